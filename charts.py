@@ -0,0 +1,47 @@
+"""Chart rendering for the /grafik command.
+
+These functions run inside a process pool, so they only take plain data
+(dicts and lists) and return PNG bytes.
+"""
+import io
+
+def render_spending_chart(expense_by_category, monthly_totals, title):
+    """Render spending by category and the monthly trend as a PNG.
+
+    expense_by_category: list of (category, amount) pairs, largest first
+    monthly_totals: list of (YYYY-MM, income, expense) tuples, oldest first
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # No display in worker processes
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import FuncFormatter
+
+    fig, (pie_ax, trend_ax) = plt.subplots(1, 2, figsize=(12, 5))
+    fig.suptitle(title)
+
+    # Spending by category
+    if expense_by_category:
+        labels = [category for category, _ in expense_by_category]
+        amounts = [amount for _, amount in expense_by_category]
+        pie_ax.pie(amounts, labels=labels, autopct='%1.1f%%', startangle=90, counterclock=False)
+        pie_ax.set_title('Pengeluaran per Kategori')
+    else:
+        pie_ax.text(0.5, 0.5, 'Belum ada pengeluaran', ha='center', va='center')
+    pie_ax.axis('equal')
+
+    # Monthly trend
+    months = [month for month, _, _ in monthly_totals]
+    trend_ax.plot(months, [income for _, income, _ in monthly_totals], marker='o', label='Pemasukan')
+    trend_ax.plot(months, [expense for _, _, expense in monthly_totals], marker='o', label='Pengeluaran')
+    trend_ax.set_title('Tren Bulanan')
+    trend_ax.yaxis.set_major_formatter(FuncFormatter(lambda value, _: f'{value:,.0f}'))
+    trend_ax.tick_params(axis='x', rotation=45)
+    trend_ax.grid(True, alpha=0.3)
+    trend_ax.legend()
+
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    plt.close(fig)
+    return buffer.getvalue()
@@ -0,0 +1,319 @@
+"""Load test: replay synthetic Telegram update streams through the bot.
+
+Every simulated user sends a transaction, confirms it, sends a multi-line
+message, confirms all of it, deletes the last transaction with /hapus and
+restores it with /batal.
+Updates are fed through Application.process_update with a stubbed Bot API,
+an in-memory ledger standing in for Google Sheets and a canned Gemini model,
+each with a configurable latency, so no network access is needed.
+
+Usage:
+    python loadtest.py --users 2000 --concurrency 1,8,32,128
+"""
+import os
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import re
+import statistics
+import tempfile
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay synthetic Telegram updates through the bot.")
+    parser.add_argument('--users', type=int, default=1000, help="simulated users per concurrency level")
+    parser.add_argument('--concurrency', default='1,8,32,128', help="comma-separated numbers of updates processed at once")
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help="seconds per Bot API call")
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help="seconds per (blocking) ledger call")
+    parser.add_argument('--gemini-latency', type=float, default=0.8, help="seconds per Gemini call")
+    parser.add_argument('--think-time', type=float, default=0.0, help="seconds a user waits between steps")
+    return parser.parse_args()
+
+args = parse_args()
+levels = [int(level) for level in args.concurrency.split(',')]
+
+# Configure the bot before it is imported: every simulated user is authorized,
+# and nothing connects to Google Sheets (the ledger is replaced below)
+os.environ['AUTHORIZED_USER_ID'] = ','.join(str(user_id) for user_id in range(1, args.users * len(levels) + 1))
+os.environ['TELEGRAM_TOKEN'] = '123456:LOADTEST'
+os.environ['GEMINI_API_KEY'] = 'loadtest'
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = ':memory:'
+os.environ['SHEETS_MIRROR'] = '0'
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import main
+
+logging.getLogger().setLevel(logging.WARNING)
+
+class StubRequest(BaseRequest):
+    """Bot API transport that answers every call locally after a delay."""
+    
+    def __init__(self, latency):
+        self.latency = latency
+        self.next_message_id = 10 ** 6
+    
+    @property
+    def read_timeout(self):
+        return None
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        
+        if endpoint == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            self.next_message_id += 1
+            result = {
+                'message_id': self.next_message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(parameters.get('chat_id', 0)), 'type': 'private'},
+                'text': parameters.get('text', '')
+            }
+        else:
+            result = True
+        
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+class StubSheetsStorage(main.LedgerStorage):
+    """In-memory ledger that blocks for a fixed time per call, like gspread."""
+    
+    def __init__(self, latency):
+        self.latency = latency
+        self.records = []
+    
+    def wait(self):
+        time.sleep(self.latency)
+    
+    def ensure_schema(self):
+        pass
+    
+    def load_records(self):
+        return [record for record in self.records if not record['Deleted']]
+    
+    def append(self, rows):
+        self.wait()
+        self.records.extend(dict(zip(main.SHEET_HEADER, row)) for row in rows)
+    
+    def delete(self, user_id, record_ids):
+        self.wait()
+        deleted_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        deleted_ids = set()
+        for record in self.records:
+            if record['ID'] in record_ids and not record['Deleted']:
+                record['Deleted'] = deleted_at
+                deleted_ids.add(record['ID'])
+        return deleted_ids
+    
+    def restore(self, user_id, record_ids):
+        self.wait()
+        restored_records = []
+        for record in self.records:
+            if record['ID'] in record_ids and record['Deleted']:
+                record['Deleted'] = ''
+                restored_records.append(record)
+        return restored_records
+    
+    def compact(self, deleted_before):
+        kept_records = [record for record in self.records if not record['Deleted'] or record['Deleted'] >= deleted_before]
+        removed_count = len(self.records) - len(kept_records)
+        self.records = kept_records
+        return removed_count
+    
+    def query(self, user_id, start_date=None, end_date=None):
+        self.wait()
+        return [
+            record for record in self.records
+            if not record['Deleted']
+            and str(record['User ID']) == str(user_id)
+            and (start_date is None or record['Date'] >= start_date)
+            and (end_date is None or record['Date'] <= end_date)
+        ]
+    
+    def existing_ids(self, user_id, record_ids):
+        self.wait()
+        return {record['ID'] for record in self.records if record['ID'] in set(record_ids)}
+    
+    def update_categories(self, changes):
+        self.wait()
+        for record in self.records:
+            if record['ID'] in changes:
+                record['Category'] = changes[record['ID']]
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+class StubModel:
+    """Gemini model that returns a fixed expense for every text."""
+    
+    def __init__(self, latency):
+        self.latency = latency
+    
+    async def generate_content_async(self, prompt):
+        await asyncio.sleep(self.latency)
+        transaction = {
+            'amount': 25000,
+            'category': 'Makanan',
+            'description': 'makan siang',
+            'transaction_type': 'expense'
+        }
+        
+        batch = re.search(r'JSON array with exactly (\d+) objects', str(prompt))
+        if batch:
+            return StubResponse(json.dumps([transaction] * int(batch.group(1))))
+        return StubResponse(json.dumps(transaction))
+
+class UpdateFactory:
+    """Build synthetic updates for simulated private chats."""
+    
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+        self.message_id = 0
+    
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+    
+    def message(self, user_id, text):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.user(user_id),
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': self.update_id, 'message': message}, self.bot)
+    
+    def callback(self, user_id, data):
+        self.update_id += 1
+        self.message_id += 1
+        callback_query = {
+            'id': str(self.update_id),
+            'from': self.user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': self.message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'Konfirmasi'
+            }
+        }
+        return Update.de_json({'update_id': self.update_id, 'callback_query': callback_query}, self.bot)
+
+def confirmation_data(application, user_id, action):
+    """Callback data of the confirmation button the bot last showed the user."""
+    session = application.user_data[user_id]['session']
+    if action == 'confirm_yes':
+        return f"confirm_yes_{session.pending_transaction['key']}"
+    return f"confirm_all_yes_{session.pending_multiple_key}"
+
+def scenario(factory, application, user_id):
+    """Return the steps of one simulated user; each builds its update when sent."""
+    return [
+        lambda: factory.message(user_id, "makan siang 25000"),
+        lambda: factory.callback(user_id, confirmation_data(application, user_id, 'confirm_yes')),
+        lambda: factory.message(user_id, "beli bensin 30000\nbayar parkir 5000"),
+        lambda: factory.callback(user_id, confirmation_data(application, user_id, 'confirm_all_yes')),
+        lambda: factory.message(user_id, "/hapus"),
+        lambda: factory.callback(user_id, "delete_last"),
+        lambda: factory.message(user_id, "/batal"),
+    ]
+
+def percentile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+async def run_level(application, factory, concurrency, first_user):
+    """Run every simulated user at once, processing at most `concurrency` updates at a time."""
+    slots = asyncio.Semaphore(concurrency)
+    queue_delays = []
+    latencies = []
+    
+    async def simulate_user(user_id):
+        for step in scenario(factory, application, user_id):
+            update = step()
+            sent = time.perf_counter()
+            async with slots:
+                queue_delays.append(time.perf_counter() - sent)
+                await application.process_update(update)
+            latencies.append(time.perf_counter() - sent)
+            
+            if args.think_time:
+                await asyncio.sleep(args.think_time)
+    
+    errors_before = application.bot_data.get('loadtest_errors', 0)
+    started = time.perf_counter()
+    # The handlers print debug output, keep it out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        await asyncio.gather(*(simulate_user(user_id) for user_id in range(first_user, first_user + args.users)))
+    elapsed = time.perf_counter() - started
+    
+    return {
+        'concurrency': concurrency,
+        'updates': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'queue_p50': percentile(queue_delays, 50),
+        'queue_p95': percentile(queue_delays, 95),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies),
+        'errors': application.bot_data.get('loadtest_errors', 0) - errors_before
+    }
+
+async def count_error(update, context):
+    context.bot_data['loadtest_errors'] = context.bot_data.get('loadtest_errors', 0) + 1
+    logging.getLogger(__name__).debug("Handler error", exc_info=context.error)
+
+async def run():
+    main.storage = StubSheetsStorage(args.sheets_latency)
+    main.model = StubModel(args.gemini_latency)
+    main.transaction_index.load()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        application = main.build_application(
+            persistence_path=os.path.join(directory, 'loadtest.pickle'),
+            request=StubRequest(args.telegram_latency)
+        )
+        application.add_error_handler(count_error)
+        await application.initialize()
+        # run_polling calls the post_init hook right after initialize
+        await application.post_init(application)
+        
+        factory = UpdateFactory(application.bot)
+        
+        print(f"{args.users} users x {len(scenario(factory, application, 0))} updates per level "
+              f"(telegram {args.telegram_latency}s, sheets {args.sheets_latency}s, gemini {args.gemini_latency}s)")
+        print(f"{'conc':>5} {'updates':>8} {'upd/s':>8} {'queue p50':>10} {'queue p95':>10} "
+              f"{'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'errors':>7}")
+        
+        for i, concurrency in enumerate(levels):
+            result = await run_level(application, factory, concurrency, 1 + i * args.users)
+            print(f"{result['concurrency']:>5} {result['updates']:>8} {result['throughput']:>8.1f} "
+                  f"{result['queue_p50']:>10.3f} {result['queue_p95']:>10.3f} "
+                  f"{result['latency_p50']:>8.3f} {result['latency_p95']:>8.3f} "
+                  f"{result['latency_p99']:>8.3f} {result['latency_max']:>8.3f} {result['errors']:>7}")
+        
+        await application.shutdown()
+
+if __name__ == '__main__':
+    asyncio.run(run())
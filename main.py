@@ -1,14 +1,36 @@
 import os
 import logging
 import json
-from datetime import datetime
+import time
+import asyncio
+import functools
+import weakref
+import re
+import io
+import uuid
+import bisect
+import sys
+import difflib
+import sqlite3
+import threading
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone, time as dtime
+import numpy as np
 import google.generativeai as genai
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden
 from telegram.ext import PicklePersistence
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import requests
+from requests.adapters import HTTPAdapter
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request
 from dotenv import load_dotenv
+from PIL import Image
+from charts import render_spending_chart
 
 # Configure logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -21,866 +43,3609 @@ GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GOOGLE_SHEETS_CREDENTIALS = os.getenv('GOOGLE_SHEETS_CREDENTIALS')
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 AUTHORIZED_USER_IDS = os.getenv('AUTHORIZED_USER_ID').split(',')
+# Admin commands are limited to these users (defaults to the first authorized user)
+ADMIN_USER_IDS = (os.getenv('ADMIN_USER_ID') or AUTHORIZED_USER_IDS[0]).split(',')
 
-# Configure Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.0-flash')
+# Auto-deletion of transaction messages
+DELETE_MESSAGES_DELAY = 1  # seconds
+DELETE_MESSAGES_BATCH_SIZE = 100  # Bot API limit for deleteMessages
+MESSAGE_DELETE_WINDOW = 48 * 60 * 60  # Telegram cannot delete older messages
+MAX_TRACKED_MESSAGES = int(os.getenv('MAX_TRACKED_MESSAGES', '200'))
+
+# Number of updates processed at the same time (across all users)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
+
+# Optional cross-user batching of Gemini parse requests
+GEMINI_BATCHING = os.getenv('GEMINI_BATCHING', '0') == '1'
+GEMINI_BATCH_WINDOW_MS = int(os.getenv('GEMINI_BATCH_WINDOW_MS', '50'))
+GEMINI_BATCH_SIZE = int(os.getenv('GEMINI_BATCH_SIZE', '10'))
+
+# Circuit breaker around Gemini (falls back to local parsing while open)
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '15'))  # seconds
+GEMINI_CB_WINDOW = int(os.getenv('GEMINI_CB_WINDOW', '20'))  # recent calls considered
+GEMINI_CB_MIN_CALLS = int(os.getenv('GEMINI_CB_MIN_CALLS', '5'))
+GEMINI_CB_ERROR_RATE = float(os.getenv('GEMINI_CB_ERROR_RATE', '0.5'))
+GEMINI_CB_SLOW_SECONDS = float(os.getenv('GEMINI_CB_SLOW_SECONDS', '8'))  # slower calls count as failures
+GEMINI_CB_COOLDOWN = float(os.getenv('GEMINI_CB_COOLDOWN', '30'))  # seconds before a half-open probe
+
+# Gemini usage accounting (/statistik), flushed to a local file
+GEMINI_USAGE_FILE = os.getenv('GEMINI_USAGE_FILE', 'gemini_usage.json')
+GEMINI_USAGE_FLUSH_INTERVAL = int(os.getenv('GEMINI_USAGE_FLUSH_INTERVAL', '300'))  # seconds
+
+# Receipt photo preprocessing before it is sent to Gemini
+RECEIPT_TARGET_SIDE = int(os.getenv('RECEIPT_TARGET_SIDE', '1280'))  # longest side in pixels
+RECEIPT_MAX_BYTES = int(os.getenv('RECEIPT_MAX_BYTES', '300000'))
+RECEIPT_JPEG_QUALITY = 80
+RECEIPT_MIN_JPEG_QUALITY = 50  # below this the image is shrunk instead
+RECEIPT_MIN_SIDE = 640  # smaller receipts become hard to read
+
+# Maximum age of a cached report, covers edits made directly in the sheet
+REPORT_CACHE_TTL = int(os.getenv('REPORT_CACHE_TTL', '300'))  # seconds
+
+# Chart rendering (/grafik) runs in a separate process pool
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+CHART_MONTHS = 12  # months shown in the trend line
+CHART_TOP_CATEGORIES = 8  # remaining categories are grouped as "Lainnya"
+
+# /analisis settings
+ANALYSIS_WINDOW = 3  # months in the moving average
+ANALYSIS_TOP_CATEGORIES = 5
+ANOMALY_RATIO = float(os.getenv('ANOMALY_RATIO', '2'))  # flag categories spending this multiple of their average
+
+# Budget warning is sent once spending crosses this share of the budget
+BUDGET_WARNING_RATIO = 0.8
+
+# Ledger storage: "sheets" (default) or "sqlite", optionally mirrored to the sheet
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sheets')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'ledger.db')
+SHEETS_MIRROR = os.getenv('SHEETS_MIRROR', '0') == '1'
+MIRROR_FLUSH_INTERVAL = int(os.getenv('MIRROR_FLUSH_INTERVAL', '30'))  # seconds
+MIRROR_BATCH_SIZE = 500  # outbox entries replayed per run
+
+# Google Sheets HTTP connections and access token upkeep
+SHEETS_POOL_SIZE = int(os.getenv('SHEETS_POOL_SIZE', '16'))  # kept-alive connections
+SHEETS_KEEPALIVE_INTERVAL = int(os.getenv('SHEETS_KEEPALIVE_INTERVAL', '120'))  # seconds
+TOKEN_REFRESH_MARGIN = 600  # refresh the access token this long before it expires (seconds)
+
+# "shared" keeps everyone in the first worksheet, "worksheet" gives each user their own
+SHEETS_TENANCY = os.getenv('SHEETS_TENANCY', 'shared')
+WORKSHEET_POOL_SIZE = int(os.getenv('WORKSHEET_POOL_SIZE', '64'))  # opened worksheets kept
+TENANT_WORKSHEET_PREFIX = "user-"
+TENANT_BATCH_RANGES = 100  # worksheet ranges per values.batchGet request
+
+# Reconciling edits made directly in the sheet
+SHEET_SYNC_INTERVAL = int(os.getenv('SHEET_SYNC_INTERVAL', '60'))  # seconds
+SYNC_BLOCK_ROWS = 500  # rows per compared block
+SYNC_SCRUB_BLOCKS = int(os.getenv('SYNC_SCRUB_BLOCKS', '4'))  # blocks re-checked per run
+
+# Cells per request when rewriting categories (or other cells) in bulk
+CATEGORY_UPDATE_BATCH_SIZE = 5000
+
+# Weekly (Mondays) and monthly (1st) digests pushed to every user
+DIGEST_TIME = dtime(7, 0, tzinfo=datetime.now().astimezone().tzinfo)
+DIGEST_SEND_RATE = int(os.getenv('DIGEST_SEND_RATE', '25'))  # messages per second, Telegram allows about 30
+DIGEST_TOP_CATEGORIES = 3
 
-# Configure Google Sheets
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDENTIALS, scope)
-client = gspread.authorize(creds)
+# Pending conversation flows expire after this much inactivity
+SESSION_TTL = int(os.getenv('SESSION_TTL', '900'))  # seconds
+SESSION_SWEEP_INTERVAL = 60  # seconds
 
-# Open the spreadsheet by ID
-spreadsheet = client.open_by_key(SPREADSHEET_ID)
-sheet = spreadsheet.sheet1  # Use the first sheet
+# New transactions matching one recorded within this window are flagged as possible duplicates
+DUPLICATE_WINDOW = int(os.getenv('DUPLICATE_WINDOW', '172800'))  # seconds
+
+# Idempotency keys of recently committed confirmations remembered to ignore repeated callbacks
+COMMITTED_KEYS_CAPACITY = 10000
+
+# Search results (/cari) and history (/riwayat) shown per page
+SEARCH_PAGE_SIZE = 5
+HISTORY_PAGE_SIZE = 5
+
+# Recurring transactions (/rutin) are materialized once a day
+RECURRING_RUN_TIME = dtime(0, 5, tzinfo=datetime.now().astimezone().tzinfo)
+
+# Tombstoned rows are physically removed once a day, off-peak
+COMPACTION_TIME = dtime(int(os.getenv('COMPACTION_HOUR', '3')), 0, tzinfo=datetime.now().astimezone().tzinfo)
+RECURRING_MAX_CATCHUP_DAYS = 31  # missed days posted after downtime
+
+# The Gemini API key is configured in main()
+model = genai.GenerativeModel('gemini-2.0-flash')
 
 # Store the spreadsheet URL for sharing
 SPREADSHEET_URL = f"https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}"
 
-def is_authorized(user_id):
-    """Check if the user is authorized to use the bot."""
-    return str(user_id) in AUTHORIZED_USER_IDS
+# Sheet columns; ID identifies generated rows such as recurring transactions,
+# Deleted holds the deletion time of rows waiting to be compacted
+SHEET_HEADER = ['Date', 'Amount', 'Category', 'Description', 'User ID', 'Timestamp', 'ID', 'Deleted']
+ID_COLUMN = SHEET_HEADER.index('ID') + 1
+DELETED_COLUMN = SHEET_HEADER.index('Deleted') + 1
 
-async def sheet_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+def column_letter(column):
+    return gspread.utils.rowcol_to_a1(1, column)[:-1]
+
+class SheetRowsGuard:
+    """Keep writes addressed by row number off rows that compaction moved.
     
-    # Check authorization
-    if not is_authorized(user_id):
-        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
-        return
+    Compaction deletes rows, shifting every row below them up. Code that
+    reads row numbers and then writes to them holds `lock` across both
+    steps; `generation` counts compactions, so a write planned from a read
+    made outside the lock can tell the rows moved in between.
+    """
     
-    user_name = update.effective_user.first_name
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.generation = 0
+
+sheet_rows = SheetRowsGuard()
+
+class SheetsConnection:
+    """Authorized HTTP session shared by every Google Sheets call.
     
-    # Create a message with the link
-    message = (
-        f"📊 *Link Google Sheet Keuangan Anda*\n\n"
-        f"Halo {user_name}, berikut adalah link untuk melihat data keuangan Anda:\n\n"
-        f"[Buka Google Sheet]({SPREADSHEET_URL})\n\n"
-        "Anda dapat melihat semua transaksi dan mengunduh data dalam format Excel/CSV."
-    )
+    Requests reuse a pool of keep-alive connections, and the access token is
+    renewed by a background job before it expires, so user requests neither
+    open new TLS connections nor wait for a token refresh.
+    """
     
-    # Create button to open the link
-    keyboard = [[InlineKeyboardButton("Buka Google Sheet", url=SPREADSHEET_URL)]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
     
-    await update.message.reply_text(
-        message, 
-        parse_mode='Markdown',
-        reply_markup=reply_markup,
-        disable_web_page_preview=True
-    )
-
-async def delete_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_name = update.effective_user.first_name
+    def __init__(self):
+        self.credentials = Credentials.from_service_account_file(GOOGLE_SHEETS_CREDENTIALS, scopes=self.SCOPES)
+        
+        # Token requests get their own pooled session
+        token_session = requests.Session()
+        token_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.token_request = Request(token_session)
+        
+        self.session = AuthorizedSession(self.credentials, auth_request=self.token_request)
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=SHEETS_POOL_SIZE))
+        
+        self.refresh_token()
+        # Calls hitting the per-minute quota (429) are retried with backoff
+        self.client = gspread.Client(self.credentials, session=self.session, http_client=gspread.BackOffHTTPClient)
     
-    # Create keyboard with deletion options
-    keyboard = [
-        [InlineKeyboardButton("Hapus Transaksi Terakhir", callback_data="delete_last")],
-        [InlineKeyboardButton("Hapus Transaksi Tertentu", callback_data="delete_specific")],
-        [InlineKeyboardButton("Hapus Berdasarkan Tanggal", callback_data="delete_date")],
-        [InlineKeyboardButton("Hapus Semua Data", callback_data="delete_all")],
-        [InlineKeyboardButton("❌ Batal", callback_data="delete_cancel")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def refresh_token(self, margin=0):
+        """Renew the access token if it expires within `margin` seconds."""
+        expiry = self.credentials.expiry  # naive UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if self.credentials.token and expiry and expiry - now > timedelta(seconds=margin):
+            return False
+        
+        self.credentials.refresh(self.token_request)
+        return True
     
-    await update.message.reply_text(
-        f"🗑️ *Hapus Data Keuangan*\n\n"
-        f"Halo {user_name}, pilih opsi penghapusan data:\n\n"
-        "⚠️ *Perhatian:* Data yang dihapus tidak dapat dikembalikan!",
-        parse_mode='Markdown',
-        reply_markup=reply_markup
-    )
+    def keep_alive(self):
+        """Make a minimal request so a pooled connection stays open."""
+        self.session.get(
+            f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}",
+            params={'fields': 'spreadsheetId'},
+            timeout=10
+        )
+
+sheets_connection = None
+
+def get_sheets_connection():
+    global sheets_connection
+    if sheets_connection is None:
+        sheets_connection = SheetsConnection()
+    return sheets_connection
+
+def open_worksheet():
+    """Connect to Google Sheets and return the spreadsheet and its first worksheet."""
+    client = get_sheets_connection().client
     
-async def delete_transaction_messages(context: ContextTypes.DEFAULT_TYPE):
-    """Delete transaction-related messages after a delay."""
-    job_data = context.job.data
-    chat_id = job_data['chat_id']
-    user_id = job_data['user_id']
+    # Open the spreadsheet by ID
+    spreadsheet = client.open_by_key(SPREADSHEET_ID)
+    return spreadsheet, spreadsheet.sheet1
+
+class LedgerStorage:
+    """Interface of the ledger backends.
     
-    # Get the user data
-    user_data = context.application.user_data.get(user_id, {})
+    Rows are lists in SHEET_HEADER order; records are dicts keyed by the
+    header names. Dates are ISO strings, so date ranges compare as text.
+    """
     
-    # Check if message deletion is enabled
-    if not user_data.get('delete_messages', True):
-        return
+    def ensure_schema(self):
+        raise NotImplementedError
     
-    # Get the list of message IDs to delete
-    messages_to_delete = user_data.get('messages_to_delete', [])
+    def load_records(self):
+        """Return every live record in insertion order, each with an ID."""
+        raise NotImplementedError
     
-    if not messages_to_delete:
-        return
+    def append(self, rows):
+        raise NotImplementedError
     
-    # Delete each message
-    for message_id in messages_to_delete:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception as e:
-            logger.error(f"Error deleting message {message_id}: {e}")
+    def delete(self, user_id, record_ids):
+        """Tombstone a user's records by ID and return the IDs that were found."""
+        raise NotImplementedError
     
-    # Clear the list of messages to delete
-    context.application.user_data[user_id]['messages_to_delete'] = []
-
-async def toggle_delete_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+    def restore(self, user_id, record_ids):
+        """Clear the tombstones of a user's records by ID and return the restored records."""
+        raise NotImplementedError
     
-    # Check authorization
-    if not is_authorized(user_id):
-        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
-        return
+    def compact(self, deleted_before):
+        """Physically remove rows tombstoned before the given timestamp; return how many."""
+        raise NotImplementedError
     
-    # Toggle the setting
-    if 'delete_messages' not in context.user_data:
-        context.user_data['delete_messages'] = True
-    else:
-        context.user_data['delete_messages'] = not context.user_data['delete_messages']
+    def query(self, user_id, start_date=None, end_date=None):
+        """Return a user's live records in insertion order, optionally within a date range."""
+        raise NotImplementedError
     
-    # Inform the user of the current setting
-    status = "AKTIF" if context.user_data['delete_messages'] else "NONAKTIF"
+    def expense_totals(self, user_id, start_date=None, end_date=None):
+        """Return a user's spending per stored category as positive amounts."""
+        totals = {}
+        for record in self.query(user_id, start_date, end_date):
+            try:
+                amount = float(record.get('Amount', 0))
+            except (TypeError, ValueError):
+                continue
+            if amount < 0:
+                category = record.get('Category', '')
+                totals[category] = totals.get(category, 0) + abs(amount)
+        return totals
     
-    await update.message.reply_text(
-        f"🗑️ Penghapusan pesan otomatis: {status}\n\n"
-        f"{'Pesan akan dihapus otomatis setelah transaksi dicatat.' if context.user_data['delete_messages'] else 'Pesan tidak akan dihapus otomatis.'}"
-    )
-
-async def delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = update.effective_user.id
+    def existing_ids(self, user_id, record_ids):
+        """Return the subset of a user's given IDs that are already stored, tombstoned or not."""
+        raise NotImplementedError
     
-    # Check authorization
-    if not is_authorized(user_id):
-        await query.answer("Anda tidak memiliki akses untuk menggunakan bot ini.", show_alert=True)
-        return
+    def existing_ids_by_user(self, ids_by_user):
+        """Like existing_ids for several users at once, given as {user ID: IDs}."""
+        existing_ids = set()
+        for user_id, record_ids in ids_by_user.items():
+            existing_ids |= self.existing_ids(user_id, record_ids)
+        return existing_ids
     
-    await query.answer()
-    action = query.data.split("_")[1]
+    def update_categories(self, changes):
+        """Set new categories, given as {record ID: category}."""
+        raise NotImplementedError
     
+    def sheet_url(self, user_id):
+        """Return the link to a user's data in Google Sheets, if there is one."""
+        return None
+
+class SheetsStorage(LedgerStorage):
+    """Ledger kept in the first worksheet of the Google spreadsheet."""
     
-    if action == "cancel":
-        await query.edit_message_text("❌ Penghapusan data dibatalkan.")
-        return
+    def __init__(self, spreadsheet=None, sheet=None):
+        if sheet is None:
+            spreadsheet, sheet = open_worksheet()
+        self.spreadsheet, self.sheet = spreadsheet, sheet
     
-    elif action == "last":
-        # Delete the last transaction for this user
-        all_records = sheet.get_all_records()
-        user_records = [record for record in all_records if str(record.get('User ID')) == str(user_id)]
+    def header_outdated(self, header):
+        """Whether the header row should be rewritten with SHEET_HEADER."""
+        if header == SHEET_HEADER:
+            return False
         
-        if not user_records:
-            await query.edit_message_text("❌ Tidak ada transaksi untuk dihapus.")
-            return
+        if header != SHEET_HEADER[:len(header)]:
+            logger.warning(f"Unexpected sheet header {header} in {self.sheet.title}, leaving it unchanged")
+            return False
         
-        # Find the last transaction's row
-        last_record = user_records[-1]
-        all_values = sheet.get_all_values()
-        header = all_values[0]  # First row is header
-        
-        # Find the row index of the last transaction
-        row_index = None
-        for i, row in enumerate(all_values[1:], start=2):  # Start from 2 because row 1 is header
-            record = dict(zip(header, row))
-            if (str(record.get('User ID')) == str(user_id) and 
-                record.get('Timestamp') == last_record.get('Timestamp')):
-                row_index = i
-                break
-        
-        if row_index:
-            # Delete the row
-            sheet.delete_rows(row_index)
-            
-            # Show confirmation with details of deleted transaction
-            amount = float(last_record.get('Amount', 0))
-            transaction_type = "Pemasukan" if amount > 0 else "Pengeluaran"
-            
-            await query.edit_message_text(
-                "✅ Transaksi terakhir berhasil dihapus!\n\n"
-                f"Jenis: {transaction_type}\n"
-                f"Jumlah: Rp {abs(amount):,.0f}\n"
-                f"Kategori: {last_record.get('Category', 'Lainnya')}\n"
-                f"Deskripsi: {last_record.get('Description', '')}\n"
-                f"Tanggal: {last_record.get('Date', '')}"
-            )
-        else:
-            await query.edit_message_text("❌ Tidak dapat menemukan transaksi terakhir.")
+        return True
     
-    elif action == "specific":
-        # Show recent transactions for selection
-        all_records = sheet.get_all_records()
-        user_records = [record for record in all_records if str(record.get('User ID')) == str(user_id)]
+    def ensure_schema(self):
+        """Write the header row, adding columns that are missing from older sheets."""
+        if self.sheet.col_count < len(SHEET_HEADER):
+            self.sheet.add_cols(len(SHEET_HEADER) - self.sheet.col_count)
         
-        if not user_records:
-            await query.edit_message_text("❌ Tidak ada transaksi untuk dihapus.")
-            return
+        if self.header_outdated(self.sheet.row_values(1)):
+            self.sheet.update(range_name='A1', values=[SHEET_HEADER])
+    
+    def parse_values(self, all_values):
+        """Turn the sheet's values into live records, assigning IDs to rows that have none.
         
-        # Get the last 5 transactions (or fewer if there aren't 5)
-        recent_transactions = user_records[-5:] if len(user_records) >= 5 else user_records
-        
-        # Create buttons for each transaction
-        keyboard = []
-        for i, transaction in enumerate(recent_transactions):
-            amount = float(transaction.get('Amount', 0))
-            transaction_type = "➕" if amount > 0 else "➖"
-            date = transaction.get('Date', '')
-            description = transaction.get('Description', '')
-            # Truncate description if too long
-            if len(description) > 20:
-                description = description[:17] + "..."
-            
-            # Create a button with transaction info
-            label = f"{date}: {transaction_type} Rp{abs(amount):,.0f} - {description}"
-            # Truncate label if too long
-            if len(label) > 64:  # Telegram button label limit
-                label = label[:61] + "..."
+        Returns the records and the ID cells to write, as batch_update entries.
+        """
+        records = []
+        missing_ids = []
+        header = all_values[0] if all_values else SHEET_HEADER
+        for row_number, row in enumerate(all_values[1:], start=2):
+            record = dict(zip(header, list(row) + [''] * (len(header) - len(row))))
+            if record.get('Deleted'):
+                continue
+            if not record.get('ID'):
+                # Rows typed directly into the sheet get an ID on first load
+                record['ID'] = new_transaction_id()
+                missing_ids.append({
+                    'range': gspread.utils.rowcol_to_a1(row_number, ID_COLUMN),
+                    'values': [[record['ID']]]
+                })
+            records.append(record)
+        return records, missing_ids
+    
+    def load_records(self):
+        """Read the whole sheet once, assigning IDs to rows that have none."""
+        with sheet_rows.lock:
+            records, missing_ids = self.parse_values(self.sheet.get_all_values())
             
-            keyboard.append([InlineKeyboardButton(label, callback_data=f"del_specific_{i}")])
+            if missing_ids:
+                self.sheet.batch_update(missing_ids)
+                logger.info(f"Assigned IDs to {len(missing_ids)} transactions")
         
-        # Add a cancel button
-        keyboard.append([InlineKeyboardButton("❌ Batal", callback_data="delete_cancel")])
-        
-        # Store the transactions in context for later reference
-        context.user_data['recent_transactions'] = recent_transactions
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(
-            "Pilih transaksi yang ingin dihapus:",
-            reply_markup=reply_markup
-        )
+        return records
     
-    elif action == "date":
-        # Ask for date range
-        context.user_data['delete_state'] = 'awaiting_start_date'
-        
-        await query.edit_message_text(
-            "📅 *Hapus Berdasarkan Tanggal*\n\n"
-            "Masukkan tanggal awal (format: YYYY-MM-DD):\n"
-            "Contoh: 2023-05-01",
-            parse_mode='Markdown'
-        )
+    def append(self, rows):
+        if len(rows) == 1:
+            self.sheet.append_row(rows[0])
+        else:
+            self.sheet.append_rows(rows)
     
-    elif action == "all":
-        # Ask for confirmation before deleting all
-        keyboard = [
-            [InlineKeyboardButton("✅ Ya, Hapus Semua", callback_data="confirm_delete_all")],
-            [InlineKeyboardButton("❌ Tidak, Batalkan", callback_data="delete_cancel")]
+    @staticmethod
+    def tombstone_ranges():
+        """A1 ranges of the ID and Deleted columns below the header."""
+        id_letter, deleted_letter = column_letter(ID_COLUMN), column_letter(DELETED_COLUMN)
+        return [f"{id_letter}2:{id_letter}", f"{deleted_letter}2:{deleted_letter}"]
+    
+    def tombstones(self, id_values=None, deleted_values=None):
+        """Return (row number, ID, deletion time) of every data row, from two columns.
+        
+        The columns are read unless their values are passed in.
+        """
+        if id_values is None:
+            id_values, deleted_values = self.sheet.batch_get(self.tombstone_ranges())
+        row_count = max(len(id_values), len(deleted_values))
+        return [
+            (
+                row_number,
+                id_values[i][0] if i < len(id_values) and id_values[i] else '',
+                deleted_values[i][0] if i < len(deleted_values) and deleted_values[i] else ''
+            )
+            for i, row_number in enumerate(range(2, row_count + 2))
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    def mark_deleted(self, row_numbers, value):
+        """Write the Deleted cell of the given rows with one batched update."""
+        if row_numbers:
+            self.sheet.batch_update([
+                {'range': gspread.utils.rowcol_to_a1(row_number, DELETED_COLUMN), 'values': [[value]]}
+                for row_number in row_numbers
+            ])
+    
+    def read_rows(self, rows_to_fetch):
+        """Fetch the given rows as contiguous ranges in one request.
         
-        await query.edit_message_text(
-            "⚠️ *PERINGATAN*\n\n"
-            "Anda akan menghapus SEMUA data keuangan Anda.\n"
-            "Tindakan ini TIDAK DAPAT DIBATALKAN.\n\n"
-            "Apakah Anda yakin ingin melanjutkan?",
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
+        Returns (row number, row) pairs; rows past the end of a range are empty.
+        """
+        ranges = []
+        for row_number in sorted(rows_to_fetch):
+            if ranges and ranges[-1][1] == row_number - 1:
+                ranges[-1][1] = row_number
+            else:
+                ranges.append([row_number, row_number])
         
-async def process_multiple_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE, transactions):
-    """Process multiple transactions and ask for confirmation."""
-    user_id = update.effective_user.id
+        last_column = column_letter(len(SHEET_HEADER))
+        blocks = self.sheet.batch_get([f"A{start}:{last_column}{end}" for start, end in ranges]) if ranges else []
+        
+        rows = []
+        for (start, end), block in zip(ranges, blocks):
+            rows.extend(zip(range(start, end + 1), list(block) + [[]] * (end - start + 1 - len(block))))
+        return rows
     
-    # Create a summary of the transactions
-    confirmation_message = f"📝 *{len(transactions)} Transaksi Terdeteksi*\n\n"
+    def delete(self, user_id, record_ids):
+        # Rows are only marked, so no row below them moves
+        with sheet_rows.lock:
+            rows = [
+                (row_number, record_id) for row_number, record_id, deleted in self.tombstones()
+                if record_id in record_ids and not deleted
+            ]
+            self.mark_deleted([row_number for row_number, _ in rows], datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        return {record_id for _, record_id in rows}
     
-    # Make a deep copy of the transactions to avoid reference issues
-    processed_transactions = []
+    def restore(self, user_id, record_ids):
+        # Two columns locate the rows, then only those rows are fetched
+        with sheet_rows.lock:
+            row_numbers = [
+                row_number for row_number, record_id, deleted in self.tombstones()
+                if record_id in record_ids and deleted
+            ]
+            rows = self.read_rows(row_numbers)
+            self.mark_deleted(row_numbers, '')
+        
+        restored = []
+        for _, row in rows:
+            record = dict(zip(SHEET_HEADER, list(row) + [''] * (len(SHEET_HEADER) - len(row))))
+            record['Deleted'] = ''
+            restored.append(record)
+        return restored
     
-    for i, transaction in enumerate(transactions, 1):
-        # Create a new dictionary for each transaction to avoid reference issues
-        processed_transaction = {
-            'amount': float(transaction.get('amount', 0)),  # Ensure amount is a float
-            'category': str(transaction.get('category', 'Lainnya')),  # Ensure category is a string
-            'description': str(transaction.get('description', f'Transaksi {i}')),  # Ensure description is a string
-            'date': str(transaction.get('date', datetime.now().strftime("%Y-%m-%d")))  # Ensure date is a string
-        }
+    def compaction_requests(self, tombstones, deleted_before):
+        """Build the deleteDimension requests removing rows tombstoned before a time.
         
-        # Add to processed transactions
-        processed_transactions.append(processed_transaction)
+        Contiguous runs of rows become one request each, ordered bottom-up so
+        earlier requests don't shift later ones. Returns the requests and the
+        number of rows they remove.
+        """
+        rows = [
+            row_number for row_number, _, deleted in tombstones
+            if deleted and deleted < deleted_before
+        ]
         
-        # Transaction type for display
-        transaction_type = "Pemasukan" if processed_transaction['amount'] > 0 else "Pengeluaran"
+        ranges = []
+        for row_number in rows:
+            if ranges and ranges[-1][1] == row_number - 1:
+                ranges[-1][1] = row_number
+            else:
+                ranges.append([row_number, row_number])
         
-        # Format the date for display
-        try:
-            display_date = datetime.strptime(processed_transaction['date'], "%Y-%m-%d").strftime("%d/%m/%Y")
-        except:
-            display_date = processed_transaction['date']
+        requests = [
+            {'deleteDimension': {'range': {
+                'sheetId': self.sheet.id,
+                'dimension': 'ROWS',
+                'startIndex': start - 1,
+                'endIndex': end
+            }}}
+            for start, end in reversed(ranges)
+        ]
+        return requests, len(rows)
+    
+    def compact(self, deleted_before):
+        with sheet_rows.lock:
+            requests, removed_count = self.compaction_requests(self.tombstones(), deleted_before)
+            if requests:
+                self.spreadsheet.batch_update({'requests': requests})
+                sheet_rows.generation += 1
+        return removed_count
+    
+    def query(self, user_id, start_date=None, end_date=None):
+        # The sheet has no server-side filter, every row is downloaded. Cells
+        # stay text so IDs such as '012345678901' or '12345e678901' survive
+        all_values = self.sheet.get_all_values()
+        header = all_values[0] if all_values else SHEET_HEADER
         
-        confirmation_message += f"*Transaksi {i}:*\n"
-        confirmation_message += f"Tanggal: {display_date}\n"
-        confirmation_message += f"Jenis: {transaction_type}\n"
-        confirmation_message += f"Jumlah: Rp {abs(processed_transaction['amount']):,.0f}\n"
-        confirmation_message += f"Kategori: {processed_transaction['category']}\n"
-        confirmation_message += f"Deskripsi: {processed_transaction['description']}\n\n"
+        records = []
+        for row in all_values[1:]:
+            record = dict(zip(header, list(row) + [''] * (len(header) - len(row))))
+            if (
+                str(record.get('User ID')) == str(user_id)
+                and not record.get('Deleted')
+                and (start_date is None or record.get('Date', '') >= start_date)
+                and (end_date is None or record.get('Date', '') <= end_date)
+            ):
+                record['Amount'] = gspread.utils.numericise(record.get('Amount', ''))
+                records.append(record)
+        return records
     
-    confirmation_message += "Apakah semua transaksi ini benar?"
+    def existing_ids(self, user_id, record_ids):
+        return set(self.sheet.col_values(ID_COLUMN)) & set(record_ids)
     
-    # Print for debugging
-    print(f"Storing {len(processed_transactions)} transactions in context")
-    for i, t in enumerate(processed_transactions):
-        print(f"Transaction {i+1}: {t}")
+    def existing_ids_by_user(self, ids_by_user):
+        # Every user shares the sheet, so one read of the ID column covers them all
+        return self.existing_ids(None, set().union(*ids_by_user.values()))
     
-    # Save processed transactions in context with a clear key
-    context.user_data['pending_multiple_transactions'] = processed_transactions.copy()
+    def update_categories(self, changes):
+        """Write changed Category cells with batched updates."""
+        category_column = SHEET_HEADER.index('Category') + 1
+        
+        with sheet_rows.lock:
+            updates = []
+            for row_number, record_id in enumerate(self.sheet.col_values(ID_COLUMN)[1:], start=2):
+                if record_id in changes:
+                    updates.append({
+                        'range': gspread.utils.rowcol_to_a1(row_number, category_column),
+                        'values': [[changes[record_id]]]
+                    })
+            
+            for i in range(0, len(updates), CATEGORY_UPDATE_BATCH_SIZE):
+                self.sheet.batch_update(updates[i:i + CATEGORY_UPDATE_BATCH_SIZE])
     
-    # Create confirmation buttons
-    keyboard = [
-        [InlineKeyboardButton("✅ Benar Semua", callback_data="confirm_all_yes"),
-         InlineKeyboardButton("❌ Batal", callback_data="confirm_all_no")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def sheet_url(self, user_id):
+        return SPREADSHEET_URL
+
+class TenantSheetsStorage(LedgerStorage):
+    """Ledger split into one worksheet per user inside the spreadsheet.
     
-    # Send confirmation message and store its ID
-    conf_message = await update.message.reply_text(
-        confirmation_message, 
-        reply_markup=reply_markup, 
-        parse_mode='Markdown'
-    )
+    Worksheets are named after the user ID and created on first use, so a
+    user's reads only download that user's rows. Opened worksheet handles
+    are kept in a bounded LRU pool.
+    """
     
-    # Add the confirmation message ID to the list for deletion
-    if 'messages_to_delete' not in context.user_data:
-        context.user_data['messages_to_delete'] = []
-    context.user_data['messages_to_delete'].append(conf_message.message_id)
+    def __init__(self, pool_size):
+        self.spreadsheet, _ = open_worksheet()
+        self.pool_size = pool_size
+        self.pool = OrderedDict()  # user ID -> SheetsStorage for the user's worksheet
+        self.pool_lock = threading.Lock()  # the sheet mirror runs in worker threads
     
-async def multiple_transactions_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle confirmation for multiple transactions."""
-    query = update.callback_query
-    user_id = update.effective_user.id
+    def worksheet_title(self, user_id):
+        return f"{TENANT_WORKSHEET_PREFIX}{user_id}"
     
-    # Check authorization
-    if not is_authorized(user_id):
-        await query.answer("Anda tidak memiliki akses untuk menggunakan bot ini.", show_alert=True)
-        return
-    
-    await query.answer()
-    
-    if query.data == "confirm_all_yes":
-        # Get the pending transactions
-        transactions = context.user_data.get('pending_multiple_transactions', [])
-        
-        if not transactions:
-            await query.edit_message_text("❌ Terjadi kesalahan. Tidak ada transaksi untuk disimpan.")
-            return
-        
-        # Show processing message
-        processing_message = await query.edit_message_text(f"⏳ Menyimpan {len(transactions)} transaksi...")
+    def tenant(self, user_id, create=True):
+        """Return the storage for a user's worksheet, opening or creating it as needed."""
+        user_key = str(user_id)
+        with self.pool_lock:
+            if user_key in self.pool:
+                self.pool.move_to_end(user_key)
+                return self.pool[user_key]
         
-        # Record all transactions to the sheet
-        success_count = 0
-        for transaction in transactions:
-            try:
-                # Prepare row data
-                row_data = [
-                    transaction.get('date', datetime.now().strftime("%Y-%m-%d")),
-                    transaction.get('amount', 0),
-                    transaction.get('category', 'Lainnya'),
-                    transaction.get('description', ''),
-                    user_id,
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                ]
-                
-                # Append to Google Sheet
-                sheet.append_row(row_data)
-                success_count += 1
-                
-                # Add a small delay between insertions
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logger.error(f"Error recording transaction: {e}", exc_info=True)
+        try:
+            worksheet = self.spreadsheet.worksheet(self.worksheet_title(user_key))
+        except gspread.exceptions.WorksheetNotFound:
+            if not create:
+                return None
+            worksheet = self.spreadsheet.add_worksheet(
+                title=self.worksheet_title(user_key), rows=1000, cols=len(SHEET_HEADER)
+            )
+            worksheet.update(range_name='A1', values=[SHEET_HEADER])
         
-        # Clear the pending transactions
-        context.user_data.pop('pending_multiple_transactions', None)
+        return self.add_to_pool(user_key, worksheet)
+    
+    def add_to_pool(self, user_key, worksheet):
+        tenant = SheetsStorage(self.spreadsheet, worksheet)
+        with self.pool_lock:
+            self.pool[user_key] = tenant
+            self.pool.move_to_end(user_key)
+            while len(self.pool) > self.pool_size:
+                self.pool.popitem(last=False)
+        return tenant
+    
+    def tenant_worksheets(self):
+        """Return (user ID, worksheet) for every user worksheet, in one metadata call."""
+        return [
+            (worksheet.title[len(TENANT_WORKSHEET_PREFIX):], worksheet)
+            for worksheet in self.spreadsheet.worksheets()
+            if worksheet.title.startswith(TENANT_WORKSHEET_PREFIX)
+        ]
+    
+    def tenants(self):
+        """Return the storage of every user worksheet, adding them to the pool."""
+        return [self.add_to_pool(user_key, worksheet) for user_key, worksheet in self.tenant_worksheets()]
+    
+    def batch_get_values(self, tenants, ranges):
+        """Read the same ranges from several worksheets with few values.batchGet calls.
         
-        # Send confirmation message
-        confirmation_message = await query.edit_message_text(
-            f"✅ {success_count} dari {len(transactions)} transaksi berhasil dicatat!\n\n"
-            f"Gunakan /laporan untuk melihat ringkasan keuangan Anda."
-        )
+        Returns, per tenant, the list of values of each range. Reading every
+        worksheet separately would exhaust the per-minute read quota at startup.
+        """
+        absolute_ranges = [
+            gspread.utils.absolute_range_name(tenant.sheet.title, range_name)
+            for tenant in tenants for range_name in ranges
+        ]
         
-        # Store the message ID for deletion
-        if 'messages_to_delete' not in context.user_data:
-            context.user_data['messages_to_delete'] = []
+        values = []
+        for i in range(0, len(absolute_ranges), TENANT_BATCH_RANGES):
+            response = self.spreadsheet.values_batch_get(absolute_ranges[i:i + TENANT_BATCH_RANGES])
+            values.extend(value_range.get('values', []) for value_range in response.get('valueRanges', []))
         
-        # Add the confirmation message ID to the list
-        context.user_data['messages_to_delete'].append(confirmation_message.message_id)
+        return [values[i:i + len(ranges)] for i in range(0, len(values), len(ranges))]
+    
+    def batch_update_values(self, updates):
+        """Write (tenant, batch_update entries) pairs with one values.batchUpdate call."""
+        data = [
+            {'range': gspread.utils.absolute_range_name(tenant.sheet.title, entry['range']), 'values': entry['values']}
+            for tenant, entries in updates for entry in entries
+        ]
+        for i in range(0, len(data), CATEGORY_UPDATE_BATCH_SIZE):
+            self.spreadsheet.values_batch_update({'valueInputOption': 'RAW', 'data': data[i:i + CATEGORY_UPDATE_BATCH_SIZE]})
+    
+    def ensure_schema(self):
+        # New worksheets get their header when created; older ones may lack columns
+        tenants = self.tenants()
+        widen = [
+            {'appendDimension': {
+                'sheetId': tenant.sheet.id,
+                'dimension': 'COLUMNS',
+                'length': len(SHEET_HEADER) - tenant.sheet.col_count
+            }}
+            for tenant in tenants if tenant.sheet.col_count < len(SHEET_HEADER)
+        ]
+        if widen:
+            self.spreadsheet.batch_update({'requests': widen})
         
-        # Schedule message deletion after 1 seconds
-        context.job_queue.run_once(
-            delete_transaction_messages, 
-            1,  # 1 seconds delay
-            data={'chat_id': update.effective_chat.id, 'user_id': user_id}
-        )
+        header_range = f"A1:{column_letter(len(SHEET_HEADER))}1"
+        self.batch_update_values([
+            (tenant, [{'range': 'A1', 'values': [SHEET_HEADER]}])
+            for tenant, (header,) in zip(tenants, self.batch_get_values(tenants, [header_range]))
+            if tenant.header_outdated(header[0] if header else [])
+        ])
     
-    elif query.data == "confirm_all_no":
-        # Clear the pending transactions
-        context.user_data.pop('pending_multiple_transactions', None)
+    def load_records(self):
+        tenants = self.tenants()
         
-        await query.edit_message_text(
-            "❌ Pencatatan transaksi dibatalkan."
-        )
-
-async def delete_specific_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+        records = []
+        missing_ids = []
+        with sheet_rows.lock:
+            for tenant, (all_values,) in zip(tenants, self.batch_get_values(tenants, ["A1:" + column_letter(len(SHEET_HEADER))])):
+                tenant_records, tenant_missing_ids = tenant.parse_values(all_values)
+                records.extend(tenant_records)
+                missing_ids.append((tenant, tenant_missing_ids))
+            
+            self.batch_update_values(missing_ids)
+        return records
     
-    user_id = update.effective_user.id
+    def append(self, rows):
+        rows_by_user = {}
+        for row in rows:
+            rows_by_user.setdefault(str(row[4]), []).append(row)
+        for user_key, user_rows in rows_by_user.items():
+            self.tenant(user_key).append(user_rows)
     
-    # Extract the index from the callback data
-    index = int(query.data.split("_")[2])
+    def delete(self, user_id, record_ids):
+        tenant = self.tenant(user_id, create=False)
+        return tenant.delete(user_id, record_ids) if tenant else set()
     
-    # Get the transaction from stored context
-    if 'recent_transactions' not in context.user_data or index >= len(context.user_data['recent_transactions']):
-        await query.edit_message_text("❌ Terjadi kesalahan. Silakan coba lagi.")
-        return
+    def restore(self, user_id, record_ids):
+        tenant = self.tenant(user_id, create=False)
+        return tenant.restore(user_id, record_ids) if tenant else []
     
-    transaction = context.user_data['recent_transactions'][index]
+    def compact(self, deleted_before):
+        tenants = self.tenants()
+        
+        requests = []
+        removed_count = 0
+        with sheet_rows.lock:
+            for tenant, (id_values, deleted_values) in zip(tenants, self.batch_get_values(tenants, SheetsStorage.tombstone_ranges())):
+                tenant_requests, tenant_count = tenant.compaction_requests(tenant.tombstones(id_values, deleted_values), deleted_before)
+                requests.extend(tenant_requests)
+                removed_count += tenant_count
+            
+            if requests:
+                self.spreadsheet.batch_update({'requests': requests})
+                sheet_rows.generation += 1
+        return removed_count
     
-    # Find the row to delete
-    all_values = sheet.get_all_values()
-    header = all_values[0]  # First row is header
+    def query(self, user_id, start_date=None, end_date=None):
+        tenant = self.tenant(user_id, create=False)
+        return tenant.query(user_id, start_date, end_date) if tenant else []
     
-    # Find the row index of the transaction
-    row_index = None
-    for i, row in enumerate(all_values[1:], start=2):  # Start from 2 because row 1 is header
-        record = dict(zip(header, row))
-        if (str(record.get('User ID')) == str(user_id) and 
-            record.get('Timestamp') == transaction.get('Timestamp')):
-            row_index = i
-            break
+    def existing_ids(self, user_id, record_ids):
+        tenant = self.tenant(user_id, create=False)
+        return tenant.existing_ids(user_id, record_ids) if tenant else set()
     
-    if row_index:
-        # Delete the row
-        sheet.delete_rows(row_index)
+    def existing_ids_by_user(self, ids_by_user):
+        # One metadata call finds the worksheets and one batched read covers their ID columns
+        user_keys = {str(user_id) for user_id in ids_by_user}
+        tenants = [
+            self.add_to_pool(user_key, worksheet) for user_key, worksheet in self.tenant_worksheets()
+            if user_key in user_keys
+        ]
+        id_range = f"{column_letter(ID_COLUMN)}2:{column_letter(ID_COLUMN)}"
         
-        # Show confirmation with details of deleted transaction
-        amount = float(transaction.get('Amount', 0))
-        transaction_type = "Pemasukan" if amount > 0 else "Pengeluaran"
+        stored_ids = set()
+        for (id_values,) in self.batch_get_values(tenants, [id_range]):
+            stored_ids.update(row[0] for row in id_values if row)
+        return stored_ids & set().union(*ids_by_user.values())
+    
+    def update_categories(self, changes):
+        tenants = self.tenants()
+        category_column = SHEET_HEADER.index('Category') + 1
+        id_range = f"{column_letter(ID_COLUMN)}2:{column_letter(ID_COLUMN)}"
         
-        await query.edit_message_text(
-            "✅ Transaksi berhasil dihapus!\n\n"
-            f"Jenis: {transaction_type}\n"
-            f"Jumlah: Rp {abs(amount):,.0f}\n"
-            f"Kategori: {transaction.get('Category', 'Lainnya')}\n"
-            f"Deskripsi: {transaction.get('Description', '')}\n"
-            f"Tanggal: {transaction.get('Date', '')}"
-        )
-    else:
-        await query.edit_message_text("❌ Tidak dapat menemukan transaksi yang dipilih.")
+        updates = []
+        with sheet_rows.lock:
+            for tenant, (id_values,) in zip(tenants, self.batch_get_values(tenants, [id_range])):
+                updates.append((tenant, [
+                    {'range': gspread.utils.rowcol_to_a1(row_number, category_column), 'values': [[changes[row[0]]]]}
+                    for row_number, row in enumerate(id_values, start=2)
+                    if row and row[0] in changes
+                ]))
+            
+            self.batch_update_values(updates)
+    
+    def sheet_url(self, user_id):
+        tenant = self.tenant(user_id)
+        return f"{SPREADSHEET_URL}#gid={tenant.sheet.id}"
 
-# Handle date input for deletion
-async def handle_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    message_text = update.message.text.strip()
+def holding_lock(method):
+    """Run a storage method while holding the instance's lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class SqliteStorage(LedgerStorage):
+    """Ledger kept in a local SQLite database.
     
-    # Check if we're in the date deletion flow
-    if 'delete_state' not in context.user_data:
-        return
+    With `mirror` set, every change is also written to an outbox table in
+    the same transaction; flush_sheets_mirror replays it onto the sheet later.
+    The single connection is shared by the worker threads, so every method
+    holds a lock: otherwise one thread's commit or rollback could cover the
+    statements of another.
+    """
     
-    delete_state = context.user_data['delete_state']
+    COLUMNS = ['date', 'amount', 'category', 'description', 'user_id', 'timestamp', 'id', 'deleted']
     
-    # Validate date format (YYYY-MM-DD)
-    import re
-    if not re.match(r'^\d{4}-\d{2}-\d{2}$', message_text):
-        await update.message.reply_text(
-            "❌ Format tanggal tidak valid. Gunakan format YYYY-MM-DD.\n"
-            "Contoh: 2023-05-01\n\n"
-            "Silakan coba lagi:"
-        )
-        return
+    def __init__(self, path, mirror=False):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.RLock()
+        self.mirror = mirror
     
-    if delete_state == 'awaiting_start_date':
-        # Store start date and ask for end date
-        context.user_data['start_date'] = message_text
-        context.user_data['delete_state'] = 'awaiting_end_date'
-        
-        await update.message.reply_text(
-            "📅 Masukkan tanggal akhir (format: YYYY-MM-DD):\n"
-            "Contoh: 2023-05-31"
-        )
+    @holding_lock
+    def ensure_schema(self):
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS transactions ("
+                "id TEXT PRIMARY KEY, date TEXT, amount REAL, category TEXT, "
+                "description TEXT, user_id TEXT, timestamp TEXT, deleted TEXT NOT NULL DEFAULT '')"
+            )
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(transactions)")}
+            if 'deleted' not in columns:
+                self.connection.execute("ALTER TABLE transactions ADD COLUMN deleted TEXT NOT NULL DEFAULT ''")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS mirror_outbox ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, payload TEXT)"
+            )
     
-    elif delete_state == 'awaiting_end_date':
-        start_date = context.user_data['start_date']
-        end_date = message_text
-        
-        # Validate that end date is after start date
-        if end_date < start_date:
-            await update.message.reply_text(
-                "❌ Tanggal akhir harus setelah tanggal awal.\n"
-                "Silakan masukkan tanggal akhir yang valid:"
+    def to_records(self, cursor_rows):
+        return [dict(zip(SHEET_HEADER, row)) for row in cursor_rows]
+    
+    @holding_lock
+    def select(self, conditions='', params=()):
+        """Return the live records matching extra SQL conditions."""
+        columns = ', '.join(self.COLUMNS)
+        where = "WHERE deleted = ''" + (f" AND {conditions}" if conditions else "")
+        return self.to_records(self.connection.execute(
+            f"SELECT {columns} FROM transactions {where} ORDER BY rowid", params
+        ))
+    
+    def add_to_outbox(self, op, payload):
+        if self.mirror:
+            self.connection.execute(
+                "INSERT INTO mirror_outbox (op, payload) VALUES (?, ?)", (op, json.dumps(payload))
             )
-            return
-        
-        # Get all records
-        all_records = sheet.get_all_records()
-        
-        # Filter records by user ID and date range
-        user_records_in_range = [
-            record for record in all_records 
-            if str(record.get('User ID')) == str(user_id) and 
-               start_date <= record.get('Date', '') <= end_date
+    
+    @holding_lock
+    def load_records(self):
+        return self.select()
+    
+    @holding_lock
+    def append(self, rows):
+        rows = [
+            list(row[:4]) + [str(row[4])] + list(row[5:]) + [''] * (len(self.COLUMNS) - len(row))
+            for row in rows
         ]
         
-        if not user_records_in_range:
-            await update.message.reply_text(
-                "❌ Tidak ada transaksi dalam rentang tanggal tersebut."
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR IGNORE INTO transactions ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                rows
             )
-            # Clear delete state
-            context.user_data.pop('delete_state', None)
-            context.user_data.pop('start_date', None)
-            return
-        
-        # Ask for confirmation
-        context.user_data['records_to_delete'] = user_records_in_range
-        
-        # Create confirmation message
-        confirmation_message = (
-            f"🗑️ *Konfirmasi Penghapusan*\n\n"
-            f"Anda akan menghapus {len(user_records_in_range)} transaksi "
-            f"dari {start_date} hingga {end_date}.\n\n"
-            "Apakah Anda yakin ingin melanjutkan?"
-        )
-        
-        keyboard = [
-            [InlineKeyboardButton("✅ Ya, Hapus", callback_data="confirm_delete_date")],
-            [InlineKeyboardButton("❌ Tidak, Batalkan", callback_data="delete_cancel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(
-            confirmation_message,
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-
-async def confirm_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+            self.add_to_outbox('append', rows)
     
-    user_id = update.effective_user.id
-    action = query.data.split("_")[2]  # confirm_delete_all or confirm_delete_date
-    
-    if action == "all":
-        # Delete all transactions for this user
-        all_values = sheet.get_all_values()
-        header = all_values[0]  # First row is header
-        
-        # Find all rows to delete (in reverse order to avoid index shifting)
-        rows_to_delete = []
-        for i, row in enumerate(all_values[1:], start=2):  # Start from 2 because row 1 is header
-            record = dict(zip(header, row))
-            if str(record.get('User ID')) == str(user_id):
-                rows_to_delete.append(i)
+    @holding_lock
+    def delete(self, user_id, record_ids):
+        found_ids = self.existing_ids(user_id, record_ids, live=True)
+        if not found_ids:
+            return set()
         
-        # Delete rows in reverse order
-        for row_index in sorted(rows_to_delete, reverse=True):
-            sheet.delete_rows(row_index)
-        
-        await query.edit_message_text(
-            "✅ Semua transaksi Anda telah dihapus.\n\n"
-            f"Total {len(rows_to_delete)} transaksi telah dihapus."
-        )
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE transactions SET deleted = ? WHERE id = ?",
+                [(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), record_id) for record_id in found_ids]
+            )
+            self.add_to_outbox('delete', {'user_id': str(user_id), 'ids': sorted(found_ids)})
+        return found_ids
     
-    elif action == "date":
-        if 'records_to_delete' not in context.user_data:
-            await query.edit_message_text("❌ Terjadi kesalahan. Silakan coba lagi.")
-            return
-        
-        records_to_delete = context.user_data['records_to_delete']
-        
-        # Find all rows to delete (in reverse order)
-        all_values = sheet.get_all_values()
-        header = all_values[0]  # First row is header
-        
-        # Find the row indices of the transactions to delete
-        rows_to_delete = []
-        for record_to_delete in records_to_delete:
-            for i, row in enumerate(all_values[1:], start=2):  # Start from 2 because row 1 is header
-                record = dict(zip(header, row))
-                if (str(record.get('User ID')) == str(user_id) and 
-                    record.get('Timestamp') == record_to_delete.get('Timestamp')):
-                    rows_to_delete.append(i)
-                    break
-        
-        # Delete rows in reverse order
-        for row_index in sorted(rows_to_delete, reverse=True):
-            sheet.delete_rows(row_index)
-        
-        # Clear delete state
-        context.user_data.pop('delete_state', None)
-        context.user_data.pop('start_date', None)
-        context.user_data.pop('records_to_delete', None)
+    @holding_lock
+    def restore(self, user_id, record_ids):
+        found_ids = self.existing_ids(user_id, record_ids) - self.existing_ids(user_id, record_ids, live=True)
+        if not found_ids:
+            return []
         
-        await query.edit_message_text(
-            "✅ Transaksi dalam rentang tanggal telah dihapus.\n\n"
-            f"Total {len(rows_to_delete)} transaksi telah dihapus."
-        )
-
-# Enhanced helper function to parse financial data using Gemini with improved income/expense detection
-async def parse_financial_data(text):
-    from datetime import datetime, timedelta
-    import locale
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE transactions SET deleted = '' WHERE id = ?", [(record_id,) for record_id in found_ids]
+            )
+            self.add_to_outbox('restore', {'user_id': str(user_id), 'ids': sorted(found_ids)})
+        return [record for record in self.query(user_id) if record['ID'] in found_ids]
     
-    # Set locale to Indonesian for better date parsing
-    try:
-        locale.setlocale(locale.LC_TIME, 'id_ID.UTF-7')  # For Linux/Mac
-    except:
-        try:
-            locale.setlocale(locale.LC_TIME, 'Indonesian')  # For Windows
-        except:
-            pass  # If setting locale fails, continue with default
+    @holding_lock
+    def compact(self, deleted_before):
+        with self.connection:
+            return self.connection.execute(
+                "DELETE FROM transactions WHERE deleted != '' AND deleted < ?", (deleted_before,)
+            ).rowcount
     
-    # Current date for reference
-    current_date = datetime.now()
+    @holding_lock
+    def query(self, user_id, start_date=None, end_date=None):
+        # Served by the (user_id, date) index
+        conditions = "user_id = ?"
+        params = [str(user_id)]
+        if start_date is not None:
+            conditions += " AND date >= ?"
+            params.append(start_date)
+        if end_date is not None:
+            conditions += " AND date <= ?"
+            params.append(end_date)
+        return self.select(conditions, params)
     
-    prompt = f"""
-    Extract financial information from this Indonesian text: "{text}"
-    Today's date is {current_date.strftime("%Y-%m-%d")} ({current_date.strftime("%A, %d %B %Y")}).
+    @holding_lock
+    def expense_totals(self, user_id, start_date=None, end_date=None):
+        where = "WHERE user_id = ? AND deleted = '' AND amount < 0"
+        params = [str(user_id)]
+        if start_date is not None:
+            where += " AND date >= ?"
+            params.append(start_date)
+        if end_date is not None:
+            where += " AND date <= ?"
+            params.append(end_date)
+        return dict(self.connection.execute(
+            f"SELECT category, -SUM(amount) FROM transactions {where} GROUP BY category", params
+        ))
     
-    Return a JSON object with these fields:
-    - amount: the monetary amount (numeric value only, without currency symbols)
-    - category: the spending/income category
-    - description: brief description of the transaction
-    - transaction_type: "income" if this is money received, or "expense" if this is money spent
-    - date: the date of the transaction in YYYY-MM-DD format
-    - time_context: any time-related information found in the text (e.g., "yesterday", "last Monday", "2 days ago")
+    @holding_lock
+    def existing_ids(self, user_id, record_ids, live=False):
+        record_ids = list(record_ids)
+        found_ids = set()
+        live_condition = " AND deleted = ''" if live else ""
+        # Stay below SQLite's limit on bound parameters
+        for i in range(0, len(record_ids), 500):
+            chunk = record_ids[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            found_ids.update(row[0] for row in self.connection.execute(
+                f"SELECT id FROM transactions WHERE user_id = ? AND id IN ({placeholders}){live_condition}",
+                [str(user_id)] + chunk
+            ))
+        return found_ids
     
-    For the date field, analyze time expressions carefully:
+    @holding_lock
+    def update_categories(self, changes):
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE transactions SET category = ? WHERE id = ?",
+                [(category, record_id) for record_id, category in changes.items()]
+            )
+            self.add_to_outbox('categories', changes)
     
-    1. Specific dates:
-       - "5 Mei 2023", "05/05/2023", "5 May 2023" → use that exact date
-       - "5 Mei", "05/05" → use that date in the current year
+    @holding_lock
+    def pending_mirror(self, limit):
+        """Return the oldest outbox entries as (seq, op, payload)."""
+        return [
+            (seq, op, json.loads(payload)) for seq, op, payload in self.connection.execute(
+                "SELECT seq, op, payload FROM mirror_outbox ORDER BY seq LIMIT ?", (limit,)
+            )
+        ]
     
-    2. Relative days:
-       - "kemarin", "yesterday" → use yesterday's date ({(current_date - timedelta(days=1)).strftime("%Y-%m-%d")})
-       - "hari ini", "today", "sekarang" → use today's date ({current_date.strftime("%Y-%m-%d")})
-       - "besok", "tomorrow" → use tomorrow's date ({(current_date + timedelta(days=1)).strftime("%Y-%m-%d")})
-       - "lusa", "day after tomorrow" → use the day after tomorrow ({(current_date + timedelta(days=2)).strftime("%Y-%m-%d")})
-       - "2 hari yang lalu", "2 days ago" → subtract the specified number of days
-       - "minggu lalu", "last week" → subtract 7 days
-       - "bulan lalu", "last month" → use the same day in the previous month
+    @holding_lock
+    def ack_mirror(self, last_seq):
+        with self.connection:
+            self.connection.execute("DELETE FROM mirror_outbox WHERE seq <= ?", (last_seq,))
+
+def create_sheets_storage():
+    if SHEETS_TENANCY == 'worksheet':
+        return TenantSheetsStorage(WORKSHEET_POOL_SIZE)
+    return SheetsStorage()
+
+def create_storage():
+    """Build the configured ledger backend and the optional sheet replica."""
+    if STORAGE_BACKEND == 'sqlite':
+        primary = SqliteStorage(SQLITE_PATH, mirror=SHEETS_MIRROR)
+        return primary, (create_sheets_storage() if SHEETS_MIRROR else None)
     
-     3. Day names:
-       - "Senin", "Monday" → use the date of the most recent Monday
-       - "Senin lalu", "last Monday" → use the date of the previous Monday (not today if today is Monday)
-       - "Senin depan", "next Monday" → use the date of the next Monday (not today if today is Monday)
+    return create_sheets_storage(), None
+
+# Opened by open_storage() from main(): chart workers are spawned processes
+# that re-run this module's top level, and must not connect to Google Sheets
+storage, sheets_replica = None, None
+sheet_synchronizer = None
+
+def new_transaction_id():
+    return uuid.uuid4().hex[:12]
+
+# Canonical categories and the labels Gemini or users commonly use for them
+CANONICAL_CATEGORIES = {
+    "Gaji": ["gaji", "salary", "upah", "payroll", "penghasilan"],
+    "Bonus": ["bonus", "thr", "komisi", "insentif"],
+    "Investasi": ["investasi", "investment", "dividen", "bunga", "saham", "reksadana"],
+    "Hadiah": ["hadiah", "gift", "kado", "warisan", "pemberian"],
+    "Penjualan": ["penjualan", "jualan", "sales"],
+    "Bisnis": ["bisnis", "usaha", "business"],
+    "Makanan": ["makanan", "makan", "food", "minuman", "makanan & minuman", "makanan dan minuman",
+                "food & beverage", "kuliner", "jajan", "snack", "kopi", "restoran"],
+    "Transportasi": ["transportasi", "transport", "transportation", "bensin", "bbm", "ojek",
+                     "ojol", "parkir", "tol", "taksi"],
+    "Belanja": ["belanja", "shopping", "groceries", "belanja bulanan", "kebutuhan rumah"],
+    "Hiburan": ["hiburan", "entertainment", "rekreasi", "liburan", "langganan", "streaming"],
+    "Tagihan": ["tagihan", "bills", "utilitas", "utilities", "listrik", "air", "internet",
+                "pulsa", "sewa", "cicilan", "iuran"],
+    "Kesehatan": ["kesehatan", "health", "obat", "dokter", "medis", "apotek"],
+    "Pendidikan": ["pendidikan", "education", "sekolah", "kursus", "buku", "kuliah"],
+    "Lainnya": ["lainnya", "lain-lain", "lain lain", "other", "others", "misc", "umum"],
+}
+
+# Alias -> canonical name; extended at runtime by merges made with /kategori
+category_aliases = {
+    alias: canonical
+    for canonical, aliases in CANONICAL_CATEGORIES.items()
+    for alias in aliases + [canonical.lower()]
+}
+category_aliases = {alias: sys.intern(canonical) for alias, canonical in category_aliases.items()}
+
+# Words joining two names of the same category, as in "makan dan jajan"
+LABEL_CONNECTORS = {"dan", "and"}
+
+@functools.lru_cache(maxsize=4096)
+def canonicalize_category(label):
+    """Map a free-form category label to its canonical, interned name.
     
-    4. Month references:
-       - "awal bulan", "beginning of the month" → use the 1st day of the current month
-       - "akhir bulan", "end of the month" → use the last day of the current month
-       - "pertengahan bulan", "middle of the month" → use the 15th day of the current month
-       - "awal bulan lalu", "beginning of last month" → use the 1st day of the previous month
+    Exact aliases win, then labels whose words all are aliases of the same
+    category, then the closest alias by fuzzy matching. Labels only partly
+    made of alias words ("air mineral") become Lainnya; unknown labels are
+    kept in title case.
+    """
+    normalized = " ".join(str(label or '').lower().split())
+    if not normalized:
+        return "Lainnya"
     
-    If no date is mentioned, use today's date ({current_date.strftime("%Y-%m-%d")}).
+    if normalized in category_aliases:
+        return category_aliases[normalized]
     
-    For transaction_type, analyze the context carefully using these rules:
+    word_categories = {
+        category_aliases.get(word) for word in tokenize(normalized) if word not in LABEL_CONNECTORS
+    }
+    if len(word_categories) == 1 and None not in word_categories:
+        return word_categories.pop()
     
-    INCOME indicators (set transaction_type to "income"):
-    - Words about receiving money: "terima", "dapat", "pemasukan", "masuk", "diterima"
-    - Income sources: "gaji", "bonus", "komisi", "dividen", "bunga", "hadiah", "warisan", "penjualan", "refund", "kembalian", "cashback"
-    - Phrases like: "dibayar oleh", "transfer dari", "kiriman dari", "diberi", "dikasih"
+    close_matches = difflib.get_close_matches(normalized, category_aliases.keys(), n=1, cutoff=0.8)
+    if close_matches:
+        return category_aliases[close_matches[0]]
     
-    EXPENSE indicators (set transaction_type to "expense"):
-    - Words about spending: "beli", "bayar", "belanja", "pengeluaran", "keluar", "dibayar"
-    - Purchase verbs: "membeli", "memesan", "berlangganan", "sewa", "booking"
-    - Expense categories: "makanan", "transportasi", "bensin", "pulsa", "tagihan", "biaya", "iuran"
-    - Phrases like: "dibayarkan untuk", "transfer ke", "kirim ke"
+    if word_categories - {None}:
+        return "Lainnya"
+    return sys.intern(normalized.title())
+
+def add_category_aliases(aliases):
+    """Register extra alias -> canonical mappings and reset the matcher cache."""
+    category_aliases.update(aliases)
+    canonicalize_category.cache_clear()
+
+def build_transaction_row(user_id, date, amount, category, description):
+    """Build a sheet row in SHEET_HEADER order for a new transaction."""
+    return [
+        date,
+        amount,
+        canonicalize_category(category),
+        description,
+        user_id,
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        new_transaction_id(),
+        ''
+    ]
+
+def history_key(record):
+    """Sort key of a record in the history: timestamp digits, then ID."""
+    return (re.sub(r'\D', '', str(record.get('Timestamp', ''))), str(record['ID']))
+
+def tokenize(text):
+    return re.findall(r'\w+', str(text).lower())
+
+class TransactionIndex:
+    """In-memory copy of the ledger with an inverted token index per user.
     
-    If the text doesn't clearly indicate transaction type, look at the context:
-    - If it mentions purchasing an item or service, it's likely an expense
-    - If it mentions receiving money or payment, it's likely income
+    Records are kept as dicts keyed by SHEET_HEADER and looked up by their ID.
+    Tokens of each description and category map to the IDs containing them,
+    and a sorted token list per user allows prefix matching with bisect.
+    """
     
-    If still unclear, default to "expense".
+    def __init__(self):
+        self.loaded = False
+        self.records = {}        # ID -> record
+        self.user_ids = {}       # user ID -> {record ID: None}, in sheet order
+        self.tokens = {}         # user ID -> {token: set of record IDs}
+        self.sorted_tokens = {}  # user ID -> sorted list of tokens
+        self.sorted_keys = {}    # user ID -> sorted list of (timestamp digits, record ID)
     
-    For category, try to identify specific categories like:
-    - Income categories: "Gaji", "Bonus", "Investasi", "Hadiah", "Penjualan", "Bisnis"
-    - Expense categories: "Makanan", "Transportasi", "Belanja", "Hiburan", "Tagihan", "Kesehatan", "Pendidikan"
+    def load(self, records=None):
+        """Read the whole ledger once, or index records already read from it."""
+        if records is None:
+            records = storage.load_records()
+        
+        self.records.clear()
+        self.user_ids.clear()
+        self.tokens.clear()
+        self.sorted_tokens.clear()
+        self.sorted_keys.clear()
+        
+        for record in records:
+            self.add(record)
+        
+        self.loaded = True
     
-    If any field is unclear, set it to null.
-    """
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
     
-    response = model.generate_content(prompt)
-    try:
-        # Extract JSON from response
-        response_text = response.text
-        if "```json" in response_text:
-            json_str = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            json_str = response_text.split("```")[1].strip()
-        else:
-            json_str = response_text.strip()
+    def add(self, record):
+        record_id = str(record['ID'])
+        user_key = str(record.get('User ID'))
+        self.records[record_id] = record
+        self.user_ids.setdefault(user_key, {})[record_id] = None
+        bisect.insort(self.sorted_keys.setdefault(user_key, []), history_key(record))
         
-        data = json.loads(json_str)
-        
-        # Process the date field - if Gemini couldn't determine it, try to parse it ourselves
-        if not data.get('date') and data.get('time_context'):
-            time_context = data.get('time_context').lower()
+        user_tokens = self.tokens.setdefault(user_key, {})
+        sorted_tokens = self.sorted_tokens.setdefault(user_key, [])
+        for token in set(tokenize(record.get('Description', '')) + tokenize(record.get('Category', ''))):
+            if token not in user_tokens:
+                user_tokens[token] = set()
+                bisect.insort(sorted_tokens, token)
+            user_tokens[token].add(record_id)
+    
+    def add_rows(self, rows):
+        for row in rows:
+            self.add(dict(zip(SHEET_HEADER, row)))
+    
+    def remove(self, record_ids):
+        for record_id in record_ids:
+            record = self.records.pop(str(record_id), None)
+            if record is None:
+                continue
             
-            # Handle common time expressions
-            if any(word in time_context for word in ["kemarin", "yesterday"]):
-                data['date'] = (current_date - timedelta(days=1)).strftime("%Y-%m-%d")
-            elif any(word in time_context for word in ["besok", "tomorrow"]):
-                data['date'] = (current_date + timedelta(days=1)).strftime("%Y-%m-%d")
-            elif any(word in time_context for word in ["lusa", "day after tomorrow"]):
-                data['date'] = (current_date + timedelta(days=2)).strftime("%Y-%m-%d")
-            elif "hari yang lalu" in time_context or "days ago" in time_context:
-                try:
-                    # Extract number of days
-                    import re
-                    days_ago = int(re.search(r'(\d+)', time_context).group(1))
-                    data['date'] = (current_date - timedelta(days=days_ago)).strftime("%Y-%m-%d")
-                except:
-                    pass
-            elif "minggu lalu" in time_context or "last week" in time_context:
-                data['date'] = (current_date - timedelta(days=7)).strftime("%Y-%m-%d")
+            user_key = str(record.get('User ID'))
+            self.user_ids.get(user_key, {}).pop(str(record_id), None)
             
-            # Handle day names
-            day_names = {
-                "senin": 0, "monday": 0,
-                "selasa": 1, "tuesday": 1,
-                "rabu": 2, "wednesday": 2,
-                "kamis": 3, "thursday": 3,
-                "jumat": 4, "friday": 4,
-                "sabtu": 5, "saturday": 5,
-                "minggu": 6, "sunday": 6
-            }
+            sorted_keys = self.sorted_keys.get(user_key, [])
+            position = bisect.bisect_left(sorted_keys, history_key(record))
+            if position < len(sorted_keys) and sorted_keys[position] == history_key(record):
+                del sorted_keys[position]
             
-            for day_name, day_num in day_names.items():
-                if day_name in time_context:
-                    # Calculate days until the previous occurrence of this day
-                    days_diff = (current_date.weekday() - day_num) % 7
-                    if days_diff == 0:
-                        # If it's the same day and "last" is mentioned, go back a week
-                        if "lalu" in time_context or "last" in time_context:
-                            days_diff = 7
-                    
-                    # If "next" is mentioned, calculate days until next occurrence
-                    if "depan" in time_context or "next" in time_context:
-                        days_diff = (day_num - current_date.weekday()) % 7
-                        if days_diff == 0:
-                            days_diff = 7
-                        data['date'] = (current_date + timedelta(days=days_diff)).strftime("%Y-%m-%d")
-                    else:
-                        data['date'] = (current_date - timedelta(days=days_diff)).strftime("%Y-%m-%d")
-                    
-                    break
-        
-        # If still no date, use today's date
-        if not data.get('date'):
-            data['date'] = current_date.strftime("%Y-%m-%d")
-        
-        # Additional processing for amount and transaction type
-        if data.get('amount') is not None:
-            # Convert amount to float and ensure proper sign
-            amount = abs(float(data.get('amount')))
+            user_tokens = self.tokens.get(user_key, {})
+            sorted_tokens = self.sorted_tokens.get(user_key, [])
+            for token in set(tokenize(record.get('Description', '')) + tokenize(record.get('Category', ''))):
+                ids = user_tokens.get(token)
+                if ids is None:
+                    continue
+                ids.discard(str(record_id))
+                if not ids:
+                    del user_tokens[token]
+                    del sorted_tokens[bisect.bisect_left(sorted_tokens, token)]
+    
+    def user_records(self, user_id):
+        """Return the user's records in sheet order."""
+        return [self.records[record_id] for record_id in self.user_ids.get(str(user_id), {})]
+    
+    def page(self, user_id, size, before=None, after=None):
+        """Return one page of the user's records, newest first.
+        
+        `before` and `after` are history keys of the page boundaries: the page
+        holds records strictly older than `before` or strictly newer than
+        `after`. Only the page's own slice is read. Also returns whether older
+        and newer records exist.
+        """
+        keys = self.sorted_keys.get(str(user_id), [])
+        if after is not None:
+            start = bisect.bisect_right(keys, after)
+            end = min(start + size, len(keys))
+        else:
+            end = bisect.bisect_left(keys, before) if before is not None else len(keys)
+            start = max(end - size, 0)
+        
+        records = [self.records[record_id] for _, record_id in reversed(keys[start:end])]
+        return records, start > 0, end < len(keys)
+    
+    def search(self, user_id, query):
+        """Return the user's records matching every query word (as a prefix), newest first."""
+        user_tokens = self.tokens.get(str(user_id), {})
+        sorted_tokens = self.sorted_tokens.get(str(user_id), [])
+        
+        matches = None
+        for word in tokenize(query):
+            word_matches = set()
+            position = bisect.bisect_left(sorted_tokens, word)
+            while position < len(sorted_tokens) and sorted_tokens[position].startswith(word):
+                word_matches |= user_tokens[sorted_tokens[position]]
+                position += 1
             
-            # Apply sign based on transaction type
-            if data.get('transaction_type') == 'expense':
-                amount = -amount
-                
-            data['amount'] = amount
+            matches = word_matches if matches is None else matches & word_matches
+            if not matches:
+                return []
         
-        # Remove time_context from final data as it's just a helper field
-        data.pop('time_context', None)
+        if matches is None:
+            return []
         
-        return data
-    except Exception as e:
-        logger.error(f"Error parsing Gemini response: {e}")
-        # If parsing fails, return a basic structure with today's date
-        return {
-            "amount": None, 
-            "category": None, 
-            "description": None, 
-            "transaction_type": None,
-            "date": current_date.strftime("%Y-%m-%d")
-        }
+        records = [self.records[record_id] for record_id in matches]
+        return sorted(records, key=lambda record: str(record.get('Timestamp', '')), reverse=True)
 
-def parse_date_from_text(text):
-    """Attempt to extract a date from text using various methods."""
-    from datetime import datetime, timedelta
-    import re
+transaction_index = TransactionIndex()
+
+def cell_text(value):
+    """Render a cell value the way the sheet displays it, for comparisons."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class SheetSynchronizer:
+    """Bring the in-memory index up to date with edits made directly in the sheet.
     
-    # Current date for reference
-    current_date = datetime.now()
+    Each run first compares the spreadsheet's Drive modified time. Only when
+    it changed are the Date, ID and Deleted columns read. Tombstoned rows count
+    as deleted. Rows with unknown or missing
+    IDs, and a rotating set of SYNC_SCRUB_BLOCKS blocks (to catch edits of
+    existing values), are then fetched with one batched ranged read and patched
+    into the index. Rows whose ID disappeared are dropped. No full reload is
+    needed.
+    """
     
-    # Try to find date patterns in the text
-    text = text.lower()
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.last_modified = None
+        self.scrub_block = 0
     
-    # Check for "yesterday", "today", "tomorrow"
-    if "kemarin" in text or "yesterday" in text:
-        return (current_date - timedelta(days=1)).strftime("%Y-%m-%d")
-    elif "hari ini" in text or "today" in text:
-        return current_date.strftime("%Y-%m-%d")
-    elif "besok" in text or "tomorrow" in text:
-        return (current_date + timedelta(days=1)).strftime("%Y-%m-%d")
-    elif "lusa" in text or "day after tomorrow" in text:
-        return (current_date + timedelta(days=2)).strftime("%Y-%m-%d")
-    
-    # Check for "X days ago"
-    days_ago_match = re.search(r'(\d+)\s+hari\s+(?:yang\s+)?lalu', text) or re.search(r'(\d+)\s+days\s+ago', text)
-    if days_ago_match:
-        days = int(days_ago_match.group(1))
-        return (current_date - timedelta(days=days)).strftime("%Y-%m-%d")
-    
-    # Check for date formats like DD/MM/YYYY or DD-MM-YYYY
-    date_patterns = [
-        r'(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})',  # DD/MM/YYYY or DD-MM-YYYY or DD.MM.YYYY
-        r'(\d{4})[/.-](\d{1,2})[/.-](\d{1,2})'   # YYYY/MM/DD or YYYY-MM-DD or YYYY.MM.DD
-    ]
+    def get_modified_time(self):
+        try:
+            return self.sheets.spreadsheet.get_lastUpdateTime()
+        except Exception as e:
+            logger.warning(f"Could not read spreadsheet modified time: {e}")
+            return None
     
-    for pattern in date_patterns:
-        match = re.search(pattern, text)
-        if match:
-            groups = match.groups()
-            if len(groups[0]) == 4:  # YYYY/MM/DD format
-                year, month, day = groups
-            else:  # DD/MM/YYYY format
-                day, month, year = groups
-            
-            try:
-                # Validate and format the date
-                date_obj = datetime(int(year), int(month), int(day))
-                return date_obj.strftime("%Y-%m-%d")
-            except ValueError:
-                # Invalid date, continue to next pattern
-                continue
+    def read_columns(self):
+        """Blocking: read the Date, ID and Deleted columns if the sheet changed.
+        
+        Returns (modified time, ID per data row, tombstoned row numbers), or
+        None when the spreadsheet was not modified since the last run.
+        """
+        modified = self.get_modified_time()
+        if modified is not None and modified == self.last_modified:
+            return None
+        
+        id_letter, deleted_letter = column_letter(ID_COLUMN), column_letter(DELETED_COLUMN)
+        date_values, id_values, deleted_values = self.sheets.sheet.batch_get([
+            "A2:A", f"{id_letter}2:{id_letter}", f"{deleted_letter}2:{deleted_letter}"
+        ])
+        row_count = max(len(date_values), len(id_values), len(deleted_values))
+        remote_ids = [row[0] if row else '' for row in id_values]
+        remote_ids += [''] * (row_count - len(remote_ids))
+        deleted_rows = {row_number for row_number, row in enumerate(deleted_values, start=2) if row and row[0]}
+        
+        # Tombstoned rows are skipped until compaction removes them
+        remote_ids = [
+            '' if row_number in deleted_rows else record_id
+            for row_number, record_id in enumerate(remote_ids, start=2)
+        ]
+        return modified, remote_ids, deleted_rows
     
-    # If no date found, return today's date
-    return current_date.strftime("%Y-%m-%d")
+    def write_ids(self, missing_ids, generation):
+        """Blocking: write assigned IDs unless compaction moved rows since they were read.
+        
+        Returns whether the IDs were written.
+        """
+        with sheet_rows.lock:
+            if sheet_rows.generation != generation:
+                return False
+            self.sheets.sheet.batch_update(missing_ids)
+            return True
     
-# Function to parse multiple transactions from multi-line input
-async def parse_multiple_transactions(text):
-    """Parse multiple transactions from text separated by newlines."""
-    # Split the text by newlines and filter out empty lines
+    async def run(self):
+        """Synchronize once and return the user IDs whose rows changed.
+        
+        Sheet reads and writes run in worker threads; the index is patched on
+        the event loop in between. Handlers may change the index while a read
+        is in flight, so only records the index held when the read started are
+        dropped, and records deleted locally meanwhile are not added back.
+        """
+        transaction_index.ensure_loaded()
+        known_ids = set(transaction_index.records)
+        generation = sheet_rows.generation
+        
+        columns = await asyncio.to_thread(self.read_columns)
+        if columns is None:
+            return set()
+        modified, remote_ids, deleted_rows = columns
+        row_count = len(remote_ids)
+        
+        # Rows the index doesn't know yet: new, or typed in without an ID
+        rows_to_fetch = {
+            row_number for row_number, record_id in enumerate(remote_ids, start=2)
+            if record_id not in transaction_index.records and row_number not in deleted_rows
+        }
+        
+        # A few blocks are compared on every run to pick up edited values
+        block_count = max((row_count + SYNC_BLOCK_ROWS - 1) // SYNC_BLOCK_ROWS, 1)
+        for _ in range(min(SYNC_SCRUB_BLOCKS, block_count)):
+            first_row = 2 + self.scrub_block * SYNC_BLOCK_ROWS
+            rows_to_fetch.update(
+                row_number for row_number in range(first_row, min(first_row + SYNC_BLOCK_ROWS, row_count + 2))
+                if row_number not in deleted_rows
+            )
+            self.scrub_block = (self.scrub_block + 1) % block_count
+        
+        changed_users = set()
+        
+        # Drop rows deleted in the sheet
+        remote_id_set = set(remote_ids)
+        removed_ids = [
+            record_id for record_id in known_ids
+            if record_id not in remote_id_set and record_id in transaction_index.records
+        ]
+        for record_id in removed_ids:
+            changed_users.add(str(transaction_index.records[record_id].get('User ID')))
+        transaction_index.remove(removed_ids)
+        
+        rows = await asyncio.to_thread(self.sheets.read_rows, rows_to_fetch)
+        
+        missing_ids = []
+        for row_number, row in rows:
+            if not any(row):
+                continue
+            
+            record = dict(zip(SHEET_HEADER, list(row) + [''] * (len(SHEET_HEADER) - len(row))))
+            if record['Deleted']:
+                continue
+            if record['ID'] in known_ids and record['ID'] not in transaction_index.records:
+                # Deleted by a handler while the rows were being read
+                continue
+            if not record['ID']:
+                record['ID'] = new_transaction_id()
+                missing_ids.append({
+                    'range': gspread.utils.rowcol_to_a1(row_number, ID_COLUMN),
+                    'values': [[record['ID']]]
+                })
+            
+            existing = transaction_index.records.get(record['ID'])
+            if existing is not None:
+                if all(cell_text(existing.get(key, '')) == cell_text(record[key]) for key in SHEET_HEADER):
+                    continue
+                changed_users.add(str(existing.get('User ID')))
+                transaction_index.remove([record['ID']])
+            
+            transaction_index.add(record)
+            changed_users.add(str(record.get('User ID')))
+        
+        if missing_ids and not await asyncio.to_thread(self.write_ids, missing_ids, generation):
+            # The rows moved; drop the unsaved IDs and assign new ones on the next run
+            transaction_index.remove([entry['values'][0][0] for entry in missing_ids])
+            return changed_users
+        
+        self.last_modified = modified
+        return changed_users
+
+def open_storage():
+    """Open the configured ledger and, for a sheet ledger, its synchronizer."""
+    global storage, sheets_replica, sheet_synchronizer
+    storage, sheets_replica = create_storage()
+    # Out-of-band edits only matter when the sheet is the primary ledger
+    sheet_synchronizer = SheetSynchronizer(storage) if isinstance(storage, SheetsStorage) else None
+
+class Session:
+    """Short-lived conversation state of one user, kept in user_data['session'].
+    
+    Pending deletions hold record IDs instead of full records, and the whole
+    state expires after SESSION_TTL seconds of inactivity. Settings such as
+    budgets stay directly in user_data.
+    """
+    
+    __slots__ = (
+        'updated_at',
+        'pending_transaction',            # parsed transaction awaiting confirm_yes, with its idempotency key
+        'pending_multiple_transactions',  # parsed lines awaiting confirm_all_yes
+        'pending_multiple_key',           # idempotency key of those lines
+        'pending_message', 'detected_date',  # text that could not be parsed
+        'transaction_type', 'description', 'date', 'amount',  # manual entry
+        'manual_key',                     # idempotency key of the manual entry's category buttons
+        'delete_state', 'start_date', 'record_ids_to_delete',  # delete by date range
+        'search_query',
+        'last_deleted_ids',  # IDs of the last deletion, restored by /batal
+    )
+    
+    def __init__(self):
+        self.clear()
+    
+    def __setstate__(self, state):
+        # Sessions pickled by older versions lack the newer slots
+        self.clear()
+        _, slots = state
+        for slot, value in slots.items():
+            if slot in self.__slots__:
+                setattr(self, slot, value)
+    
+    def clear(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self.updated_at = time.time()
+    
+    def clear_manual_entry(self):
+        self.pending_message = self.detected_date = None
+        self.transaction_type = self.description = self.date = self.amount = self.manual_key = None
+    
+    def clear_delete_range(self):
+        self.delete_state = self.start_date = self.record_ids_to_delete = None
+    
+    def expired(self, now=None):
+        return (now or time.time()) - self.updated_at > SESSION_TTL
+
+# Flow keys stored directly in user_data by older versions
+LEGACY_FLOW_KEYS = (
+    'pending_transaction', 'pending_multiple_transactions', 'recent_transactions',
+    'records_to_delete', 'delete_state', 'start_date', 'pending_message', 'detected_date',
+    'transaction_type', 'description', 'date', 'amount', 'search_query'
+)
+
+class CommittedKeys:
+    """Bounded set of idempotency keys whose transactions have been written.
+    
+    Every confirmation keyboard carries a fresh key in its callback data. A
+    repeated tap or a redelivered callback finds its key here and is ignored
+    instead of appending the rows again.
+    """
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.keys = OrderedDict()
+    
+    def __contains__(self, key):
+        return key in self.keys
+    
+    def add(self, key):
+        self.keys[key] = None
+        self.keys.move_to_end(key)
+        while len(self.keys) > self.capacity:
+            self.keys.popitem(last=False)
+
+committed_keys = CommittedKeys(COMMITTED_KEYS_CAPACITY)
+
+def new_idempotency_key():
+    return uuid.uuid4().hex[:16]
+
+def callback_key(data, prefix):
+    """Return the idempotency key after `prefix` in callback data, or None for keyless buttons."""
+    key = data[len(prefix):].lstrip('_')
+    return key or None
+
+def get_session(user_data):
+    """Return the user's session, starting a fresh one if the last has expired."""
+    session = user_data.get('session')
+    if session is None or session.expired():
+        session = Session()
+        user_data['session'] = session
+    session.updated_at = time.time()
+    return session
+
+async def expire_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job: drop conversation state that has been idle longer than SESSION_TTL."""
+    now = time.time()
+    expired_count = 0
+    changed_user_ids = []
+    for user_id, user_data in list(context.application.user_data.items()):
+        changed = False
+        for key in LEGACY_FLOW_KEYS:
+            changed = user_data.pop(key, None) is not None or changed
+        
+        session = user_data.get('session')
+        if session is not None and session.expired(now):
+            del user_data['session']
+            expired_count += 1
+            changed = True
+        
+        if changed:
+            changed_user_ids.append(user_id)
+    
+    # PTB only persists user_data touched by an update; idle users must be marked
+    context.application.mark_data_for_update_persistence(user_ids=changed_user_ids)
+    
+    if expired_count:
+        logger.info(f"Expired {expired_count} idle sessions")
+
+def is_authorized(user_id):
+    """Check if the user is authorized to use the bot."""
+    return str(user_id) in AUTHORIZED_USER_IDS
+
+def is_admin(user_id):
+    """Check if the user may run admin commands."""
+    return str(user_id) in ADMIN_USER_IDS
+
+# One lock per active user; entries disappear once no handler holds them
+user_locks = weakref.WeakValueDictionary()
+
+def serialize_per_user(handler):
+    """Run a handler while holding the user's lock.
+    
+    Updates are processed concurrently, but handlers for the same user share
+    state in context.user_data and must run in order.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user is None:
+            return await handler(update, context)
+        
+        user_id = update.effective_user.id
+        lock = user_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            user_locks[user_id] = lock
+        
+        async with lock:
+            return await handler(update, context)
+    
+    return wrapper
+
+# Per-user ledger version, bumped whenever that user's rows are written
+ledger_versions = {}
+
+def get_ledger_version(user_id):
+    return ledger_versions.get(str(user_id), 0)
+
+class RenderedCache:
+    """Per-user cache of rendered output (report text, chart file IDs).
+    
+    An entry is valid only while the user's ledger version is unchanged and
+    for at most `ttl` seconds, which bounds staleness after edits made
+    directly in the Google Sheet.
+    """
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}  # (user_id, kind) -> (version, rendered_at, value)
+    
+    def get(self, user_id, kind):
+        entry = self.entries.get((str(user_id), kind))
+        if entry is None:
+            return None
+        
+        version, rendered_at, value = entry
+        if version != get_ledger_version(user_id) or time.monotonic() - rendered_at > self.ttl:
+            del self.entries[(str(user_id), kind)]
+            return None
+        
+        return value
+    
+    def put(self, user_id, kind, value, version):
+        # Skip results computed from data that changed while rendering
+        if version == get_ledger_version(user_id):
+            self.entries[(str(user_id), kind)] = (version, time.monotonic(), value)
+
+rendered_cache = RenderedCache(REPORT_CACHE_TTL)
+
+def invalidate_user_data(user_id):
+    """Mark everything cached for a user as stale after their rows change."""
+    ledger_versions[str(user_id)] = get_ledger_version(user_id) + 1
+
+class DuplicateIndex:
+    """Rolling per-user index of content hashes of recently recorded transactions.
+    
+    A hash covers the date, amount and normalized description. Entries are
+    evicted once they are older than `window` seconds, so memory is bounded
+    by the recent write rate rather than by the size of the ledger.
+    """
+    
+    def __init__(self, window):
+        self.window = window
+        self.order = {}   # user ID -> deque of (recorded_at, hash), oldest first
+        self.hashes = {}  # user ID -> {hash: deque of recorded_at}
+    
+    @staticmethod
+    def content_hash(date, amount, description):
+        try:
+            amount = round(float(amount), 2)
+        except (TypeError, ValueError):
+            pass
+        return hash((str(date), amount, " ".join(tokenize(description))))
+    
+    def evict(self, user_key, now):
+        order = self.order.get(user_key)
+        if order is None:
+            return
+        
+        hashes = self.hashes[user_key]
+        while order and now - order[0][0] > self.window:
+            recorded_at, content_hash = order.popleft()
+            times = hashes.get(content_hash)
+            # Skip entries already taken out by remove()
+            if times and times[0] <= recorded_at:
+                times.popleft()
+            if not times:
+                hashes.pop(content_hash, None)
+        
+        if not order:
+            del self.order[user_key]
+            del self.hashes[user_key]
+    
+    def add(self, user_id, date, amount, description, recorded_at=None):
+        user_key = str(user_id)
+        recorded_at = time.time() if recorded_at is None else recorded_at
+        content_hash = self.content_hash(date, amount, description)
+        self.order.setdefault(user_key, deque()).append((recorded_at, content_hash))
+        self.hashes.setdefault(user_key, {}).setdefault(content_hash, deque()).append(recorded_at)
+    
+    def add_rows(self, rows):
+        for row in rows:
+            record = dict(zip(SHEET_HEADER, row))
+            self.add(record['User ID'], record['Date'], record['Amount'], record['Description'])
+    
+    def remove_records(self, records):
+        """Forget deleted transactions so re-entering them is not flagged."""
+        for record in records:
+            user_key = str(record.get('User ID'))
+            content_hash = self.content_hash(record.get('Date'), record.get('Amount'), record.get('Description'))
+            times = self.hashes.get(user_key, {}).get(content_hash)
+            if times:
+                times.pop()
+                if not times:
+                    del self.hashes[user_key][content_hash]
+    
+    def seed(self, records):
+        """Index the recent records of a freshly loaded ledger."""
+        now = time.time()
+        recent = []
+        for record in records:
+            try:
+                recorded_at = datetime.strptime(str(record.get('Timestamp')), "%Y-%m-%d %H:%M:%S").timestamp()
+            except ValueError:
+                continue
+            if now - recorded_at <= self.window:
+                recent.append((recorded_at, record))
+        
+        for recorded_at, record in sorted(recent, key=lambda item: item[0]):
+            self.add(record.get('User ID'), record.get('Date'), record.get('Amount'), record.get('Description'), recorded_at)
+    
+    def is_duplicate(self, user_id, date, amount, description):
+        user_key = str(user_id)
+        self.evict(user_key, time.time())
+        return self.content_hash(date, amount, description) in self.hashes.get(user_key, {})
+    
+    def prune(self):
+        now = time.time()
+        for user_key in list(self.order):
+            self.evict(user_key, now)
+
+duplicate_index = DuplicateIndex(DUPLICATE_WINDOW)
+
+async def prune_duplicate_index(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job: evict expired hashes of users who stopped writing."""
+    duplicate_index.prune()
+
+async def record_transactions(user_data, user_id, rows):
+    """Append rows for a user and update every local structure that tracks them.
+    
+    The ledger call runs in a worker thread; the in-memory structures are
+    updated on the event loop once it returns. Returns the budget warnings
+    triggered by the new rows.
+    """
+    await asyncio.to_thread(storage.append, rows)
+    
+    # Budgets first: missing totals are seeded from the index without these rows
+    budget_warnings = check_budgets(user_data, rows)
+    invalidate_user_data(user_id)
+    transaction_index.add_rows(rows)
+    duplicate_index.add_rows(rows)
+    return budget_warnings
+
+async def delete_transactions(user_data, user_id, records):
+    """Delete the given records of a user from the ledger, matched by ID.
+    
+    Rows are tombstoned rather than removed, so /batal can restore them until
+    compact_ledger runs. Returns the number of deleted rows.
+    """
+    transaction_index.ensure_loaded()
+    record_ids = {str(record['ID']) for record in records if record.get('ID')}
+    
+    if len(record_ids) < len(records):
+        # Rows added directly in the sheet get their ID when the index is reloaded
+        transaction_index.load(await asyncio.to_thread(storage.load_records))
+        timestamps = {record.get('Timestamp') for record in records if not record.get('ID')}
+        record_ids |= {
+            str(record['ID']) for record in transaction_index.user_records(user_id)
+            if record.get('Timestamp') in timestamps
+        }
+    
+    deleted_ids = await asyncio.to_thread(storage.delete, user_id, record_ids)
+    deleted_records = [
+        transaction_index.records[record_id] for record_id in deleted_ids
+        if record_id in transaction_index.records
+    ]
+    remove_from_month_totals(user_data, user_id, deleted_records)
+    duplicate_index.remove_records(deleted_records)
+    transaction_index.remove(deleted_ids)
+    invalidate_user_data(user_id)
+    
+    if deleted_ids:
+        get_session(user_data).last_deleted_ids = sorted(deleted_ids)
+    
+    return len(deleted_ids)
+
+async def restore_transactions(user_data, user_id, record_ids):
+    """Clear the tombstones of a user's deleted records and re-index them.
+    
+    Returns the number of restored rows.
+    """
+    restored_records = await asyncio.to_thread(storage.restore, user_id, set(record_ids))
+    
+    for record in restored_records:
+        try:
+            update_month_totals(
+                user_data, record.get('Date', ''), record.get('Amount', 0),
+                record.get('Category'), user_id=user_id
+            )
+        except (TypeError, ValueError):
+            pass
+        transaction_index.add(record)
+        duplicate_index.add(user_id, record.get('Date'), record.get('Amount'), record.get('Description'))
+    
+    invalidate_user_data(user_id)
+    return len(restored_records)
+
+async def undo_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    session = get_session(context.user_data)
+    if not session.last_deleted_ids:
+        await update.message.reply_text("❌ Tidak ada penghapusan yang dapat dibatalkan.")
+        return
+    
+    record_ids = session.last_deleted_ids
+    session.last_deleted_ids = None
+    
+    restored_count = await restore_transactions(context.user_data, user_id, record_ids)
+    if restored_count:
+        await update.message.reply_text(f"↩️ {restored_count} transaksi telah dipulihkan.")
+    else:
+        await update.message.reply_text("❌ Transaksi yang dihapus sudah tidak dapat dipulihkan.")
+
+async def compact_ledger(context: ContextTypes.DEFAULT_TYPE):
+    """Daily off-peak job: physically remove tombstoned rows in bulk.
+    
+    Rows deleted within the last SESSION_TTL seconds are kept so /batal can
+    still restore them.
+    """
+    deleted_before = (datetime.now() - timedelta(seconds=SESSION_TTL)).strftime("%Y-%m-%d %H:%M:%S")
+    for ledger in (storage, sheets_replica):
+        if ledger is None:
+            continue
+        try:
+            removed_count = await asyncio.to_thread(ledger.compact, deleted_before)
+            if removed_count:
+                logger.info(f"Compacted {removed_count} deleted rows from {type(ledger).__name__}")
+        except Exception as e:
+            logger.error(f"Error compacting the ledger: {e}")
+
+async def sheet_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    sheets = sheets_replica or storage
+    sheet_url = sheets.sheet_url(user_id)
+    if sheet_url is None:
+        await update.message.reply_text("❌ Data keuangan disimpan di database lokal, tidak ada Google Sheet.")
+        return
+    
+    user_name = update.effective_user.first_name
+    
+    # Create a message with the link
+    message = (
+        f"📊 *Link Google Sheet Keuangan Anda*\n\n"
+        f"Halo {user_name}, berikut adalah link untuk melihat data keuangan Anda:\n\n"
+        f"[Buka Google Sheet]({sheet_url})\n\n"
+        "Anda dapat melihat semua transaksi dan mengunduh data dalam format Excel/CSV."
+    )
+    
+    # Create button to open the link
+    keyboard = [[InlineKeyboardButton("Buka Google Sheet", url=sheet_url)]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        message, 
+        parse_mode='Markdown',
+        reply_markup=reply_markup,
+        disable_web_page_preview=True
+    )
+
+async def delete_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    user_name = update.effective_user.first_name
+    
+    # Create keyboard with deletion options
+    keyboard = [
+        [InlineKeyboardButton("Hapus Transaksi Terakhir", callback_data="delete_last")],
+        [InlineKeyboardButton("Hapus Transaksi Tertentu", callback_data="delete_specific")],
+        [InlineKeyboardButton("Hapus Berdasarkan Tanggal", callback_data="delete_date")],
+        [InlineKeyboardButton("Hapus Semua Data", callback_data="delete_all")],
+        [InlineKeyboardButton("❌ Batal", callback_data="delete_cancel")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        f"🗑️ *Hapus Data Keuangan*\n\n"
+        f"Halo {user_name}, pilih opsi penghapusan data:\n\n"
+        "⚠️ *Perhatian:* Penghapusan terakhir hanya dapat dibatalkan dengan /batal selama sesi Anda masih aktif.",
+        parse_mode='Markdown',
+        reply_markup=reply_markup
+    )
+    
+def track_message_for_deletion(user_data, message_id):
+    """Remember a message ID for the next coalesced auto-deletion run."""
+    now = time.time()
+    tracked = [
+        entry for entry in user_data.get('messages_to_delete', [])
+        # Entries stored before timestamps were tracked are kept for one more attempt
+        if isinstance(entry, int) or now - entry[1] < MESSAGE_DELETE_WINDOW
+    ]
+    tracked.append((message_id, now))
+    
+    # Keep only the newest IDs so persisted user data stays bounded
+    user_data['messages_to_delete'] = tracked[-MAX_TRACKED_MESSAGES:]
+
+def schedule_message_deletion(context: ContextTypes.DEFAULT_TYPE, chat_id, user_id):
+    """Schedule a single pending deletion job per chat."""
+    job_name = f"delete_messages_{chat_id}"
+    
+    # A pending job will pick up every message tracked before it runs
+    if context.job_queue.get_jobs_by_name(job_name):
+        return
+    
+    context.job_queue.run_once(
+        delete_transaction_messages,
+        DELETE_MESSAGES_DELAY,
+        data={'chat_id': chat_id, 'user_id': user_id},
+        name=job_name
+    )
+
+async def delete_transaction_messages(context: ContextTypes.DEFAULT_TYPE):
+    """Delete transaction-related messages after a delay."""
+    job_data = context.job.data
+    chat_id = job_data['chat_id']
+    user_id = job_data['user_id']
+    
+    # Get the user data
+    user_data = context.application.user_data.get(user_id, {})
+    
+    # Check if message deletion is enabled
+    if not user_data.get('delete_messages', True):
+        return
+    
+    # Take the tracked IDs and clear the list before awaiting any API call
+    messages_to_delete = user_data.get('messages_to_delete', [])
+    user_data['messages_to_delete'] = []
+    
+    # Telegram only allows deleting messages younger than 48 hours
+    now = time.time()
+    message_ids = [
+        entry if isinstance(entry, int) else entry[0]
+        for entry in messages_to_delete
+        if isinstance(entry, int) or now - entry[1] < MESSAGE_DELETE_WINDOW
+    ]
+    
+    if not message_ids:
+        return
+    
+    # Delete in bulk, up to 100 messages per request
+    for i in range(0, len(message_ids), DELETE_MESSAGES_BATCH_SIZE):
+        batch = message_ids[i:i + DELETE_MESSAGES_BATCH_SIZE]
+        try:
+            await context.bot.delete_messages(chat_id=chat_id, message_ids=batch)
+        except Exception as e:
+            logger.error(f"Error deleting messages {batch}: {e}")
+
+async def toggle_delete_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    # Toggle the setting
+    if 'delete_messages' not in context.user_data:
+        context.user_data['delete_messages'] = True
+    else:
+        context.user_data['delete_messages'] = not context.user_data['delete_messages']
+    
+    # Inform the user of the current setting
+    status = "AKTIF" if context.user_data['delete_messages'] else "NONAKTIF"
+    
+    await update.message.reply_text(
+        f"🗑️ Penghapusan pesan otomatis: {status}\n\n"
+        f"{'Pesan akan dihapus otomatis setelah transaksi dicatat.' if context.user_data['delete_messages'] else 'Pesan tidak akan dihapus otomatis.'}"
+    )
+
+def format_transaction_label(transaction):
+    """Format a sheet record as a short inline button label."""
+    amount = float(transaction.get('Amount', 0) or 0)
+    transaction_type = "➕" if amount > 0 else "➖"
+    date = transaction.get('Date', '')
+    description = str(transaction.get('Description', ''))
+    # Truncate description if too long
+    if len(description) > 20:
+        description = description[:17] + "..."
+    
+    # Create a button with transaction info
+    label = f"{date}: {transaction_type} Rp{abs(amount):,.0f} - {description}"
+    # Truncate label if too long
+    if len(label) > 64:  # Telegram button label limit
+        label = label[:61] + "..."
+    
+    return label
+
+async def delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await query.answer("Anda tidak memiliki akses untuk menggunakan bot ini.", show_alert=True)
+        return
+    
+    await query.answer()
+    action = query.data.split("_")[1]
+    
+    
+    if action == "cancel":
+        get_session(context.user_data).clear_delete_range()
+        await query.edit_message_text("❌ Penghapusan data dibatalkan.")
+        return
+    
+    elif action == "last":
+        # Delete the last transaction for this user
+        user_records = await asyncio.to_thread(storage.query, user_id)
+        
+        if not user_records:
+            await query.edit_message_text("❌ Tidak ada transaksi untuk dihapus.")
+            return
+        
+        # Delete the last transaction's row
+        last_record = user_records[-1]
+        if await delete_transactions(context.user_data, user_id, [last_record]):
+            # Show confirmation with details of deleted transaction
+            amount = float(last_record.get('Amount', 0))
+            transaction_type = "Pemasukan" if amount > 0 else "Pengeluaran"
+            
+            await query.edit_message_text(
+                "✅ Transaksi terakhir berhasil dihapus!\n\n"
+                f"Jenis: {transaction_type}\n"
+                f"Jumlah: Rp {abs(amount):,.0f}\n"
+                f"Kategori: {last_record.get('Category', 'Lainnya')}\n"
+                f"Deskripsi: {last_record.get('Description', '')}\n"
+                f"Tanggal: {last_record.get('Date', '')}\n\n"
+                "Gunakan /batal untuk membatalkan."
+            )
+        else:
+            await query.edit_message_text("❌ Tidak dapat menemukan transaksi terakhir.")
+    
+    elif action == "specific":
+        # Show recent transactions for selection, paged from the in-memory index
+        text, reply_markup = render_history_page(user_id, 'd')
+        if reply_markup is None:
+            await query.edit_message_text("❌ Tidak ada transaksi untuk dihapus.")
+            return
+        
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    
+    elif action == "date":
+        # Ask for date range
+        session = get_session(context.user_data)
+        session.clear_delete_range()
+        session.delete_state = 'awaiting_start_date'
+        
+        await query.edit_message_text(
+            "📅 *Hapus Berdasarkan Tanggal*\n\n"
+            "Masukkan tanggal awal (format: YYYY-MM-DD):\n"
+            "Contoh: 2023-05-01",
+            parse_mode='Markdown'
+        )
+    
+    elif action == "all":
+        # Ask for confirmation before deleting all
+        keyboard = [
+            [InlineKeyboardButton("✅ Ya, Hapus Semua", callback_data="confirm_delete_all")],
+            [InlineKeyboardButton("❌ Tidak, Batalkan", callback_data="delete_cancel")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await query.edit_message_text(
+            "⚠️ *PERINGATAN*\n\n"
+            "Anda akan menghapus SEMUA data keuangan Anda.\n"
+            "Data masih dapat dipulihkan dengan /batal sesaat setelahnya, sebelum dihapus permanen.\n\n"
+            "Apakah Anda yakin ingin melanjutkan?",
+            parse_mode='Markdown',
+            reply_markup=reply_markup
+        )
+        
+async def process_multiple_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE, transactions):
+    """Process multiple transactions and ask for confirmation."""
+    user_id = update.effective_user.id
+    
+    # Create a summary of the transactions
+    confirmation_message = f"📝 *{len(transactions)} Transaksi Terdeteksi*\n\n"
+    
+    # Make a deep copy of the transactions to avoid reference issues
+    processed_transactions = []
+    seen_hashes = set()
+    duplicate_count = 0
+    
+    for i, transaction in enumerate(transactions, 1):
+        # Create a new dictionary for each transaction to avoid reference issues
+        processed_transaction = {
+            'amount': float(transaction.get('amount', 0)),  # Ensure amount is a float
+            'category': canonicalize_category(transaction.get('category')),  # Canonical, interned string
+            'description': str(transaction.get('description', f'Transaksi {i}')),  # Ensure description is a string
+            'date': str(transaction.get('date', datetime.now().strftime("%Y-%m-%d")))  # Ensure date is a string
+        }
+        
+        # Add to processed transactions
+        processed_transactions.append(processed_transaction)
+        
+        # Transaction type for display
+        transaction_type = "Pemasukan" if processed_transaction['amount'] > 0 else "Pengeluaran"
+        
+        # Format the date for display
+        try:
+            display_date = datetime.strptime(processed_transaction['date'], "%Y-%m-%d").strftime("%d/%m/%Y")
+        except:
+            display_date = processed_transaction['date']
+        
+        confirmation_message += f"*Transaksi {i}:*\n"
+        confirmation_message += f"Tanggal: {display_date}\n"
+        confirmation_message += f"Jenis: {transaction_type}\n"
+        confirmation_message += f"Jumlah: Rp {abs(processed_transaction['amount']):,.0f}\n"
+        confirmation_message += f"Kategori: {processed_transaction['category']}\n"
+        confirmation_message += f"Deskripsi: {processed_transaction['description']}\n"
+        
+        # Flag copies of recent transactions and repeated lines in this message
+        content = (processed_transaction['date'], processed_transaction['amount'], processed_transaction['description'])
+        content_hash = duplicate_index.content_hash(*content)
+        if content_hash in seen_hashes or duplicate_index.is_duplicate(user_id, *content):
+            confirmation_message += "⚠️ Kemungkinan duplikat\n"
+            duplicate_count += 1
+        seen_hashes.add(content_hash)
+        confirmation_message += "\n"
+    
+    if duplicate_count:
+        confirmation_message += f"⚠️ {duplicate_count} transaksi mirip dengan yang baru saja dicatat.\n\n"
+    
+    confirmation_message += "Apakah semua transaksi ini benar?"
+    
+    # Print for debugging
+    print(f"Storing {len(processed_transactions)} transactions in context")
+    for i, t in enumerate(processed_transactions):
+        print(f"Transaction {i+1}: {t}")
+    
+    # Save processed transactions in the session
+    session = get_session(context.user_data)
+    session.pending_multiple_transactions = processed_transactions.copy()
+    session.pending_multiple_key = new_idempotency_key()
+    
+    # Create confirmation buttons
+    keyboard = [
+        [InlineKeyboardButton("✅ Benar Semua", callback_data=f"confirm_all_yes_{session.pending_multiple_key}"),
+         InlineKeyboardButton("❌ Batal", callback_data=f"confirm_all_no_{session.pending_multiple_key}")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    # Send confirmation message and store its ID
+    conf_message = await update.message.reply_text(
+        confirmation_message, 
+        reply_markup=reply_markup, 
+        parse_mode='Markdown'
+    )
+    
+    # Add the confirmation message ID to the list for deletion
+    track_message_for_deletion(context.user_data, conf_message.message_id)
+    
+async def multiple_transactions_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle confirmation for multiple transactions."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await query.answer("Anda tidak memiliki akses untuk menggunakan bot ini.", show_alert=True)
+        return
+    
+    await query.answer()
+    session = get_session(context.user_data)
+    
+    if query.data.startswith("confirm_all_yes"):
+        key = callback_key(query.data, "confirm_all_yes")
+        if key is not None and key in committed_keys:
+            # Repeated tap or redelivered callback, the rows are already written
+            return
+        
+        # Get the pending transactions
+        transactions = session.pending_multiple_transactions or []
+        
+        if not transactions or (key is not None and key != session.pending_multiple_key):
+            await query.edit_message_text("❌ Terjadi kesalahan. Tidak ada transaksi untuk disimpan.")
+            return
+        
+        # Show processing message
+        processing_message = await query.edit_message_text(f"⏳ Menyimpan {len(transactions)} transaksi...")
+        
+        # Prepare row data
+        rows = [
+            build_transaction_row(
+                user_id,
+                transaction.get('date', datetime.now().strftime("%Y-%m-%d")),
+                transaction.get('amount', 0),
+                transaction.get('category', 'Lainnya'),
+                transaction.get('description', '')
+            )
+            for transaction in transactions
+        ]
+        
+        # Record all transactions to the sheet in a single request
+        try:
+            budget_warnings = await record_transactions(context.user_data, user_id, rows)
+        except Exception as e:
+            logger.error(f"Error recording transactions: {e}", exc_info=True)
+            # The pending transactions are kept, so the same buttons can be tapped again
+            await query.edit_message_text(
+                f"❌ Gagal mencatat {len(transactions)} transaksi. Silakan coba lagi.",
+                reply_markup=query.message.reply_markup
+            )
+            return
+        if key is not None:
+            committed_keys.add(key)
+        session.pending_multiple_transactions = session.pending_multiple_key = None
+        
+        # Send confirmation message
+        confirmation_message = await query.edit_message_text(
+            f"✅ {len(rows)} dari {len(transactions)} transaksi berhasil dicatat!\n\n"
+            f"Gunakan /laporan untuk melihat ringkasan keuangan Anda."
+        )
+        
+        # Store the message ID for deletion
+        track_message_for_deletion(context.user_data, confirmation_message.message_id)
+        
+        # Schedule message deletion (coalesced per chat)
+        schedule_message_deletion(context, update.effective_chat.id, user_id)
+        
+        await send_budget_warnings(context, update.effective_chat.id, budget_warnings)
+    
+    elif query.data.startswith("confirm_all_no"):
+        # Clear the pending transactions
+        session.pending_multiple_transactions = session.pending_multiple_key = None
+        
+        await query.edit_message_text(
+            "❌ Pencatatan transaksi dibatalkan."
+        )
+
+async def delete_specific_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    
+    # Extract the transaction ID from the callback data
+    record_id = query.data.split("_", 2)[2]
+    transaction = transaction_index.records.get(record_id)
+    
+    if transaction is None or str(transaction.get('User ID')) != str(user_id):
+        await query.edit_message_text("❌ Tidak dapat menemukan transaksi yang dipilih.")
+        return
+    
+    # Delete the row
+    if await delete_transactions(context.user_data, user_id, [transaction]):
+        # Show confirmation with details of deleted transaction
+        amount = float(transaction.get('Amount', 0))
+        transaction_type = "Pemasukan" if amount > 0 else "Pengeluaran"
+        
+        await query.edit_message_text(
+            "✅ Transaksi berhasil dihapus!\n\n"
+            f"Jenis: {transaction_type}\n"
+            f"Jumlah: Rp {abs(amount):,.0f}\n"
+            f"Kategori: {transaction.get('Category', 'Lainnya')}\n"
+            f"Deskripsi: {transaction.get('Description', '')}\n"
+            f"Tanggal: {transaction.get('Date', '')}\n\n"
+            "Gunakan /batal untuk membatalkan."
+        )
+    else:
+        await query.edit_message_text("❌ Tidak dapat menemukan transaksi yang dipilih.")
+
+# Handle date input for deletion
+async def handle_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    message_text = update.message.text.strip()
+    
+    # Check if we're in the date deletion flow
+    session = get_session(context.user_data)
+    if session.delete_state is None:
+        return
+    
+    delete_state = session.delete_state
+    
+    # Validate date format (YYYY-MM-DD)
+    import re
+    if not re.match(r'^\d{4}-\d{2}-\d{2}$', message_text):
+        await update.message.reply_text(
+            "❌ Format tanggal tidak valid. Gunakan format YYYY-MM-DD.\n"
+            "Contoh: 2023-05-01\n\n"
+            "Silakan coba lagi:"
+        )
+        return
+    
+    if delete_state == 'awaiting_start_date':
+        # Store start date and ask for end date
+        session.start_date = message_text
+        session.delete_state = 'awaiting_end_date'
+        
+        await update.message.reply_text(
+            "📅 Masukkan tanggal akhir (format: YYYY-MM-DD):\n"
+            "Contoh: 2023-05-31"
+        )
+    
+    elif delete_state == 'awaiting_end_date':
+        start_date = session.start_date
+        end_date = message_text
+        
+        # Validate that end date is after start date
+        if end_date < start_date:
+            await update.message.reply_text(
+                "❌ Tanggal akhir harus setelah tanggal awal.\n"
+                "Silakan masukkan tanggal akhir yang valid:"
+            )
+            return
+        
+        # Get the user's records in the date range
+        user_records_in_range = await asyncio.to_thread(storage.query, user_id, start_date, end_date)
+        if any(not record.get('ID') for record in user_records_in_range):
+            # Rows typed directly in the sheet get their ID when the index is reloaded
+            transaction_index.load(await asyncio.to_thread(storage.load_records))
+            user_records_in_range = await asyncio.to_thread(storage.query, user_id, start_date, end_date)
+        
+        if not user_records_in_range:
+            await update.message.reply_text(
+                "❌ Tidak ada transaksi dalam rentang tanggal tersebut."
+            )
+            # Clear delete state
+            session.clear_delete_range()
+            return
+        
+        # Ask for confirmation; only the IDs are kept until then
+        session.record_ids_to_delete = [str(record['ID']) for record in user_records_in_range if record.get('ID')]
+        
+        # Create confirmation message
+        confirmation_message = (
+            f"🗑️ *Konfirmasi Penghapusan*\n\n"
+            f"Anda akan menghapus {len(user_records_in_range)} transaksi "
+            f"dari {start_date} hingga {end_date}.\n\n"
+            "Apakah Anda yakin ingin melanjutkan?"
+        )
+        
+        keyboard = [
+            [InlineKeyboardButton("✅ Ya, Hapus", callback_data="confirm_delete_date")],
+            [InlineKeyboardButton("❌ Tidak, Batalkan", callback_data="delete_cancel")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await update.message.reply_text(
+            confirmation_message,
+            parse_mode='Markdown',
+            reply_markup=reply_markup
+        )
+
+async def confirm_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = update.effective_user.id
+    action = query.data.split("_")[2]  # confirm_delete_all or confirm_delete_date
+    
+    if action == "all":
+        # Delete all transactions for this user
+        transaction_index.ensure_loaded()
+        deleted_count = await delete_transactions(context.user_data, user_id, transaction_index.user_records(user_id))
+        
+        # Nothing is left, so this month's spending starts from zero
+        context.user_data['month_totals'] = {'month': datetime.now().strftime("%Y-%m"), 'totals': {}}
+        
+        await query.edit_message_text(
+            "✅ Semua transaksi Anda telah dihapus.\n\n"
+            f"Total {deleted_count} transaksi telah dihapus.\n"
+            "Gunakan /batal untuk membatalkan."
+        )
+    
+    elif action == "date":
+        session = get_session(context.user_data)
+        if session.record_ids_to_delete is None:
+            await query.edit_message_text("❌ Terjadi kesalahan. Silakan coba lagi.")
+            return
+        
+        transaction_index.ensure_loaded()
+        records_to_delete = [
+            transaction_index.records[record_id] for record_id in session.record_ids_to_delete
+            if record_id in transaction_index.records
+        ]
+        
+        deleted_count = await delete_transactions(context.user_data, user_id, records_to_delete)
+        
+        # Clear delete state
+        session.clear_delete_range()
+        
+        await query.edit_message_text(
+            "✅ Transaksi dalam rentang tanggal telah dihapus.\n\n"
+            f"Total {deleted_count} transaksi telah dihapus.\n"
+            "Gunakan /batal untuk membatalkan."
+        )
+
+# Fields and rules shared by the single and batched parse prompts
+PARSE_FIELDS = """
+    - amount: the monetary amount (numeric value only, without currency symbols)
+    - category: the spending/income category
+    - description: brief description of the transaction
+    - transaction_type: "income" if this is money received, or "expense" if this is money spent
+"""
+
+# Dates are resolved locally by resolve_date_expression, so the rules only
+# cover the fields Gemini still has to infer
+PARSE_RULES = """
+    For transaction_type, analyze the context carefully using these rules:
+    
+    INCOME indicators (set transaction_type to "income"):
+    - Words about receiving money: "terima", "dapat", "pemasukan", "masuk", "diterima"
+    - Income sources: "gaji", "bonus", "komisi", "dividen", "bunga", "hadiah", "warisan", "penjualan", "refund", "kembalian", "cashback"
+    - Phrases like: "dibayar oleh", "transfer dari", "kiriman dari", "diberi", "dikasih"
+    
+    EXPENSE indicators (set transaction_type to "expense"):
+    - Words about spending: "beli", "bayar", "belanja", "pengeluaran", "keluar", "dibayar"
+    - Purchase verbs: "membeli", "memesan", "berlangganan", "sewa", "booking"
+    - Expense categories: "makanan", "transportasi", "bensin", "pulsa", "tagihan", "biaya", "iuran"
+    - Phrases like: "dibayarkan untuk", "transfer ke", "kirim ke"
+    
+    If the text doesn't clearly indicate transaction type, look at the context:
+    - If it mentions purchasing an item or service, it's likely an expense
+    - If it mentions receiving money or payment, it's likely income
+    
+    If still unclear, default to "expense".
+    
+    For category, try to identify specific categories like:
+    - Income categories: "Gaji", "Bonus", "Investasi", "Hadiah", "Penjualan", "Bisnis"
+    - Expense categories: "Makanan", "Transportasi", "Belanja", "Hiburan", "Tagihan", "Kesehatan", "Pendidikan"
+    
+    If any field is unclear, set it to null.
+    """
+
+def build_parse_prompt(text):
+    """Build the prompt for a single transaction."""
+    return f"""
+    Extract financial information from this Indonesian text: "{text}"
+    
+    Return a JSON object with these fields:{PARSE_FIELDS}{PARSE_RULES}"""
+
+def build_batch_parse_prompt(texts):
+    """Build one prompt covering several independent transactions."""
+    numbered_texts = "\n".join(f'    {i}. "{text}"' for i, text in enumerate(texts, 1))
+    return f"""
+    Extract financial information from each of these {len(texts)} independent Indonesian texts:
+{numbered_texts}
+    
+    Return a JSON array with exactly {len(texts)} objects, in the same order as the texts.
+    Each object has these fields:{PARSE_FIELDS}{PARSE_RULES}"""
+
+def extract_json(response_text):
+    """Extract and decode the JSON payload from a Gemini response."""
+    if "```json" in response_text:
+        json_str = response_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in response_text:
+        json_str = response_text.split("```")[1].strip()
+    else:
+        json_str = response_text.strip()
+    
+    return json.loads(json_str)
+
+class CircuitBreaker:
+    """Track Gemini latency and errors and stop calling it while it is unhealthy.
+    
+    closed: every request goes to Gemini.
+    open: requests are refused until `cooldown` seconds have passed.
+    half-open: a single probe request is let through; its outcome closes or
+    re-opens the circuit.
+    """
+    
+    def __init__(self, window, min_calls, error_rate, slow_call, cooldown):
+        self.outcomes = deque(maxlen=window)  # True for a failed or slow call
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened_at = 0
+        self.probe_in_flight = False
+    
+    def allow_request(self):
+        if self.state == 'closed':
+            return True
+        
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = 'half-open'
+        
+        if self.state == 'half-open' and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        
+        return False
+    
+    def available(self):
+        """Whether allow_request would let a call through, without taking the probe slot."""
+        if self.state == 'closed':
+            return True
+        if self.state == 'open':
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not self.probe_in_flight
+    
+    def release_probe(self):
+        """Free the half-open probe slot of a call that ended without an outcome."""
+        if self.state == 'half-open':
+            self.probe_in_flight = False
+    
+    def record(self, success, latency):
+        failed = not success or latency > self.slow_call
+        
+        if self.state == 'half-open':
+            self.probe_in_flight = False
+            if failed:
+                self.trip()
+            else:
+                logger.info("Gemini circuit closed, LLM parsing restored")
+                self.state = 'closed'
+                self.outcomes.clear()
+            return
+        
+        self.outcomes.append(failed)
+        if (self.state == 'closed' and len(self.outcomes) >= self.min_calls and
+                sum(self.outcomes) / len(self.outcomes) >= self.error_rate):
+            self.trip()
+    
+    def trip(self):
+        logger.warning(f"Gemini circuit opened, using local parsing for {self.cooldown}s")
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+
+gemini_breaker = CircuitBreaker(
+    window=GEMINI_CB_WINDOW,
+    min_calls=GEMINI_CB_MIN_CALLS,
+    error_rate=GEMINI_CB_ERROR_RATE,
+    slow_call=GEMINI_CB_SLOW_SECONDS,
+    cooldown=GEMINI_CB_COOLDOWN
+)
+
+class GeminiUsage:
+    """Gemini requests, tokens and latency per user and flow.
+    
+    Totals are aggregated in memory under "user|flow" keys and are
+    cumulative across restarts: they are loaded from and periodically
+    flushed to GEMINI_USAGE_FILE. Flows are single, multi, batch and
+    receipt; bypasses count texts parsed locally instead of by Gemini.
+    """
+    
+    FIELDS = ('requests', 'errors', 'prompt_tokens', 'response_tokens', 'latency', 'max_latency', 'bypasses')
+    
+    def __init__(self, path):
+        self.path = path
+        self.totals = {}
+    
+    def load(self):
+        """Read the totals saved by earlier runs."""
+        try:
+            with open(self.path) as f:
+                self.totals = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not read Gemini usage from {self.path}: {e}")
+    
+    def entry(self, user_id, flow):
+        return self.totals.setdefault(f"{user_id}|{flow}", dict.fromkeys(self.FIELDS, 0))
+    
+    def record_call(self, callers, latency, prompt_tokens=0, response_tokens=0, ok=True):
+        """Record one Gemini call; a batch's tokens are split evenly between its callers."""
+        for user_id, flow in callers:
+            entry = self.entry(user_id, flow)
+            entry['requests'] += 1
+            entry['errors'] += 0 if ok else 1
+            entry['prompt_tokens'] += prompt_tokens / len(callers)
+            entry['response_tokens'] += response_tokens / len(callers)
+            entry['latency'] += latency
+            entry['max_latency'] = max(entry['max_latency'], latency)
+    
+    def record_bypass(self, user_id, flow):
+        self.entry(user_id, flow)['bypasses'] += 1
+    
+    def snapshot(self):
+        return json.dumps(self.totals)
+    
+    def write(self, data):
+        """Write a snapshot atomically, so a crash never leaves a partial file."""
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as f:
+            f.write(data)
+        os.replace(temporary_path, self.path)
+    
+    def summarize(self):
+        """Return the totals merged per flow and the tokens used per user."""
+        flows = {}
+        users = {}
+        for key, entry in self.totals.items():
+            user_key, flow = key.rsplit('|', 1)
+            flow_totals = flows.setdefault(flow, dict.fromkeys(self.FIELDS, 0))
+            for field in self.FIELDS:
+                if field == 'max_latency':
+                    flow_totals[field] = max(flow_totals[field], entry[field])
+                else:
+                    flow_totals[field] += entry[field]
+            users[user_key] = users.get(user_key, 0) + entry['prompt_tokens'] + entry['response_tokens']
+        return flows, users
+
+gemini_usage = GeminiUsage(GEMINI_USAGE_FILE)
+
+async def call_gemini(prompt, callers=((None, 'single'),)):
+    """Call Gemini with a timeout and record the outcome in the circuit breaker.
+    
+    `callers` lists the (user ID, flow) pairs the call is made for, for usage
+    accounting.
+    """
+    started = time.monotonic()
+    try:
+        # Use the async client so a slow response doesn't block other users
+        response = await asyncio.wait_for(model.generate_content_async(prompt), GEMINI_TIMEOUT)
+        text = response.text
+    except asyncio.CancelledError:
+        # A cancelled call says nothing about Gemini's health, but must not
+        # keep the probe slot taken
+        gemini_breaker.release_probe()
+        raise
+    except Exception:
+        gemini_breaker.record(False, time.monotonic() - started)
+        gemini_usage.record_call(callers, time.monotonic() - started, ok=False)
+        raise
+    
+    latency = time.monotonic() - started
+    gemini_breaker.record(True, latency)
+    
+    usage_metadata = getattr(response, 'usage_metadata', None)
+    gemini_usage.record_call(
+        callers, latency,
+        getattr(usage_metadata, 'prompt_token_count', 0) or 0,
+        getattr(usage_metadata, 'candidates_token_count', 0) or 0
+    )
+    return text
+
+async def request_parse(text, caller=(None, 'single')):
+    """Send a single parse request to Gemini and return the raw JSON object."""
+    return extract_json(await call_gemini(build_parse_prompt(text), [caller]))
+
+class GeminiBatchDispatcher:
+    """Collect parse requests from different users into batched Gemini calls.
+    
+    Requests arriving within `window` seconds of each other are sent as one
+    prompt (at most `max_size` texts) and each result is routed back to its
+    caller. If a batch fails, its texts are retried as single requests.
+    """
+    
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.pending = []  # (text, caller, future) waiting for the next flush
+        self.flush_task = None
+        self.tasks = set()  # the loop only keeps weak references to running tasks
+    
+    def start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+    
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Gemini batch task failed", exc_info=task.exception())
+    
+    async def submit(self, text, caller=(None, 'single')):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((text, caller, future))
+        
+        if len(self.pending) >= self.max_size:
+            # Batch is full, send it right away
+            if self.flush_task is not None:
+                self.flush_task.cancel()
+                self.flush_task = None
+            batch, self.pending = self.pending, []
+            self.start(self.run_batch(batch))
+        elif self.flush_task is None:
+            self.flush_task = self.start(self.flush_later())
+        
+        return await future
+    
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        batch, self.pending = self.pending, []
+        if batch:
+            await self.run_batch(batch)
+    
+    async def run_batch(self, batch):
+        if len(batch) > 1:
+            try:
+                texts = [text for text, _, _ in batch]
+                callers = [(user_id, 'batch') for _, (user_id, _), _ in batch]
+                results = extract_json(await call_gemini(build_batch_parse_prompt(texts), callers))
+                
+                if not isinstance(results, list) or len(results) != len(batch):
+                    raise ValueError(f"expected {len(batch)} results, got {results!r}")
+                
+                for (_, _, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+                return
+            except Exception as e:
+                logger.error(f"Batched Gemini parse failed, retrying {len(batch)} single requests: {e}")
+        
+        # Single request, or fallback after a failed batch
+        async def run_single(text, caller, future):
+            try:
+                result = await request_parse(text, caller)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+        
+        await asyncio.gather(*(run_single(text, caller, future) for text, caller, future in batch))
+
+# Cross-user micro-batching is optional (GEMINI_BATCHING=1 to enable)
+gemini_dispatcher = (
+    GeminiBatchDispatcher(GEMINI_BATCH_WINDOW_MS / 1000, GEMINI_BATCH_SIZE)
+    if GEMINI_BATCHING else None
+)
+
+# Enhanced helper function to parse financial data using Gemini with improved income/expense detection
+async def parse_financial_data(text, user_id=None, flow='single'):
+    # Current date for reference
+    current_date = date.today()
+    
+    # While Gemini is slow or down, skip it and parse locally
+    if not gemini_breaker.allow_request():
+        gemini_usage.record_bypass(user_id, flow)
+        return parse_financial_data_locally(text)
+    
+    try:
+        if gemini_dispatcher is not None:
+            data = await gemini_dispatcher.submit(text, (user_id, flow))
+        else:
+            data = await request_parse(text, (user_id, flow))
+        
+        return finalize_parsed_data(data, text, current_date)
+    except Exception as e:
+        logger.error(f"Error parsing Gemini response: {e}")
+        # If parsing fails, fall back to the local parser
+        gemini_usage.record_bypass(user_id, flow)
+        return parse_financial_data_locally(text)
+
+def finalize_parsed_data(data, text, current_date, printed_date=None):
+    """Fill in the date and sign the amount of a raw Gemini result.
+    
+    The date comes from the expressions in the user's text; otherwise the
+    date printed on a receipt, otherwise today.
+    """
+    data['date'] = (
+        resolve_date_expression(text, current_date) or printed_date or current_date
+    ).strftime("%Y-%m-%d")
+    
+    # Additional processing for amount and transaction type
+    if data.get('amount') is not None:
+        # Convert amount to float and ensure proper sign
+        amount = abs(float(data.get('amount')))
+        
+        # Apply sign based on transaction type
+        if data.get('transaction_type') == 'expense':
+            amount = -amount
+            
+        data['amount'] = amount
+    
+    return data
+
+def build_receipt_prompt(caption, current_date):
+    """Build the prompt for a receipt photo."""
+    caption_line = f'The user added this caption: "{caption}"' if caption else ""
+    return f"""
+    Extract financial information from this photo of an Indonesian receipt or transfer proof.
+    {caption_line}
+    Today's date is {current_date.strftime("%Y-%m-%d")}.
+    
+    Use the final total that was paid as the amount, and the store or merchant name
+    in the description.
+    
+    Return a JSON object with these fields:{PARSE_FIELDS}    - date: the transaction date printed on the receipt in YYYY-MM-DD format, or null if none is printed
+{PARSE_RULES}"""
+
+def select_receipt_photo(photo_sizes):
+    """Pick the smallest Telegram photo size that is still large enough to read."""
+    for photo_size in sorted(photo_sizes, key=lambda p: p.width * p.height):
+        if max(photo_size.width, photo_size.height) >= RECEIPT_TARGET_SIDE:
+            return photo_size
+    
+    # Every size is small, use the largest one
+    return max(photo_sizes, key=lambda p: p.width * p.height)
+
+def prepare_receipt_image(image_bytes):
+    """Downscale, convert to grayscale and re-encode a receipt as a capped JPEG.
+    
+    Runs in a worker thread because decoding and encoding are CPU-bound.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image = image.convert('L')  # Receipts are readable without color
+    image.thumbnail((RECEIPT_TARGET_SIDE, RECEIPT_TARGET_SIDE))
+    
+    quality = RECEIPT_JPEG_QUALITY
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        if buffer.tell() <= RECEIPT_MAX_BYTES:
+            return buffer.getvalue()
+        
+        # Lower the quality to its floor first, then shrink the image
+        if quality > RECEIPT_MIN_JPEG_QUALITY:
+            quality = max(quality - 10, RECEIPT_MIN_JPEG_QUALITY)
+        elif max(image.size) > RECEIPT_MIN_SIDE:
+            side = max(int(max(image.size) * 0.8), RECEIPT_MIN_SIDE)
+            image.thumbnail((side, side))
+        else:
+            # Smallest readable version, sent even though it exceeds the cap
+            return buffer.getvalue()
+
+async def parse_receipt(jpeg_bytes, caption, user_id=None):
+    """Parse a prepared receipt photo with Gemini into the parse_financial_data structure."""
+    current_date = date.today()
+    
+    response_text = await call_gemini([
+        build_receipt_prompt(caption, current_date),
+        {'mime_type': 'image/jpeg', 'data': jpeg_bytes}
+    ], [(user_id, 'receipt')])
+    
+    data = extract_json(response_text)
+    try:
+        printed_date = datetime.strptime(str(data.pop('date', None)), "%Y-%m-%d").date()
+    except ValueError:
+        printed_date = None
+    
+    # A date in the caption ("kemarin") takes precedence over the printed one
+    return finalize_parsed_data(data, caption or "", current_date, printed_date)
+
+WEEKDAY_NAMES = {
+    "senin": 0, "monday": 0,
+    "selasa": 1, "tuesday": 1,
+    "rabu": 2, "wednesday": 2,
+    "kamis": 3, "thursday": 3,
+    "jumat": 4, "friday": 4,
+    "sabtu": 5, "saturday": 5,
+    "minggu": 6, "sunday": 6
+}
+
+MONTH_NAMES = {
+    "januari": 1, "january": 1, "jan": 1,
+    "februari": 2, "pebruari": 2, "february": 2, "feb": 2,
+    "maret": 3, "march": 3, "mar": 3,
+    "april": 4, "apr": 4,
+    "mei": 5, "may": 5,
+    "juni": 6, "june": 6, "jun": 6,
+    "juli": 7, "july": 7, "jul": 7,
+    "agustus": 8, "august": 8, "agu": 8, "agt": 8, "aug": 8,
+    "september": 9, "sept": 9, "sep": 9,
+    "oktober": 10, "october": 10, "okt": 10, "oct": 10,
+    "november": 11, "nopember": 11, "nov": 11, "nop": 11,
+    "desember": 12, "december": 12, "des": 12, "dec": 12
+}
+
+NUMBER_WORDS = {
+    "satu": 1, "dua": 2, "tiga": 3, "empat": 4, "lima": 5, "enam": 6, "tujuh": 7,
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7
+}
+
+# Units of relative expressions, by the number of months they span (0 = days)
+DATE_UNITS = {
+    "hari": ('days', 1), "day": ('days', 1), "days": ('days', 1),
+    "minggu": ('days', 7), "pekan": ('days', 7), "week": ('days', 7), "weeks": ('days', 7),
+    "bulan": ('months', 1), "month": ('months', 1), "months": ('months', 1),
+    "tahun": ('months', 12), "year": ('months', 12), "years": ('months', 12)
+}
+
+PAST_WORDS = {"lalu", "kemarin", "sebelumnya", "last", "previous", "ago"}
+FUTURE_WORDS = {"depan", "berikutnya", "next", "lagi", "kemudian", "later", "from now"}
+
+def word_pattern(words):
+    """Regex alternation of words, longest first so "sept" is tried before "sep"."""
+    return "|".join(sorted(words, key=len, reverse=True))
+
+MONTH_PATTERN = word_pattern(MONTH_NAMES)
+WEEKDAY_PATTERN = word_pattern(WEEKDAY_NAMES)
+COUNT_PATTERN = r"\d+|" + word_pattern(NUMBER_WORDS)
+UNIT_PATTERN = word_pattern(DATE_UNITS)
+DIRECTION_PATTERN = word_pattern(PAST_WORDS | FUTURE_WORDS | {"ini", "this"})
+
+def direction_of(word):
+    """Return -1 for a past modifier, 1 for a future one and 0 otherwise."""
+    if word in PAST_WORDS:
+        return -1
+    if word in FUTURE_WORDS:
+        return 1
+    return 0
+
+def month_length(year, month):
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return (next_month - timedelta(days=1)).day
+
+def shift_months(day, months):
+    """Move a date by whole months, clamping to the last day of the target month."""
+    year, month = divmod(day.year * 12 + day.month - 1 + months, 12)
+    return date(year, month + 1, min(day.day, month_length(year, month + 1)))
+
+def shift_date(today, unit, count):
+    kind, size = DATE_UNITS[unit]
+    if kind == 'days':
+        return today + timedelta(days=count * size)
+    return shift_months(today, count * size)
+
+def parse_year(year, today):
+    """Expand a two-digit year to 20xx; no year means the current one."""
+    if not year:
+        return today.year
+    year = int(year)
+    return year + 2000 if year < 100 else year
+
+def boundary_date(boundary, year, month):
+    if boundary in ("awal", "beginning", "start"):
+        return date(year, month, 1)
+    if boundary in ("akhir", "end"):
+        return date(year, month, month_length(year, month))
+    return date(year, month, 15)
+
+def resolve_month_boundary(parts, today):
+    # "awal bulan lalu", "end of next month"
+    month = shift_months(today.replace(day=1), direction_of(parts['direction'] or ""))
+    return boundary_date(parts['boundary'], month.year, month.month)
+
+def resolve_named_month_boundary(parts, today):
+    # "akhir Mei", "end of May 2023"
+    return boundary_date(parts['boundary'], parse_year(parts['year'], today), MONTH_NAMES[parts['month']])
+
+def resolve_numeric_date(parts, today):
+    # 2024-05-05, 05/05/2024, 5-5-24, 05/05
+    return date(parse_year(parts.get('year'), today), int(parts['month']), int(parts['day']))
+
+def resolve_month_name_date(parts, today):
+    # "5 Mei", "5th May 2023", "May 5, 2023"
+    return date(parse_year(parts['year'], today), MONTH_NAMES[parts['month']], int(parts['day']))
+
+def resolve_day_of_month(parts, today):
+    # "tanggal 5", "tgl 25 bulan lalu"; a day past the month's end means its last day
+    month = shift_months(today.replace(day=1), direction_of(parts['direction'] or ""))
+    day = int(parts['day'])
+    if not 1 <= day <= 31:
+        raise ValueError(f"day {day} is out of range")
+    return date(month.year, month.month, min(day, month_length(month.year, month.month)))
+
+def resolve_unit_count(parts, today):
+    # "3 hari yang lalu", "seminggu lalu", "two weeks ago", "2 hari lagi"
+    count = parts['count']
+    count = 1 if count is None else int(count) if count.isdigit() else NUMBER_WORDS[count]
+    return shift_date(today, parts['unit'], count * direction_of(parts['direction']))
+
+def resolve_relative_unit(parts, today):
+    # "minggu lalu", "last month", "tahun depan"
+    return shift_date(today, parts['unit'], direction_of(parts['direction']))
+
+def resolve_weekday(parts, today):
+    # "Senin", "Senin lalu", "hari Minggu depan", "last Friday"
+    weekday = WEEKDAY_NAMES[parts['weekday']]
+    direction = direction_of(parts['direction'] or "")
+    if direction > 0:
+        # The next one, never today
+        return today + timedelta(days=(weekday - today.weekday() - 1) % 7 + 1)
+    if direction < 0:
+        # The previous one, never today
+        return today - timedelta(days=(today.weekday() - weekday - 1) % 7 + 1)
+    # The most recent one, today included
+    return today - timedelta(days=(today.weekday() - weekday) % 7)
+
+def resolve_offset(days):
+    return lambda parts, today: today + timedelta(days=days)
+
+# Date expressions in the order they are tried. Longer expressions come before
+# the words they contain ("awal bulan lalu" before "bulan lalu", "kemarin lusa"
+# before "kemarin"), and "minggu lalu" means last week unless it follows "hari".
+DATE_RULES = [(re.compile(pattern), resolve) for pattern, resolve in [
+    (rf"\b(?P<boundary>awal|akhir|pertengahan|tengah) bulan(?: (?P<direction>{DIRECTION_PATTERN}))?\b",
+     resolve_month_boundary),
+    (rf"\b(?P<boundary>beginning|start|end|middle) of (?:the )?(?:(?P<direction>{DIRECTION_PATTERN}) )?month\b",
+     resolve_month_boundary),
+    (rf"\b(?P<boundary>awal|akhir|pertengahan|tengah) (?:bulan )?(?P<month>{MONTH_PATTERN})(?: (?P<year>\d{{4}}))?\b",
+     resolve_named_month_boundary),
+    (rf"\b(?P<boundary>beginning|start|end|middle) of (?P<month>{MONTH_PATTERN})(?:,? (?P<year>\d{{4}}))?\b",
+     resolve_named_month_boundary),
+    (r"\b(?P<year>\d{4})[/.-](?P<month>\d{1,2})[/.-](?P<day>\d{1,2})\b", resolve_numeric_date),
+    (r"\b(?P<day>\d{1,2})[/.-](?P<month>\d{1,2})[/.-](?P<year>\d{4}|\d{2})\b", resolve_numeric_date),
+    (r"\b(?P<day>\d{1,2})/(?P<month>\d{1,2})\b(?![/.-]?\d)", resolve_numeric_date),
+    (rf"\b(?P<day>\d{{1,2}})(?:st|nd|rd|th)? (?P<month>{MONTH_PATTERN})\b(?:,? (?P<year>\d{{4}})\b)?",
+     resolve_month_name_date),
+    (rf"\b(?P<month>{MONTH_PATTERN}) (?P<day>\d{{1,2}})(?:st|nd|rd|th)?\b(?:,? (?P<year>\d{{4}})\b)?",
+     resolve_month_name_date),
+    (rf"\b(?:tanggal|tgl\.?) ?(?P<day>\d{{1,2}})\b(?: bulan (?P<direction>{DIRECTION_PATTERN})\b)?",
+     resolve_day_of_month),
+    (rf"\b(?:(?P<count>{COUNT_PATTERN}) |se)(?P<unit>{UNIT_PATTERN}) (?:yang )?"
+     rf"(?P<direction>lalu|sebelumnya|ago|lagi|kemudian|later|from now)\b",
+     resolve_unit_count),
+    (r"\b(?:kemarin lusa|day before yesterday)\b", resolve_offset(-2)),
+    (r"\b(?:lusa|day after tomorrow)\b", resolve_offset(2)),
+    (rf"(?<!hari )\b(?P<unit>minggu|pekan|bulan|tahun) (?P<direction>{DIRECTION_PATTERN})\b", resolve_relative_unit),
+    (r"\b(?P<direction>last|next|this|previous) (?P<unit>week|month|year)\b", resolve_relative_unit),
+    (rf"\b(?P<direction>last|next|this|previous) (?P<weekday>{WEEKDAY_PATTERN})\b", resolve_weekday),
+    (rf"\bhari (?P<weekday>{WEEKDAY_PATTERN})(?: (?P<direction>{DIRECTION_PATTERN}))?\b", resolve_weekday),
+    # A bare "minggu" is more often "week" than Sunday
+    (rf"\b(?P<weekday>{word_pattern(set(WEEKDAY_NAMES) - {'minggu'})})(?: (?P<direction>{DIRECTION_PATTERN}))?\b",
+     resolve_weekday),
+    (r"\b(?:kemarin|kmrn|yesterday)\b", resolve_offset(-1)),
+    (r"\b(?:besok|tomorrow)\b", resolve_offset(1)),
+]]
+
+def resolve_date_expression(text, today):
+    """Return the date an Indonesian or English text refers to, or None.
+    
+    Handles explicit dates ("5 Mei 2023", "05/05", "2023-05-05"), relative
+    days ("kemarin", "3 hari yang lalu", "lusa"), weekdays ("Senin lalu",
+    "next Friday") and month boundaries ("awal bulan lalu", "akhir Mei").
+    """
+    text = " ".join(str(text).lower().split())
+    for pattern, resolve in DATE_RULES:
+        for match in pattern.finditer(text):
+            try:
+                return resolve(match.groupdict(), today)
+            except ValueError:
+                # Not a valid calendar date (e.g. 31/02). Stop here: later rules
+                # would reread the same words ("tgl 31 bulan lalu" as "31 months ago")
+                return None
+    return None
+
+def parse_date_from_text(text, today=None):
+    """Return the date mentioned in text as YYYY-MM-DD, defaulting to today."""
+    today = today or date.today()
+    return (resolve_date_expression(text, today) or today).strftime("%Y-%m-%d")
+
+# Function to parse multiple transactions from multi-line input
+async def parse_multiple_transactions(text, user_id=None):
+    """Parse multiple transactions from text separated by newlines."""
+    # Split the text by newlines and filter out empty lines
     lines = [line.strip() for line in text.split('\n') if line.strip()]
     print(f"Parsing {len(lines)} lines")
     
-    if not lines:
-        return []
+    if not lines:
+        return []
+    
+    # With batching enabled, submit all lines at once so they share a Gemini call
+    if gemini_dispatcher is not None:
+        batched_results = await asyncio.gather(
+            *(parse_financial_data(line, user_id, 'multi') for line in lines), return_exceptions=True
+        )
+    
+    # Process each line as a separate transaction
+    transactions = []
+    for i, line in enumerate(lines):
+        try:
+            print(f"Parsing line {i+1}: {line}")
+            if gemini_dispatcher is not None:
+                transaction_data = batched_results[i]
+                if isinstance(transaction_data, Exception):
+                    raise transaction_data
+            else:
+                transaction_data = await parse_financial_data(line, user_id, 'multi')
+            print(f"Parsed data: {transaction_data}")
+            
+            # Only include transactions where an amount could be determined
+            if transaction_data.get('amount') is not None:
+                transactions.append(transaction_data)
+                print(f"Added transaction {i+1}")
+            else:
+                print(f"Skipping line {i+1} - no amount detected")
+        except Exception as e:
+            print(f"Error parsing line {i+1}: {e}")
+            logger.error(f"Error parsing transaction line '{line}': {e}")
+            # Continue with other lines even if one fails
+            continue
+    
+    print(f"Returning {len(transactions)} parsed transactions")
+    return transactions
+
+# Command handlers
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    # Original handler code
+    await update.message.reply_text(
+        "👋 Selamat datang di Bot Pencatatan Keuangan!\n\n"
+        "Gunakan bot ini untuk mencatat keuangan Anda. Data akan disimpan di Google Sheets.\n\n"
+        "Perintah:\n"
+        "/catat - Catat transaksi baru\n"
+        "/laporan - Lihat laporan keuangan\n"
+        "/grafik - Lihat grafik pengeluaran\n"
+        "/analisis - Analisis tren dan pola pengeluaran\n"
+        "/anggaran - Atur anggaran bulanan per kategori\n"
+        "/rutin - Atur transaksi rutin (gaji, sewa, langganan)\n"
+        "/cari - Cari transaksi\n"
+        "/riwayat - Lihat riwayat transaksi\n"
+        "/sheet - Dapatkan link Google Sheet\n"
+        "/hapus - Hapus data keuangan\n"
+        "/batal - Batalkan penghapusan terakhir\n"
+        "/help - Bantuan lengkap\n\n"
+        "Atau cukup kirim pesan seperti:\n"
+        "• 'Beli makan siang 50000' (pengeluaran)\n"
+        "• 'Terima gaji bulan ini 5000000' (pemasukan)\n\n"
+        "Bot akan otomatis mendeteksi apakah itu pemasukan atau pengeluaran."
+    )
+
+async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    # Check if we're in delete state, manual entry or processing a financial message
+    session = get_session(context.user_data)
+    if session.delete_state is not None:
+        await handle_date_input(update, context)
+    elif session.transaction_type is not None and session.amount is None:
+        await handle_amount_input(update, context)
+    else:
+        message_text = update.message.text
+        print(f"Received message: {message_text}")
+        
+        # Split by newlines and filter out empty lines
+        lines = [line.strip() for line in message_text.split('\n') if line.strip()]
+        print(f"Detected {len(lines)} lines")
+        
+        # If we have multiple lines, process as multiple transactions
+        if len(lines) > 1:
+            transactions = await parse_multiple_transactions(message_text, user_id)
+            print(f"Parsed {len(transactions)} transactions")
+            
+            if not transactions:
+                await update.message.reply_text(
+                    "❌ Saya tidak dapat mengenali transaksi dari pesan Anda.\n"
+                    "Pastikan setiap baris berisi informasi transaksi yang lengkap."
+                )
+                return
+            
+            # Process multiple transactions
+            await process_multiple_transactions(update, context, transactions)
+        else:
+            # Single transaction processing
+            await process_financial_message(update, context)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    help_text = (
+        "🔍 *Cara Menggunakan Bot Keuangan*\n\n"
+        "*Mencatat Transaksi:*\n"
+        "Cukup kirim pesan yang menjelaskan transaksi Anda. Bot akan otomatis mendeteksi apakah itu pemasukan atau pengeluaran.\n\n"
+        "*Contoh Pemasukan:*\n"
+        "• Terima gaji bulan ini 5000000\n"
+        "• Dapat bonus kerja 1500000\n"
+        "• Penjualan barang 250000\n"
+        "• Kiriman dari ibu 500000\n\n"
+        "*Contoh Pengeluaran:*\n"
+        "• Beli makan siang 50000\n"
+        "• Bayar tagihan listrik 350000\n"
+        "• Belanja bulanan di supermarket 750000\n"
+        "• Isi bensin motor 25000\n\n"
+        "*Input Multi-Transaksi:*\n"
+        "Anda dapat mencatat beberapa transaksi sekaligus dengan mengirimkan pesan dengan format:\n\n"
+        "Transaksi 1\n"
+        "Transaksi 2\n"
+        "Transaksi 3\n\n"
+        "Contoh:\n"
+        "Beli makan siang kemarin 50000\n"
+        "Bayar listrik hari ini 350000\n"
+        "Terima gaji 5000000\n\n"
+        "Bot akan menganalisis setiap baris sebagai transaksi terpisah.\n\n"
+        "*Foto Struk:*\n"
+        "Kirim foto struk belanja atau bukti transfer, bot akan membaca total dan tanggalnya.\n\n"
+        "*Perintah Lain:*\n"
+        "/catat - Mulai mencatat transaksi baru\n"
+        "/laporan - Lihat laporan keuangan Anda\n"
+        "/grafik - Lihat grafik pengeluaran dan tren bulanan\n"
+        "/analisis - Perubahan bulanan, rata-rata per kategori, pola harian, dan peringatan pengeluaran tidak biasa\n"
+        "/anggaran [kategori] [jumlah] - Atur anggaran bulanan (peringatan di 80% dan 100%)\n"
+        "/rutin - Atur transaksi rutin harian, mingguan, atau bulanan\n"
+        "/cari [kata] - Cari transaksi berdasarkan deskripsi atau kategori\n"
+        "/riwayat - Telusuri riwayat transaksi per halaman\n"
+        "/batal - Pulihkan transaksi yang terakhir dihapus\n"
+        "/help - Tampilkan bantuan ini\n\n"
+        "*Pengaturan Bot:*\n"
+        "/hapuspesan - Aktifkan/nonaktifkan penghapusan pesan otomatis\n"
+        "/ringkasan - Aktifkan/nonaktifkan ringkasan mingguan dan bulanan\n\n"
+    )
+    
+    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+async def record_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "Silakan kirim detail transaksi Anda.\n"
+        "Format: [deskripsi] [jumlah]\n"
+        "Contoh: 'Beli makan siang 50000' atau 'Gaji bulan ini 5000000'"
+    )
+
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    # Reuse the rendered report while the user's data is unchanged
+    cached_report = rendered_cache.get(user_id, 'report')
+    if cached_report is not None:
+        await update.message.reply_text(cached_report, parse_mode='Markdown')
+        return
+    
+    await update.message.reply_text("📊 Mengambil data laporan keuangan Anda...")
+    
+    try:
+        version = get_ledger_version(user_id)
+        
+        # Get the user's records from the ledger
+        user_records = await asyncio.to_thread(storage.query, user_id)
+        
+        if not user_records:
+            await update.message.reply_text("❌ Anda belum memiliki catatan keuangan.")
+            return
+        
+        # Refresh the month-to-date budget totals from the records already read
+        seed_month_totals(context.user_data, user_records)
+        
+        # Calculate summary
+        total_income = sum(float(record['Amount']) for record in user_records if float(record['Amount']) > 0)
+        total_expense = sum(abs(float(record['Amount'])) for record in user_records if float(record['Amount']) < 0)
+        balance = total_income - total_expense
+        
+        # Create report message
+        report_message = f"📊 *Laporan Keuangan*\n\n"
+        report_message += f"Total Pemasukan: Rp {total_income:,.0f}\n"
+        report_message += f"Total Pengeluaran: Rp {total_expense:,.0f}\n"
+        report_message += f"Saldo: Rp {balance:,.0f}\n\n"
+        
+        # Add category breakdown for expenses
+        expense_by_category = {}
+        for record in user_records:
+            amount = float(record['Amount'])
+            if amount < 0:  # It's an expense
+                category = canonicalize_category(record.get('Category', 'Lainnya'))
+                if category in expense_by_category:
+                    expense_by_category[category] += abs(amount)
+                else:
+                    expense_by_category[category] = abs(amount)
+        
+        if expense_by_category:
+            report_message += "*Pengeluaran per Kategori:*\n"
+            for category, amount in sorted(expense_by_category.items(), key=lambda x: x[1], reverse=True):
+                percentage = (amount / total_expense) * 100 if total_expense > 0 else 0
+                report_message += f"• {category}: Rp {amount:,.0f} ({percentage:.1f}%)\n"
+            
+            report_message += "\n"
+        
+        # Add recent transactions
+        report_message += "*Transaksi Terakhir:*\n"
+        
+        # Take the 5 most recent transactions (newest first) from the index
+        transaction_index.ensure_loaded()
+        recent_transactions, _, _ = transaction_index.page(user_id, 5)
+        
+        for record in recent_transactions:
+            try:
+                amount = float(record['Amount'])
+                symbol = "+" if amount >= 0 else "-"
+                date = record.get('Date', '')
+                category = record.get('Category', 'Lainnya')
+                description = record.get('Description', '')
+                
+                # Truncate description if too long
+                if len(description) > 20:
+                    description = description[:17] + "..."
+                
+                report_message += f"• {date} | {symbol} Rp {abs(amount):,.0f} | {category} | {description}\n"
+            except Exception as e:
+                # Skip this record if there's an error
+                continue
+        
+        # Send the report
+        rendered_cache.put(user_id, 'report', report_message, version)
+        await update.message.reply_text(report_message, parse_mode='Markdown')
+        
+    except Exception as e:
+        logger.error(f"Error generating report: {e}")
+        await update.message.reply_text(
+            "❌ Terjadi kesalahan saat mengambil laporan keuangan Anda. "
+            "Silakan coba lagi nanti."
+        )
+
+def category_key(category):
+    """Normalize a category name for budget lookups."""
+    return canonicalize_category(category).lower()
+
+def get_month_totals(user_data, user_id=None):
+    """Return this month's spending per category.
+    
+    Totals that are not seeded yet are computed from the user's records in
+    the in-memory index when `user_id` is given; otherwise None is returned.
+    Callers seed them before the index reflects the change they apply.
+    """
+    month = datetime.now().strftime("%Y-%m")
+    month_totals = user_data.get('month_totals')
+    if month_totals is None:
+        if user_id is None:
+            return None
+        seed_month_totals(user_data, transaction_index.user_records(user_id))
+        month_totals = user_data['month_totals']
+    
+    if month_totals['month'] != month:
+        # Totals have been tracked continuously, so a new month starts from zero
+        month_totals = {'month': month, 'totals': {}}
+        user_data['month_totals'] = month_totals
+    
+    return month_totals['totals']
+
+def seed_month_totals(user_data, user_records):
+    """Compute month-to-date spending per category from records already read."""
+    month = datetime.now().strftime("%Y-%m")
+    totals = {}
+    for record in user_records:
+        if str(record.get('Date', ''))[:7] != month:
+            continue
+        try:
+            amount = float(record.get('Amount', 0))
+        except (TypeError, ValueError):
+            continue
+        if amount < 0:
+            key = category_key(record.get('Category'))
+            totals[key] = totals.get(key, 0) + abs(amount)
+    
+    user_data['month_totals'] = {'month': month, 'totals': totals}
+
+def update_month_totals(user_data, date, amount, category, removed=False, user_id=None):
+    """Apply one written or deleted expense to the month-to-date totals."""
+    totals = get_month_totals(user_data, user_id)
+    if totals is None or str(date)[:7] != datetime.now().strftime("%Y-%m"):
+        return
+    
+    amount = float(amount or 0)
+    if amount >= 0:
+        return
+    
+    key = category_key(category)
+    change = -abs(amount) if removed else abs(amount)
+    totals[key] = max(totals.get(key, 0) + change, 0)
+
+def remove_from_month_totals(user_data, user_id, records):
+    """Take deleted sheet records out of the month-to-date totals."""
+    for record in records:
+        try:
+            update_month_totals(
+                user_data, record.get('Date', ''), record.get('Amount', 0),
+                record.get('Category'), removed=True, user_id=user_id
+            )
+        except (TypeError, ValueError):
+            continue
+
+def check_budgets(user_data, rows):
+    """Add appended rows to the month-to-date totals and return budget warnings.
+    
+    Rows use the sheet layout [date, amount, category, description, user id,
+    timestamp]. No sheet reads are needed, the totals are kept incrementally.
+    """
+    budgets = user_data.get('budgets', {})
+    totals = get_month_totals(user_data, rows[0][4]) if rows else None
+    
+    warnings = []
+    for row in rows:
+        date, amount, category = row[0], row[1], row[2]
+        key = category_key(category)
+        before = totals.get(key, 0) if totals is not None else 0
+        update_month_totals(user_data, date, amount, category)
+        
+        if key not in budgets or totals is None:
+            continue
+        
+        name, limit = budgets[key]
+        after = totals.get(key, 0)
+        if before < limit <= after:
+            warnings.append(
+                f"🚨 Anggaran {name} terlampaui!\n"
+                f"Terpakai Rp {after:,.0f} dari Rp {limit:,.0f} ({after / limit * 100:.0f}%)."
+            )
+        elif before < limit * BUDGET_WARNING_RATIO <= after:
+            warnings.append(
+                f"⚠️ Pengeluaran {name} sudah {after / limit * 100:.0f}% dari anggaran bulan ini.\n"
+                f"Terpakai Rp {after:,.0f} dari Rp {limit:,.0f}."
+            )
+    
+    return warnings
+
+async def send_budget_warnings(context: ContextTypes.DEFAULT_TYPE, chat_id, warnings):
+    for warning in warnings:
+        await context.bot.send_message(chat_id=chat_id, text=warning)
+
+async def budget_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    budgets = context.user_data.setdefault('budgets', {})
+    
+    # Seed the month-to-date totals once; afterwards they are kept incrementally
+    if get_month_totals(context.user_data) is None:
+        month_start = date.today().replace(day=1).isoformat()
+        totals = {}
+        expense_totals = await asyncio.to_thread(storage.expense_totals, user_id, month_start)
+        for category, amount in expense_totals.items():
+            totals[category_key(category)] = totals.get(category_key(category), 0) + amount
+        context.user_data['month_totals'] = {'month': month_start[:7], 'totals': totals}
+    
+    if not context.args:
+        if not budgets:
+            await update.message.reply_text(
+                "💰 Anda belum memiliki anggaran.\n\n"
+                "Atur anggaran bulanan dengan:\n"
+                "/anggaran [kategori] [jumlah]\n"
+                "Contoh: /anggaran Makanan 2000000"
+            )
+            return
+        
+        totals = get_month_totals(context.user_data)
+        message = "💰 *Anggaran Bulan Ini*\n\n"
+        for key, (name, limit) in sorted(budgets.items()):
+            spent = totals.get(key, 0)
+            message += f"• {name}: Rp {spent:,.0f} / Rp {limit:,.0f} ({spent / limit * 100:.0f}%)\n"
+        
+        await update.message.reply_text(message, parse_mode='Markdown')
+        return
+    
+    amount = extract_amount(context.args[-1]) if len(context.args) >= 2 else None
+    if amount is None:
+        await update.message.reply_text(
+            "❌ Format tidak valid.\n"
+            "Gunakan: /anggaran [kategori] [jumlah]\n"
+            "Contoh: /anggaran Makanan 2000000"
+        )
+        return
+    
+    name = canonicalize_category(" ".join(context.args[:-1]))
+    key = category_key(name)
+    
+    if amount == 0:
+        budgets.pop(key, None)
+        await update.message.reply_text(f"🗑️ Anggaran {name} dihapus.")
+        return
+    
+    budgets[key] = (name, amount)
+    await update.message.reply_text(f"✅ Anggaran {name} diatur: Rp {amount:,.0f} per bulan.")
+
+WEEKDAY_LABELS = ["Senin", "Selasa", "Rabu", "Kamis", "Jumat", "Sabtu", "Minggu"]
+
+def recurring_due_dates(rule, after, until):
+    """Yield the dates in (after, until] on which a recurring rule is due."""
+    day = after + timedelta(days=1)
+    while day <= until:
+        if rule['frequency'] == 'harian':
+            yield day
+        elif rule['frequency'] == 'mingguan':
+            if day.weekday() == rule['day']:
+                yield day
+        elif rule['frequency'] == 'bulanan':
+            # Rules for the 29th-31st fall on the last day of shorter months
+            next_month = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+            last_day = (next_month - timedelta(days=1)).day
+            if day.day == min(rule['day'], last_day):
+                yield day
+        day += timedelta(days=1)
+
+def describe_recurring_rule(rule):
+    if rule['frequency'] == 'harian':
+        schedule = "Setiap hari"
+    elif rule['frequency'] == 'mingguan':
+        schedule = f"Setiap {WEEKDAY_LABELS[rule['day']]}"
+    else:
+        schedule = f"Setiap tanggal {rule['day']}"
     
-    # Process each line as a separate transaction
-    transactions = []
-    for i, line in enumerate(lines):
+    transaction_type = "Pemasukan" if rule['amount'] > 0 else "Pengeluaran"
+    return f"{schedule} | {transaction_type} Rp {abs(rule['amount']):,.0f} | {rule['category']} | {rule['description']}"
+
+async def recurring_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    rules = context.user_data.setdefault('recurring_rules', [])
+    args = context.args
+    usage = (
+        "Format:\n"
+        "/rutin harian [deskripsi] [jumlah]\n"
+        "/rutin mingguan [hari] [deskripsi] [jumlah]\n"
+        "/rutin bulanan [tanggal] [deskripsi] [jumlah]\n"
+        "/rutin hapus [nomor]\n\n"
+        "Contoh: /rutin bulanan 1 Bayar sewa kos 1500000"
+    )
+    
+    if not args:
+        if not rules:
+            await update.message.reply_text("🔁 Anda belum memiliki transaksi rutin.\n\n" + usage)
+            return
+        
+        message = "🔁 Transaksi Rutin\n\n"
+        for rule in rules:
+            message += f"{rule['id']}. {describe_recurring_rule(rule)}\n"
+        await update.message.reply_text(message + "\n" + usage)
+        return
+    
+    frequency = args[0].lower()
+    
+    if frequency == "hapus":
+        remaining = [rule for rule in rules if len(args) < 2 or str(rule['id']) != args[1]]
+        if len(remaining) == len(rules):
+            await update.message.reply_text("❌ Transaksi rutin tidak ditemukan.")
+            return
+        context.user_data['recurring_rules'] = remaining
+        await update.message.reply_text("🗑️ Transaksi rutin dihapus.")
+        return
+    
+    if frequency not in ('harian', 'mingguan', 'bulanan'):
+        await update.message.reply_text("❌ Format tidak valid.\n\n" + usage)
+        return
+    
+    day = None
+    text_args = args[1:]
+    if frequency == 'mingguan':
+        day = WEEKDAY_NAMES.get(text_args[0].lower()) if text_args else None
+        text_args = text_args[1:]
+    elif frequency == 'bulanan':
+        day = int(text_args[0]) if text_args and text_args[0].isdigit() else None
+        if day is not None and not 1 <= day <= 31:
+            day = None
+        text_args = text_args[1:]
+    
+    # Reuse the local parser for amount, transaction type and category
+    parsed = parse_financial_data_locally(" ".join(text_args))
+    if (frequency != 'harian' and day is None) or not parsed['amount']:
+        await update.message.reply_text("❌ Format tidak valid.\n\n" + usage)
+        return
+    
+    next_id = context.user_data.get('recurring_next_id', 1)
+    context.user_data['recurring_next_id'] = next_id + 1
+    
+    rule = {
+        'id': next_id,
+        'frequency': frequency,
+        'day': day,
+        'amount': parsed['amount'],
+        'category': parsed['category'],
+        'description': parsed['description'],
+        # The first entry is posted on the next due date after today
+        'last_run': date.today().isoformat()
+    }
+    rules.append(rule)
+    
+    await update.message.reply_text(
+        "✅ Transaksi rutin ditambahkan!\n\n"
+        f"{describe_recurring_rule(rule)}\n\n"
+        "Transaksi akan dicatat otomatis pada setiap jadwal."
+    )
+
+async def materialize_recurring_transactions(context: ContextTypes.DEFAULT_TYPE):
+    """Post every due recurring transaction of all users in one append_rows call.
+    
+    Each generated row carries a deterministic ID (rule and due date), and
+    IDs already present in the sheet are skipped, so a run repeated after a
+    restart never posts the same entry twice. The advanced last_run is
+    persisted, so entries deleted since are not posted again either.
+    """
+    today = date.today()
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    rows = []
+    for user_id, user_data in list(context.application.user_data.items()):
+        for rule in user_data.get('recurring_rules', []):
+            after = max(date.fromisoformat(rule['last_run']), today - timedelta(days=RECURRING_MAX_CATCHUP_DAYS))
+            for due in recurring_due_dates(rule, after, today):
+                row = [
+                    due.isoformat(),
+                    rule['amount'],
+                    rule['category'],
+                    rule['description'],
+                    user_id,
+                    timestamp,
+                    f"rutin-{user_id}-{rule['id']}-{due.isoformat()}",
+                    ''
+                ]
+                rows.append(row)
+    
+    new_rows = []
+    if rows:
+        # Skip entries that an earlier, interrupted run already wrote
+        new_rows = await asyncio.to_thread(append_missing, storage, rows)
+        
+        if new_rows:
+            logger.info(f"Posted {len(new_rows)} recurring transactions")
+    
+    # Only advance the schedule once the rows are safely written
+    advanced_user_ids = []
+    for user_id, user_data in list(context.application.user_data.items()):
+        for rule in user_data.get('recurring_rules', []):
+            rule['last_run'] = today.isoformat()
+        if user_data.get('recurring_rules'):
+            advanced_user_ids.append(user_id)
+    
+    # Jobs touch user_data outside an update, so PTB would not persist it;
+    # a restart then resumes from the advanced last_run
+    context.application.mark_data_for_update_persistence(user_ids=advanced_user_ids)
+    
+    new_rows_by_user = {}
+    for row in new_rows:
+        new_rows_by_user.setdefault(row[4], []).append(row)
+    
+    # Budgets first: missing totals are seeded from the index without these rows
+    budget_warnings_by_user = {
+        user_id: check_budgets(context.application.user_data[user_id], user_rows)
+        for user_id, user_rows in new_rows_by_user.items()
+    }
+    transaction_index.add_rows(new_rows)
+    duplicate_index.add_rows(new_rows)
+    
+    for user_id, user_rows in new_rows_by_user.items():
+        invalidate_user_data(user_id)
+        budget_warnings = budget_warnings_by_user[user_id]
+        
         try:
-            print(f"Parsing line {i+1}: {line}")
-            transaction_data = await parse_financial_data(line)
-            print(f"Parsed data: {transaction_data}")
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"🔁 {len(user_rows)} transaksi rutin telah dicatat otomatis."
+            )
+            await send_budget_warnings(context, user_id, budget_warnings)
+        except Exception as e:
+            logger.error(f"Error notifying user {user_id} about recurring transactions: {e}")
+
+class RateLimitedSender:
+    """Send many messages while staying under Telegram's broadcast limit.
+    
+    Messages are spaced 1 / rate seconds apart; a RetryAfter from Telegram
+    pauses sending for the requested time before retrying.
+    """
+    
+    def __init__(self, bot, rate):
+        self.bot = bot
+        self.interval = 1 / rate
+        self.next_send = 0
+    
+    async def send(self, chat_id, text, **kwargs):
+        """Send one message and return whether it was delivered."""
+        for attempt in range(3):
+            delay = self.next_send - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_send = max(self.next_send, time.monotonic()) + self.interval
             
-            # Only include transactions where an amount could be determined
-            if transaction_data.get('amount') is not None:
-                transactions.append(transaction_data)
-                print(f"Added transaction {i+1}")
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.next_send = time.monotonic() + retry_after
+            except Forbidden:
+                # The user blocked the bot
+                return False
+            except Exception as e:
+                logger.error(f"Error sending message to {chat_id}: {e}")
+                return False
+        
+        return False
+
+DIGEST_TITLES = {'weekly': "Ringkasan Mingguan", 'monthly': "Ringkasan Bulanan"}
+
+def digest_periods(today):
+    """Return the (kind, first day, last day) periods whose digest is due today."""
+    periods = []
+    if today.weekday() == 0:
+        periods.append(('weekly', today - timedelta(days=7), today - timedelta(days=1)))
+    if today.day == 1:
+        last_day = today - timedelta(days=1)
+        periods.append(('monthly', last_day.replace(day=1), last_day))
+    return periods
+
+def summarize_periods(records, periods):
+    """Compute every user's totals for each period in a single pass over the records.
+    
+    Returns {(user ID, kind): {'income', 'expense', 'count', 'categories'}}.
+    """
+    bounds = [(kind, start.isoformat(), end.isoformat()) for kind, start, end in periods]
+    summaries = {}
+    for record in records:
+        record_date = str(record.get('Date', ''))
+        try:
+            amount = float(record.get('Amount', 0))
+        except (TypeError, ValueError):
+            continue
+        
+        for kind, start, end in bounds:
+            if not start <= record_date <= end:
+                continue
+            
+            summary = summaries.setdefault(
+                (str(record.get('User ID')), kind),
+                {'income': 0, 'expense': 0, 'count': 0, 'categories': {}}
+            )
+            summary['count'] += 1
+            if amount >= 0:
+                summary['income'] += amount
             else:
-                print(f"Skipping line {i+1} - no amount detected")
-        except Exception as e:
-            print(f"Error parsing line {i+1}: {e}")
-            logger.error(f"Error parsing transaction line '{line}': {e}")
-            # Continue with other lines even if one fails
+                summary['expense'] += abs(amount)
+                category = canonicalize_category(record.get('Category'))
+                summary['categories'][category] = summary['categories'].get(category, 0) + abs(amount)
+    
+    return summaries
+
+def format_digest(kind, start, end, summary):
+    message = (
+        f"📬 *{DIGEST_TITLES[kind]}* ({start.strftime('%d/%m/%Y')} - {end.strftime('%d/%m/%Y')})\n\n"
+        f"Pemasukan: Rp {summary['income']:,.0f}\n"
+        f"Pengeluaran: Rp {summary['expense']:,.0f}\n"
+        f"Selisih: Rp {summary['income'] - summary['expense']:,.0f}\n"
+        f"Jumlah transaksi: {summary['count']}\n"
+    )
+    
+    top_categories = sorted(summary['categories'].items(), key=lambda item: item[1], reverse=True)[:DIGEST_TOP_CATEGORIES]
+    if top_categories:
+        message += "\n*Pengeluaran terbesar:*\n"
+        for category, amount in top_categories:
+            percentage = amount / summary['expense'] * 100 if summary['expense'] else 0
+            message += f"• {category}: Rp {amount:,.0f} ({percentage:.1f}%)\n"
+    
+    return message
+
+async def send_digests(context: ContextTypes.DEFAULT_TYPE):
+    """Daily job: push the weekly (Mondays) and monthly (1st) summaries.
+    
+    The ledger is read once and all users' totals are grouped in one pass;
+    messages then go out through a rate-limited sender.
+    """
+    periods = digest_periods(date.today())
+    if not periods:
+        return
+    
+    records = await asyncio.to_thread(storage.load_records)
+    summaries = summarize_periods(records, periods)
+    
+    # One message per user, even when both digests are due on the same day
+    messages = {}
+    for kind, start, end in periods:
+        for (user_key, summary_kind), summary in summaries.items():
+            if summary_kind == kind:
+                messages.setdefault(user_key, []).append(format_digest(kind, start, end, summary))
+    
+    sender = RateLimitedSender(context.bot, DIGEST_SEND_RATE)
+    sent_count = 0
+    for user_key, sections in messages.items():
+        if not is_authorized(user_key):
+            continue
+        try:
+            user_data = context.application.user_data.get(int(user_key), {})
+        except ValueError:
+            continue
+        if not user_data.get('digest', True):
             continue
+        
+        if await sender.send(int(user_key), "\n".join(sections), parse_mode='Markdown'):
+            sent_count += 1
     
-    print(f"Returning {len(transactions)} parsed transactions")
-    return transactions
+    logger.info(f"Sent {sent_count} digests")
 
-# Command handlers
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def toggle_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check authorization
@@ -888,23 +3653,68 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
         return
     
-    # Original handler code
+    # Toggle the setting (digests are on by default)
+    context.user_data['digest'] = not context.user_data.get('digest', True)
+    
+    status = "AKTIF" if context.user_data['digest'] else "NONAKTIF"
     await update.message.reply_text(
-        "👋 Selamat datang di Bot Pencatatan Keuangan!\n\n"
-        "Gunakan bot ini untuk mencatat keuangan Anda. Data akan disimpan di Google Sheets.\n\n"
-        "Perintah:\n"
-        "/catat - Catat transaksi baru\n"
-        "/laporan - Lihat laporan keuangan\n"
-        "/sheet - Dapatkan link Google Sheet\n"
-        "/hapus - Hapus data keuangan\n"
-        "/help - Bantuan lengkap\n\n"
-        "Atau cukup kirim pesan seperti:\n"
-        "• 'Beli makan siang 50000' (pengeluaran)\n"
-        "• 'Terima gaji bulan ini 5000000' (pemasukan)\n\n"
-        "Bot akan otomatis mendeteksi apakah itu pemasukan atau pengeluaran."
+        f"📬 Ringkasan otomatis: {status}\n\n"
+        f"{'Ringkasan mingguan dikirim setiap Senin dan ringkasan bulanan setiap tanggal 1.' if context.user_data['digest'] else 'Ringkasan tidak akan dikirim.'}"
     )
 
-async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def encode_history_cursor(key):
+    return f"{key[0]}_{key[1]}"
+
+def decode_history_cursor(cursor):
+    timestamp, record_id = cursor.split("_", 1)
+    return (timestamp, record_id)
+
+def render_history_page(user_id, mode, before=None, after=None):
+    """Render a page of the transaction history as message text and keyboard.
+    
+    mode 'v' lists the transactions in the text, mode 'd' shows them as
+    buttons that delete the transaction. Page boundaries are passed as
+    cursors in the callback data, so no records are kept in user_data.
+    """
+    transaction_index.ensure_loaded()
+    records, has_older, has_newer = transaction_index.page(user_id, HISTORY_PAGE_SIZE, before, after)
+    
+    if not records:
+        return "❌ Anda belum memiliki catatan keuangan.", None
+    
+    keyboard = []
+    if mode == 'd':
+        text = "Pilih transaksi yang ingin dihapus:"
+        for record in records:
+            keyboard.append([InlineKeyboardButton(
+                format_transaction_label(record), callback_data=f"del_specific_{record['ID']}"
+            )])
+    else:
+        text = "📜 Riwayat Transaksi\n\n"
+        for record in records:
+            amount = float(record.get('Amount', 0) or 0)
+            symbol = "+" if amount >= 0 else "-"
+            text += (
+                f"• {record.get('Date', '')} | {symbol} Rp {abs(amount):,.0f} | "
+                f"{record.get('Category', 'Lainnya')} | {record.get('Description', '')}\n"
+            )
+    
+    navigation = []
+    if has_newer:
+        cursor = encode_history_cursor(history_key(records[0]))
+        navigation.append(InlineKeyboardButton("⬅️ Lebih baru", callback_data=f"hist_{mode}_n_{cursor}"))
+    if has_older:
+        cursor = encode_history_cursor(history_key(records[-1]))
+        navigation.append(InlineKeyboardButton("Lebih lama ➡️", callback_data=f"hist_{mode}_o_{cursor}"))
+    if navigation:
+        keyboard.append(navigation)
+    
+    if mode == 'd':
+        keyboard.append([InlineKeyboardButton("❌ Batal", callback_data="delete_cancel")])
+    
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check authorization
@@ -912,78 +3722,399 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
         return
     
-    # Check if we're in delete state or processing a financial message
-    if 'delete_state' in context.user_data:
-        await handle_date_input(update, context)
+    text, reply_markup = render_history_page(user_id, 'v')
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await query.answer("Anda tidak memiliki akses untuk menggunakan bot ini.", show_alert=True)
+        return
+    
+    await query.answer()
+    
+    # hist_<mode>_<n|o>_<cursor>: newer or older than the cursor
+    _, mode, direction, cursor = query.data.split("_", 3)
+    key = decode_history_cursor(cursor)
+    
+    if direction == "n":
+        text, reply_markup = render_history_page(user_id, mode, after=key)
     else:
-        message_text = update.message.text
-        print(f"Received message: {message_text}")
+        text, reply_markup = render_history_page(user_id, mode, before=key)
+    
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+def render_search_page(user_id, query, page):
+    """Render one page of search results as message text and keyboard."""
+    transaction_index.ensure_loaded()
+    results = transaction_index.search(user_id, query)
+    
+    if not results:
+        return f"🔍 Tidak ada transaksi yang cocok dengan '{query}'.", None
+    
+    page_count = (len(results) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    page = max(0, min(page, page_count - 1))
+    page_results = results[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]
+    
+    total = sum(float(record.get('Amount', 0) or 0) for record in results)
+    text = (
+        f"🔍 {len(results)} transaksi cocok dengan '{query}' (total Rp {total:,.0f})\n"
+        f"Halaman {page + 1} dari {page_count}. Ketuk transaksi untuk menghapusnya."
+    )
+    
+    keyboard = [
+        [InlineKeyboardButton(format_transaction_label(record), callback_data=f"cari_del_{page}_{record['ID']}")]
+        for record in page_results
+    ]
+    
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Sebelumnya", callback_data=f"cari_page_{page - 1}"))
+    if page < page_count - 1:
+        navigation.append(InlineKeyboardButton("Berikutnya ➡️", callback_data=f"cari_page_{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("❌ Tutup", callback_data="cari_close")])
+    
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    query = " ".join(context.args).strip()
+    if not query:
+        await update.message.reply_text(
+            "🔍 Cari transaksi berdasarkan deskripsi atau kategori.\n\n"
+            "Format: /cari [kata]\n"
+            "Contoh: /cari bensin"
+        )
+        return
+    
+    get_session(context.user_data).search_query = query
+    text, reply_markup = render_search_page(user_id, query, 0)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await query.answer("Anda tidak memiliki akses untuk menggunakan bot ini.", show_alert=True)
+        return
+    
+    await query.answer()
+    session = get_session(context.user_data)
+    
+    if query.data == "cari_close":
+        session.search_query = None
+        await query.edit_message_text("🔍 Pencarian ditutup.")
+        return
+    
+    search_query = session.search_query
+    if not search_query:
+        await query.edit_message_text("❌ Pencarian sudah kedaluwarsa. Silakan gunakan /cari lagi.")
+        return
+    
+    _, action, page, *record_id = query.data.split("_", 3)
+    page = int(page)
+    prefix = ""
+    
+    if action == "del":
+        record = transaction_index.records.get(record_id[0])
+        if record is not None and str(record.get('User ID')) == str(user_id) and \
+                await delete_transactions(context.user_data, user_id, [record]):
+            prefix = f"✅ Dihapus: {format_transaction_label(record)}\n\n"
+        else:
+            prefix = "❌ Transaksi tidak ditemukan.\n\n"
+    
+    text, reply_markup = render_search_page(user_id, search_query, page)
+    await query.edit_message_text(prefix + text, reply_markup=reply_markup)
+
+async def category_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ Maaf, perintah ini hanya untuk admin.")
+        return
+    
+    usage = (
+        "Format:\n"
+        "/kategori - Lihat kategori yang tercatat\n"
+        "/kategori rapikan - Ubah semua kategori lama ke nama bakunya\n"
+        "/kategori gabung [lama1], [lama2] > [baru] - Gabungkan kategori"
+    )
+    text = " ".join(context.args).strip()
+    
+    if not text:
+        transaction_index.ensure_loaded()
+        counts = {}
+        for record in transaction_index.records.values():
+            label = str(record.get('Category', ''))
+            counts[label] = counts.get(label, 0) + 1
         
-        # Split by newlines and filter out empty lines
-        lines = [line.strip() for line in message_text.split('\n') if line.strip()]
-        print(f"Detected {len(lines)} lines")
+        message = "🏷️ Kategori Tercatat\n\n"
+        for label, count in sorted(counts.items(), key=lambda x: x[1], reverse=True):
+            canonical = canonicalize_category(label)
+            mapping = f" → {canonical}" if canonical != label else ""
+            message += f"• {label or '(kosong)'}: {count}{mapping}\n"
         
-        # If we have multiple lines, process as multiple transactions
-        if len(lines) > 1:
-            transactions = await parse_multiple_transactions(message_text)
-            print(f"Parsed {len(transactions)} transactions")
-            
-            if not transactions:
-                await update.message.reply_text(
-                    "❌ Saya tidak dapat mengenali transaksi dari pesan Anda.\n"
-                    "Pastikan setiap baris berisi informasi transaksi yang lengkap."
-                )
-                return
-            
-            # Process multiple transactions
-            await process_multiple_transactions(update, context, transactions)
-        else:
-            # Single transaction processing
-            await process_financial_message(update, context)
+        await update.message.reply_text(message + "\n" + usage)
+        return
+    
+    if text.lower().startswith("gabung"):
+        sources, _, target = text[len("gabung"):].partition(">")
+        target = target.strip()
+        sources = [source.strip().lower() for source in sources.split(",") if source.strip()]
+        if not target or not sources:
+            await update.message.reply_text("❌ Format tidak valid.\n\n" + usage)
+            return
+        
+        # Remember the merge so later writes use the new name as well
+        target = canonicalize_category(target)
+        merged_aliases = {source: target for source in sources}
+        context.bot_data.setdefault('category_aliases', {}).update(merged_aliases)
+        add_category_aliases(merged_aliases)
+    elif text.lower() != "rapikan":
+        await update.message.reply_text("❌ Format tidak valid.\n\n" + usage)
+        return
+    
+    changed_count = await canonicalize_sheet_categories(context)
+    await update.message.reply_text(f"✅ {changed_count} transaksi diperbarui ke kategori baku.")
+
+async def canonicalize_sheet_categories(context: ContextTypes.DEFAULT_TYPE):
+    """Rewrite every historical category to its canonical name in bulk.
+    
+    Changed categories are found from the in-memory index and written in one
+    batched storage update. Returns the number of changed rows.
+    """
+    transaction_index.ensure_loaded()
+    changes = {}
+    for record_id, record in transaction_index.records.items():
+        label = str(record.get('Category', ''))
+        canonical = canonicalize_category(label)
+        if canonical != label:
+            changes[record_id] = canonical
+    
+    if changes:
+        await asyncio.to_thread(storage.update_categories, changes)
+        
+        # Category names changed for many users at once, rebuild local state
+        transaction_index.load(await asyncio.to_thread(storage.load_records))
+        for user_key in transaction_index.user_ids:
+            invalidate_user_data(user_key)
+        for user_data in context.application.user_data.values():
+            user_data.pop('month_totals', None)
+    
+    return len(changes)
+
+async def load_category_aliases(application: Application):
+    """Restore category merges saved in bot_data after a restart."""
+    add_category_aliases(application.bot_data.get('category_aliases', {}))
+
+async def post_init(application: Application):
+    """Prepare the event loop and restore saved state before updates arrive."""
+    # Ledger calls run via asyncio.to_thread; one worker per pooled Sheets
+    # connection lets the blocking calls of different users overlap
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=SHEETS_POOL_SIZE))
+    gemini_usage.load()
+    await load_category_aliases(application)
+
+GEMINI_FLOW_LABELS = {
+    'single': "Pesan tunggal",
+    'multi': "Pesan multi-baris",
+    'batch': "Batch lintas pengguna",
+    'receipt': "Foto struk",
+}
+
+async def statistics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔ Maaf, perintah ini hanya untuk admin.")
+        return
+    
+    flows, users = gemini_usage.summarize()
+    if not flows:
+        await update.message.reply_text("📈 Belum ada pemakaian Gemini yang tercatat.")
+        return
+    
+    message = "📈 *Statistik Pemakaian Gemini*\n\n"
+    total_tokens = 0
+    for flow, totals in sorted(flows.items(), key=lambda item: item[1]['prompt_tokens'], reverse=True):
+        requests_count = totals['requests']
+        total_tokens += totals['prompt_tokens'] + totals['response_tokens']
+        message += f"*{GEMINI_FLOW_LABELS.get(flow, flow)}*\n"
+        message += f"• Permintaan: {requests_count:,} (gagal {totals['errors']:,}, parser lokal {totals['bypasses']:,})\n"
+        message += f"• Token: {totals['prompt_tokens']:,.0f} prompt, {totals['response_tokens']:,.0f} respons\n"
+        if requests_count:
+            message += (
+                f"• Per permintaan: {totals['prompt_tokens'] / requests_count:,.0f} prompt, "
+                f"{totals['response_tokens'] / requests_count:,.0f} respons\n"
+                f"• Latensi: rata-rata {totals['latency'] / requests_count:.2f} dtk, maks {totals['max_latency']:.2f} dtk\n"
+            )
+        message += "\n"
+    
+    message += f"*Total token:* {total_tokens:,.0f}\n\n*Pengguna teratas:*\n"
+    for user_key, tokens in sorted(users.items(), key=lambda item: item[1], reverse=True)[:5]:
+        message += f"• {user_key}: {tokens:,.0f} token\n"
+    
+    await update.message.reply_text(message, parse_mode='Markdown')
+
+async def flush_gemini_usage(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job: write the Gemini usage totals to GEMINI_USAGE_FILE."""
+    try:
+        await asyncio.to_thread(gemini_usage.write, gemini_usage.snapshot())
+    except Exception as e:
+        logger.error(f"Error writing Gemini usage: {e}")
+
+async def save_gemini_usage(application: Application):
+    """Write the Gemini usage totals once more on shutdown."""
+    gemini_usage.write(gemini_usage.snapshot())
+
+async def post_shutdown(application: Application):
+    """Save state and stop the chart worker processes when the bot stops."""
+    await save_gemini_usage(application)
+    shutdown_chart_executor()
+
+async def sync_sheet_changes(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job: patch local state with edits made directly in the sheet."""
+    try:
+        changed_users = await sheet_synchronizer.run()
+    except Exception as e:
+        logger.error(f"Error synchronizing sheet changes: {e}")
+        return
+    
+    for user_key in changed_users:
+        invalidate_user_data(user_key)
+        
+        # Month-to-date budget totals are seeded again on the next read
+        try:
+            context.application.user_data.get(int(user_key), {}).pop('month_totals', None)
+        except ValueError:
+            continue
+    
+    if changed_users:
+        logger.info(f"Synchronized sheet changes for {len(changed_users)} users")
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = (
-        "🔍 *Cara Menggunakan Bot Keuangan*\n\n"
-        "*Mencatat Transaksi:*\n"
-        "Cukup kirim pesan yang menjelaskan transaksi Anda. Bot akan otomatis mendeteksi apakah itu pemasukan atau pengeluaran.\n\n"
-        "*Contoh Pemasukan:*\n"
-        "• Terima gaji bulan ini 5000000\n"
-        "• Dapat bonus kerja 1500000\n"
-        "• Penjualan barang 250000\n"
-        "• Kiriman dari ibu 500000\n\n"
-        "*Contoh Pengeluaran:*\n"
-        "• Beli makan siang 50000\n"
-        "• Bayar tagihan listrik 350000\n"
-        "• Belanja bulanan di supermarket 750000\n"
-        "• Isi bensin motor 25000\n\n"
-        "*Input Multi-Transaksi:*\n"
-        "Anda dapat mencatat beberapa transaksi sekaligus dengan mengirimkan pesan dengan format:\n\n"
-        "Transaksi 1\n"
-        "Transaksi 2\n"
-        "Transaksi 3\n\n"
-        "Contoh:\n"
-        "Beli makan siang kemarin 50000\n"
-        "Bayar listrik hari ini 350000\n"
-        "Terima gaji 5000000\n\n"
-        "Bot akan menganalisis setiap baris sebagai transaksi terpisah."
-        "*Perintah Lain:*\n"
-        "/catat - Mulai mencatat transaksi baru\n"
-        "/laporan - Lihat laporan keuangan Anda\n"
-        "/help - Tampilkan bantuan ini"
-        "*Pengaturan Bot:*\n"
-        "/hapuspesan - Aktifkan/nonaktifkan penghapusan pesan otomatis\n\n"
-    )
+async def flush_sheets_mirror(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job: replay SQLite ledger changes onto the Google Sheet replica.
     
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    Consecutive appends are written with one append_rows call, and rows the
+    sheet already holds are skipped, so replaying an entry twice is harmless.
+    Entries are acknowledged only after they were written.
+    """
+    entries = await asyncio.to_thread(storage.pending_mirror, MIRROR_BATCH_SIZE)
+    
+    # Group consecutive appends so each group is one sheet write
+    groups = []
+    for seq, op, payload in entries:
+        if op == 'append' and groups and groups[-1][1] == 'append':
+            groups[-1][0] = seq
+            groups[-1][2].extend(payload)
+        else:
+            groups.append([seq, op, list(payload) if op == 'append' else payload])
+    
+    last_seq = None
+    try:
+        for seq, op, payload in groups:
+            if op == 'append':
+                await asyncio.to_thread(append_missing, sheets_replica, payload)
+            elif op == 'delete':
+                await asyncio.to_thread(sheets_replica.delete, payload['user_id'], set(payload['ids']))
+            elif op == 'restore':
+                await asyncio.to_thread(sheets_replica.restore, payload['user_id'], set(payload['ids']))
+            elif op == 'categories':
+                await asyncio.to_thread(sheets_replica.update_categories, payload)
+            last_seq = seq
+    except Exception as e:
+        logger.error(f"Error mirroring ledger to the sheet: {e}")
+    
+    if last_seq is not None:
+        await asyncio.to_thread(storage.ack_mirror, last_seq)
 
-async def record_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "Silakan kirim detail transaksi Anda.\n"
-        "Format: [deskripsi] [jumlah]\n"
-        "Contoh: 'Beli makan siang 50000' atau 'Gaji bulan ini 5000000'"
-    )
+def append_missing(ledger, rows):
+    """Append the rows whose IDs the ledger does not hold yet; returns them."""
+    ids_by_user = {}
+    for row in rows:
+        ids_by_user.setdefault(row[4], []).append(row[ID_COLUMN - 1])
+    existing_ids = ledger.existing_ids_by_user(ids_by_user)
+    new_rows = [row for row in rows if row[ID_COLUMN - 1] not in existing_ids]
+    if new_rows:
+        ledger.append(new_rows)
+    return new_rows
 
-async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def maintain_sheets_connection(context: ContextTypes.DEFAULT_TYPE):
+    """Periodic job: renew the Sheets access token early and keep a connection warm."""
+    try:
+        if await asyncio.to_thread(sheets_connection.refresh_token, TOKEN_REFRESH_MARGIN):
+            logger.info("Refreshed Google Sheets access token")
+        await asyncio.to_thread(sheets_connection.keep_alive)
+    except Exception as e:
+        logger.warning(f"Error maintaining the Google Sheets connection: {e}")
+
+# Created on first use so worker processes are only started when needed
+chart_executor = None
+
+def get_chart_executor():
+    global chart_executor
+    if chart_executor is None:
+        # Forking would copy the PTB/APScheduler threads and gRPC state into the
+        # workers, which can deadlock them; spawned workers start clean. They
+        # re-run this module's top level, which therefore opens no connections
+        chart_executor = ProcessPoolExecutor(
+            max_workers=CHART_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return chart_executor
+
+def shutdown_chart_executor():
+    global chart_executor
+    if chart_executor is not None:
+        chart_executor.shutdown(cancel_futures=True)
+        chart_executor = None
+
+def summarize_for_chart(user_records):
+    """Aggregate records into the plain data needed by render_spending_chart."""
+    expense_by_category = {}
+    monthly = {}
+    for record in user_records:
+        try:
+            amount = float(record['Amount'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        
+        month = str(record.get('Date', ''))[:7]
+        income, expense = monthly.get(month, (0, 0))
+        if amount < 0:
+            category = canonicalize_category(record.get('Category', 'Lainnya'))
+            expense_by_category[category] = expense_by_category.get(category, 0) + abs(amount)
+            monthly[month] = (income, expense + abs(amount))
+        else:
+            monthly[month] = (income + amount, expense)
+    
+    # Keep the largest categories and fold the rest into "Lainnya"
+    categories = sorted(expense_by_category.items(), key=lambda x: x[1], reverse=True)
+    if len(categories) > CHART_TOP_CATEGORIES:
+        rest = sum(amount for _, amount in categories[CHART_TOP_CATEGORIES - 1:])
+        categories = categories[:CHART_TOP_CATEGORIES - 1] + [("Lainnya", rest)]
+    
+    months = sorted(month for month in monthly if month)[-CHART_MONTHS:]
+    monthly_totals = [(month, monthly[month][0], monthly[month][1]) for month in months]
+    
+    return categories, monthly_totals
+
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Check authorization
@@ -991,82 +4122,231 @@ async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
         return
     
-    await update.message.reply_text("📊 Mengambil data laporan keuangan Anda...")
+    caption = "📈 Grafik keuangan Anda"
+    
+    # Reuse the uploaded image while the user's data is unchanged
+    cached_file_id = rendered_cache.get(user_id, 'chart')
+    if cached_file_id is not None:
+        await update.message.reply_photo(photo=cached_file_id, caption=caption)
+        return
+    
+    await update.message.reply_text("📈 Membuat grafik keuangan Anda...")
     
     try:
-        # Get all records directly from the sheet
-        all_records = sheet.get_all_records()
+        version = get_ledger_version(user_id)
         
-        # Filter records for this user
-        user_records = [record for record in all_records if str(record.get('User ID')) == str(user_id)]
+        # Get the user's records from the ledger
+        user_records = await asyncio.to_thread(storage.query, user_id)
         
         if not user_records:
             await update.message.reply_text("❌ Anda belum memiliki catatan keuangan.")
             return
         
-        # Calculate summary
-        total_income = sum(float(record['Amount']) for record in user_records if float(record['Amount']) > 0)
-        total_expense = sum(abs(float(record['Amount'])) for record in user_records if float(record['Amount']) < 0)
-        balance = total_income - total_expense
+        expense_by_category, monthly_totals = summarize_for_chart(user_records)
         
-        # Create report message
-        report_message = f"📊 *Laporan Keuangan*\n\n"
-        report_message += f"Total Pemasukan: Rp {total_income:,.0f}\n"
-        report_message += f"Total Pengeluaran: Rp {total_expense:,.0f}\n"
-        report_message += f"Saldo: Rp {balance:,.0f}\n\n"
+        # Render in a worker process so the event loop stays responsive
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(
+            get_chart_executor(),
+            render_spending_chart,
+            expense_by_category,
+            monthly_totals,
+            f"Keuangan {update.effective_user.first_name}"
+        )
         
-        # Add category breakdown for expenses
-        expense_by_category = {}
-        for record in user_records:
-            amount = float(record['Amount'])
-            if amount < 0:  # It's an expense
-                category = record.get('Category', 'Lainnya')
-                if category in expense_by_category:
-                    expense_by_category[category] += abs(amount)
-                else:
-                    expense_by_category[category] = abs(amount)
+        message = await update.message.reply_photo(photo=png, caption=caption)
         
-        if expense_by_category:
-            report_message += "*Pengeluaran per Kategori:*\n"
-            for category, amount in sorted(expense_by_category.items(), key=lambda x: x[1], reverse=True):
-                percentage = (amount / total_expense) * 100 if total_expense > 0 else 0
-                report_message += f"• {category}: Rp {amount:,.0f} ({percentage:.1f}%)\n"
-            
-            report_message += "\n"
+        # Telegram keeps the upload, later requests only send its file_id
+        rendered_cache.put(user_id, 'chart', message.photo[-1].file_id, version)
         
-        # Add recent transactions
-        report_message += "*Transaksi Terakhir:*\n"
+    except Exception as e:
+        logger.error(f"Error generating chart: {e}")
+        await update.message.reply_text(
+            "❌ Terjadi kesalahan saat membuat grafik keuangan Anda. "
+            "Silakan coba lagi nanti."
+        )
+
+ISO_DATE_PATTERN = re.compile(r'\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])$')
+
+class LedgerColumns:
+    """Columnar view of one user's expenses as parallel NumPy arrays.
+    
+    `days` holds dates as days since the epoch, `spent` the positive expense
+    amounts and `codes` indexes into the sorted `categories` array.
+    """
+    
+    def __init__(self, records):
+        dates, amounts, categories = [], [], []
+        for record in records:
+            record_date = str(record.get('Date', ''))[:10]
+            if not ISO_DATE_PATTERN.match(record_date):
+                continue
+            try:
+                amount = float(record.get('Amount', 0))
+            except (TypeError, ValueError):
+                continue
+            if amount < 0:
+                dates.append(record_date)
+                amounts.append(-amount)
+                categories.append(str(record.get('Category', 'Lainnya')))
         
-        # Sort transactions by date (newest first)
-        sorted_records = sorted(user_records, key=lambda x: x.get('Timestamp', ''), reverse=True)
+        self.days = np.array(dates, dtype='datetime64[D]').astype(np.int64)
+        self.spent = np.array(amounts, dtype=np.float64)
         
-        # Take the 5 most recent transactions
-        recent_transactions = sorted_records[:5]
+        # Canonicalize each distinct label once rather than once per row
+        labels, label_codes = np.unique(np.array(categories, dtype=str), return_inverse=True)
+        canonical = np.array([canonicalize_category(label) for label in labels], dtype=str)
+        self.categories, canonical_codes = np.unique(canonical, return_inverse=True)
+        self.codes = canonical_codes[label_codes]
+    
+    def __len__(self):
+        return len(self.spent)
+
+def analyze_spending(columns, today):
+    """Compute month-over-month, moving-average, weekday and anomaly figures.
+    
+    Everything is derived from a (month x category) matrix built with a
+    single bincount, so the cost barely grows with the length of the history.
+    """
+    today_day = np.datetime64(today, 'D').astype(np.int64)
+    current_month = np.datetime64(today, 'M').astype(np.int64)
+    
+    # Ignore future-dated rows (e.g. scheduled entries)
+    mask = columns.days <= today_day
+    days, spent, codes = columns.days[mask], columns.spent[mask], columns.codes[mask]
+    if not len(spent):
+        return None
+    
+    months = days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    first_month = months.min()
+    month_count = int(current_month - first_month + 1)
+    category_count = len(columns.categories)
+    
+    matrix = np.bincount(
+        (months - first_month) * category_count + codes,
+        weights=spent,
+        minlength=month_count * category_count
+    ).reshape(month_count, category_count)
+    monthly_totals = matrix.sum(axis=1)
+    
+    # Moving average over the complete months before the current one
+    history = matrix[:-1]
+    window = min(ANALYSIS_WINDOW, len(history))
+    if window:
+        cumulative = np.vstack([np.zeros(category_count), np.cumsum(history, axis=0)])
+        moving = (cumulative[window:] - cumulative[:-window]) / window
+        averages = moving[-1]
+        previous_averages = moving[-2] if len(moving) > 1 else None
+    else:
+        averages = np.zeros(category_count)
+        previous_averages = None
+    
+    # Flag categories whose spending this month is far above their average
+    current = matrix[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(averages > 0, current / averages, 0)
+    anomalies = np.flatnonzero(ratios >= ANOMALY_RATIO)
+    anomalies = anomalies[np.argsort(-ratios[anomalies])]
+    
+    # Average spending per weekday over every calendar day in the history
+    weekdays = (days + 3) % 7  # 1970-01-01 was a Thursday
+    weekday_totals = np.bincount(weekdays, weights=spent, minlength=7)
+    weekday_occurrences = np.bincount((np.arange(days.min(), today_day + 1) + 3) % 7, minlength=7)
+    weekday_averages = weekday_totals / np.maximum(weekday_occurrences, 1)
+    
+    top = np.argsort(-(averages + current))[:ANALYSIS_TOP_CATEGORIES]
+    top = top[(averages[top] + current[top]) > 0]
+    
+    return {
+        'this_month': monthly_totals[-1],
+        'last_month': monthly_totals[-2] if month_count > 1 else None,
+        'window': window,
+        'top': [
+            (
+                str(columns.categories[code]),
+                current[code],
+                averages[code],
+                previous_averages[code] if previous_averages is not None else None
+            )
+            for code in top
+        ],
+        'anomalies': [(str(columns.categories[code]), ratios[code]) for code in anomalies],
+        'weekday_averages': weekday_averages
+    }
+
+def format_analysis(analysis):
+    message = "🔎 *Analisis Pengeluaran*\n\n"
+    
+    message += f"Bulan ini: Rp {analysis['this_month']:,.0f}\n"
+    if analysis['last_month']:
+        change = (analysis['this_month'] - analysis['last_month']) / analysis['last_month'] * 100
+        message += f"Bulan lalu: Rp {analysis['last_month']:,.0f} ({change:+.1f}%)\n"
+    elif analysis['last_month'] is not None:
+        message += "Bulan lalu: Rp 0\n"
+    
+    if analysis['top']:
+        if analysis['window']:
+            message += f"\n*Kategori (bulan ini / rata-rata {analysis['window']} bulan):*\n"
+        else:
+            message += "\n*Kategori bulan ini:*\n"
+        for category, current, average, previous_average in analysis['top']:
+            line = f"• {category}: Rp {current:,.0f}"
+            if analysis['window']:
+                line += f" / Rp {average:,.0f}"
+                if previous_average is not None and previous_average > 0:
+                    trend = "📈" if average > previous_average else "📉" if average < previous_average else "➡️"
+                    line += f" {trend}"
+            message += line + "\n"
+    
+    weekday_averages = analysis['weekday_averages']
+    message += "\n*Rata-rata per Hari:*\n"
+    busiest = int(np.argmax(weekday_averages))
+    for weekday, average in enumerate(weekday_averages):
+        marker = " 🔥" if weekday == busiest and average > 0 else ""
+        message += f"• {WEEKDAY_LABELS[weekday]}: Rp {average:,.0f}{marker}\n"
+    
+    if analysis['anomalies']:
+        message += "\n*Perlu Diperhatikan:*\n"
+        for category, ratio in analysis['anomalies']:
+            message += f"⚠️ Pengeluaran {category} bulan ini {ratio:.1f}× rata-rata\n"
+    
+    return message
+
+async def analysis_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    # Reuse the rendered analysis while the user's data is unchanged
+    cached_analysis = rendered_cache.get(user_id, 'analysis')
+    if cached_analysis is not None:
+        await update.message.reply_text(cached_analysis, parse_mode='Markdown')
+        return
+    
+    await update.message.reply_text("🔎 Menganalisis pengeluaran Anda...")
+    
+    try:
+        version = get_ledger_version(user_id)
         
-        for record in recent_transactions:
-            try:
-                amount = float(record['Amount'])
-                symbol = "+" if amount >= 0 else "-"
-                date = record.get('Date', '')
-                category = record.get('Category', 'Lainnya')
-                description = record.get('Description', '')
-                
-                # Truncate description if too long
-                if len(description) > 20:
-                    description = description[:17] + "..."
-                
-                report_message += f"• {date} | {symbol} Rp {abs(amount):,.0f} | {category} | {description}\n"
-            except Exception as e:
-                # Skip this record if there's an error
-                continue
+        # The in-memory index holds the user's records, no sheet download needed
+        transaction_index.ensure_loaded()
+        columns = LedgerColumns(transaction_index.user_records(user_id))
+        analysis = analyze_spending(columns, date.today()) if len(columns) else None
+        if analysis is None:
+            await update.message.reply_text("❌ Anda belum memiliki catatan pengeluaran.")
+            return
         
-        # Send the report
-        await update.message.reply_text(report_message, parse_mode='Markdown')
+        analysis_message = format_analysis(analysis)
+        rendered_cache.put(user_id, 'analysis', analysis_message, version)
+        await update.message.reply_text(analysis_message, parse_mode='Markdown')
         
     except Exception as e:
-        logger.error(f"Error generating report: {e}")
+        logger.error(f"Error analyzing spending: {e}")
         await update.message.reply_text(
-            "❌ Terjadi kesalahan saat mengambil laporan keuangan Anda. "
+            "❌ Terjadi kesalahan saat menganalisis pengeluaran Anda. "
             "Silakan coba lagi nanti."
         )
 
@@ -1100,16 +4380,77 @@ def detect_transaction_type(text):
     else:
         return "expense"  # Default to expense if tied or no matches
 
+# Keywords for guessing a category when Gemini is unavailable
+LOCAL_CATEGORY_KEYWORDS = {
+    "Gaji": ["gaji", "upah"],
+    "Bonus": ["bonus", "thr", "komisi"],
+    "Investasi": ["dividen", "bunga", "saham", "reksadana"],
+    "Hadiah": ["hadiah", "kado", "warisan", "kiriman dari"],
+    "Makanan": ["makan", "minum", "kopi", "sarapan", "snack", "jajan"],
+    "Transportasi": ["bensin", "ojek", "grab", "gojek", "parkir", "tol", "taksi", "kereta", "bus"],
+    "Tagihan": ["listrik", "air", "pulsa", "internet", "tagihan", "iuran", "cicilan", "sewa"],
+    "Belanja": ["belanja", "beli", "supermarket", "pasar"],
+    "Hiburan": ["nonton", "bioskop", "game", "langganan", "berlangganan"],
+    "Kesehatan": ["obat", "dokter", "apotek", "rumah sakit"],
+    "Pendidikan": ["buku", "kursus", "sekolah", "kuliah", "spp"],
+}
+
+# Date-like fragments that must not be mistaken for amounts
+DATE_FRAGMENT_PATTERN = re.compile(
+    r'\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}|\d+\s+(?:hari|days|minggu|weeks|bulan|months)\b'
+)
+
+# Amounts like "50000", "50.000", "Rp 1,5 jt", "25rb", "10k"
+AMOUNT_PATTERN = re.compile(
+    r'(?:rp\.?\s*)?(\d{1,3}(?:[.,]\d{3})+|\d+)(?:[.,](\d{1,2}))?\s*(rb|ribu|k|jt|juta)?\b'
+)
+
+AMOUNT_MULTIPLIERS = {"rb": 1_000, "ribu": 1_000, "k": 1_000, "jt": 1_000_000, "juta": 1_000_000}
+
+def extract_amount(text):
+    """Extract the largest monetary amount from text, or None."""
+    text = DATE_FRAGMENT_PATTERN.sub(' ', text.lower())
+    
+    amounts = []
+    for match in AMOUNT_PATTERN.finditer(text):
+        whole, fraction, suffix = match.groups()
+        value = float(re.sub(r'[.,]', '', whole))
+        if fraction:
+            value += float(f"0.{fraction}")
+        if suffix:
+            value *= AMOUNT_MULTIPLIERS[suffix]
+        amounts.append(value)
+    
+    return max(amounts) if amounts else None
+
+def parse_financial_data_locally(text):
+    """Parse a transaction without Gemini, used when the circuit breaker is open."""
+    transaction_type = detect_transaction_type(text)
+    amount = extract_amount(text)
+    if amount is not None and transaction_type == 'expense':
+        amount = -amount
+    
+    lowered = text.lower()
+    category = "Lainnya"
+    for name, keywords in LOCAL_CATEGORY_KEYWORDS.items():
+        if any(keyword in lowered for keyword in keywords):
+            category = name
+            break
+    
+    return {
+        "amount": amount,
+        "category": category,
+        "description": text.strip(),
+        "transaction_type": transaction_type,
+        "date": parse_date_from_text(text)
+    }
+
 # Message handler for financial data with improved detection
 async def process_financial_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Store the user's message ID for later deletion
-    if 'messages_to_delete' not in context.user_data:
-        context.user_data['messages_to_delete'] = []
-    
-    # Add the user's message ID to the list
-    context.user_data['messages_to_delete'].append(update.message.message_id)
+    track_message_for_deletion(context.user_data, update.message.message_id)
     
     # Authorization is already checked in the message_handler
     
@@ -1120,22 +4461,26 @@ async def process_financial_message(update: Update, context: ContextTypes.DEFAUL
     
     # If we have multiple lines, process as multiple transactions
     if len(lines) > 1:
-        transactions = await parse_multiple_transactions(message_text)
+        transactions = await parse_multiple_transactions(message_text, user_id)
         
         if not transactions:
             error_message = await update.message.reply_text(
                 "❌ Saya tidak dapat mengenali transaksi dari pesan Anda.\n"
                 "Pastikan setiap baris berisi informasi transaksi yang lengkap."
             )
-            context.user_data['messages_to_delete'].append(error_message.message_id)
+            track_message_for_deletion(context.user_data, error_message.message_id)
             return
         
         # Process multiple transactions
         await process_multiple_transactions(update, context, transactions)
-    else:
-        # Single transaction processing
-        parsed_data = await parse_financial_data(message_text)
+        return
     
+    # Single transaction processing
+    parsed_data = await parse_financial_data(message_text, user_id)
+    await confirm_parsed_transaction(update, context, parsed_data, message_text)
+
+async def confirm_parsed_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE, parsed_data, message_text):
+    """Ask the user to confirm a parsed transaction, or fall back to manual input."""
     # If Gemini couldn't determine a date, try our fallback parser
     if not parsed_data.get('date'):
         parsed_data['date'] = parse_date_from_text(message_text)
@@ -1147,9 +4492,10 @@ async def process_financial_message(update: Update, context: ContextTypes.DEFAUL
              InlineKeyboardButton("Pengeluaran", callback_data="type_expense")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        context.user_data['pending_message'] = message_text
+        session = get_session(context.user_data)
+        session.pending_message = message_text
         # Store the detected date for later use
-        context.user_data['detected_date'] = parsed_data.get('date')
+        session.detected_date = parsed_data.get('date')
         
         await update.message.reply_text(
             "Saya tidak dapat menentukan jumlah transaksi. Apakah ini pemasukan atau pengeluaran?",
@@ -1160,7 +4506,7 @@ async def process_financial_message(update: Update, context: ContextTypes.DEFAUL
     # Create confirmation message with parsed data
     amount = parsed_data.get('amount', 0)
     transaction_type = "Pemasukan" if amount > 0 else "Pengeluaran"
-    category = parsed_data.get('category', 'Lainnya')
+    category = canonicalize_category(parsed_data.get('category'))
     description = parsed_data.get('description', message_text)
     date = parsed_data.get('date')
     
@@ -1177,25 +4523,88 @@ async def process_financial_message(update: Update, context: ContextTypes.DEFAUL
     confirmation_message += f"Jumlah: Rp {abs(amount):,.0f}\n"
     confirmation_message += f"Kategori: {category}\n"
     confirmation_message += f"Deskripsi: {description}\n\n"
+    
+    # Flag a resent message without reading the sheet
+    if duplicate_index.is_duplicate(update.effective_user.id, date, amount, description):
+        confirmation_message += (
+            "⚠️ *Kemungkinan duplikat:* transaksi dengan tanggal, jumlah, dan deskripsi "
+            "yang sama sudah dicatat baru-baru ini.\n\n"
+        )
+    
     confirmation_message += "Apakah data ini benar?"
     
     # Save data temporarily
-    context.user_data['pending_transaction'] = {
+    key = new_idempotency_key()
+    get_session(context.user_data).pending_transaction = {
         'date': date,
         'amount': amount,
         'category': category,
-        'description': description
+        'description': description,
+        'key': key
     }
     
     # Create confirmation buttons
     keyboard = [
-        [InlineKeyboardButton("✅ Benar", callback_data="confirm_yes"),
-         InlineKeyboardButton("❌ Salah", callback_data="confirm_no")]
+        [InlineKeyboardButton("✅ Benar", callback_data=f"confirm_yes_{key}"),
+         InlineKeyboardButton("❌ Salah", callback_data=f"confirm_no_{key}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(confirmation_message, reply_markup=reply_markup, parse_mode='Markdown')
 
+async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
+    # Check authorization
+    if not is_authorized(user_id):
+        await update.message.reply_text("⛔ Maaf, Anda tidak memiliki akses untuk menggunakan bot ini.")
+        return
+    
+    # Store the user's message ID for later deletion
+    track_message_for_deletion(context.user_data, update.message.message_id)
+    
+    caption = update.message.caption or ""
+    
+    unavailable_text = (
+        "⚠️ Pembacaan foto struk sedang tidak tersedia.\n"
+        "Silakan kirim transaksi sebagai teks, misalnya: 'Belanja di supermarket 150000'"
+    )
+    
+    # Photos can only be read by Gemini; don't download them while it is down
+    if not gemini_breaker.available():
+        await update.message.reply_text(unavailable_text)
+        return
+    
+    try:
+        photo_file = await select_receipt_photo(update.message.photo).get_file()
+        image_bytes = await photo_file.download_as_bytearray()
+        jpeg_bytes = await asyncio.to_thread(prepare_receipt_image, bytes(image_bytes))
+    except Exception as e:
+        logger.error(f"Error downloading receipt photo: {e}")
+        await update.message.reply_text(
+            "❌ Saya tidak dapat membaca struk dari foto ini.\n"
+            "Pastikan foto jelas, atau kirim transaksi sebagai teks."
+        )
+        return
+    
+    # Take the breaker slot only now, so a failed download cannot hold the
+    # half-open probe without ever recording an outcome
+    if not gemini_breaker.allow_request():
+        await update.message.reply_text(unavailable_text)
+        return
+    
+    try:
+        parsed_data = await parse_receipt(jpeg_bytes, caption, user_id)
+    except Exception as e:
+        logger.error(f"Error parsing receipt photo: {e}")
+        await update.message.reply_text(
+            "❌ Saya tidak dapat membaca struk dari foto ini.\n"
+            "Pastikan foto jelas, atau kirim transaksi sebagai teks."
+        )
+        return
+    
+    await confirm_parsed_transaction(update, context, parsed_data, parsed_data.get('description') or caption or "Struk")
+
 # Callback query handler
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1207,18 +4616,20 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     await query.answer()
+    session = get_session(context.user_data)
     
     if query.data.startswith("type_"):
         transaction_type = query.data.split("_")[1]
-        message_text = context.user_data.get('pending_message', '')
+        message_text = session.pending_message or ''
         
         # Get the detected date if available, otherwise use today's date
-        detected_date = context.user_data.get('detected_date', datetime.now().strftime("%Y-%m-%d"))
+        detected_date = session.detected_date or datetime.now().strftime("%Y-%m-%d")
         
         # Ask for amount
-        context.user_data['transaction_type'] = transaction_type
-        context.user_data['description'] = message_text
-        context.user_data['date'] = detected_date  # Store the date
+        session.transaction_type = transaction_type
+        session.description = message_text
+        session.amount = None
+        session.date = detected_date  # Store the date
         
         # Format the date for display
         try:
@@ -1236,21 +4647,41 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         is_confirmed = query.data.split("_")[1] == "yes"
         
         if is_confirmed:
+            key = callback_key(query.data, "confirm_yes")
+            if key is not None and key in committed_keys:
+                # Repeated tap or redelivered callback, the row is already written
+                return
+            
             # Get transaction data
-            transaction = context.user_data.get('pending_transaction', {})
+            transaction = session.pending_transaction
+            if not transaction or (key is not None and transaction.get('key') != key):
+                await query.edit_message_text("❌ Transaksi sudah kedaluwarsa. Silakan kirim ulang transaksi Anda.")
+                return
+            session.pending_transaction = None
             
             # Prepare row data
-            row_data = [
+            row_data = build_transaction_row(
+                user_id,
                 transaction.get('date', datetime.now().strftime("%Y-%m-%d")),  # Use the date from parsed data
                 transaction.get('amount', 0),
                 transaction.get('category', 'Lainnya'),
-                transaction.get('description', ''),
-                user_id,
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ]
+                transaction.get('description', '')
+            )
             
             # Append to Google Sheet
-            sheet.append_row(row_data)
+            try:
+                budget_warnings = await record_transactions(context.user_data, user_id, [row_data])
+            except Exception as e:
+                logger.error(f"Error recording transaction: {e}", exc_info=True)
+                # Keep the transaction and its buttons so the user can retry
+                session.pending_transaction = transaction
+                await query.edit_message_text(
+                    "❌ Gagal mencatat transaksi. Silakan coba lagi.",
+                    reply_markup=query.message.reply_markup
+                )
+                return
+            if key is not None:
+                committed_keys.add(key)
             
             # Determine transaction type for display
             amount = transaction.get('amount', 0)
@@ -1267,18 +4698,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
             # Store the message ID for deletion
-            if 'messages_to_delete' not in context.user_data:
-                context.user_data['messages_to_delete'] = []
+            track_message_for_deletion(context.user_data, confirmation_message.message_id)
             
-            # Add the confirmation message ID to the list
-            context.user_data['messages_to_delete'].append(confirmation_message.message_id)
+            # Schedule message deletion (coalesced per chat)
+            schedule_message_deletion(context, update.effective_chat.id, user_id)
             
-            # Schedule message deletion after 1 seconds
-            context.job_queue.run_once(
-                delete_transaction_messages, 
-                1,  # 1 seconds delay
-                data={'chat_id': update.effective_chat.id, 'user_id': user_id}
-            )
+            await send_budget_warnings(context, update.effective_chat.id, budget_warnings)
         else:
             # If not confirmed, ask for manual input
             keyboard = [
@@ -1294,7 +4719,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Handle amount input after transaction type selection
 async def handle_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if 'transaction_type' not in context.user_data:
+    session = get_session(context.user_data)
+    if session.transaction_type is None:
         return
     
     try:
@@ -1303,23 +4729,24 @@ async def handle_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE
         amount = float(amount_text)
         
         # Adjust sign based on transaction type
-        if context.user_data['transaction_type'] == 'expense':
+        if session.transaction_type == 'expense':
             amount = -abs(amount)  # Make negative for expenses
         else:
             amount = abs(amount)   # Make positive for income
         
-        description = context.user_data.get('description', '')
+        description = session.description or ''
         
-        # Ask for category
-        context.user_data['amount'] = amount
+        # Ask for category; the buttons carry a key so a second tap writes nothing
+        session.amount = amount
+        session.manual_key = new_idempotency_key()
         
         # Suggest categories based on transaction type
-        if context.user_data['transaction_type'] == 'income':
+        if session.transaction_type == 'income':
             categories = ["Gaji", "Bonus", "Investasi", "Hadiah", "Lainnya"]
         else:
             categories = ["Makanan", "Transportasi", "Belanja", "Hiburan", "Tagihan", "Lainnya"]
         
-        keyboard = [[InlineKeyboardButton(cat, callback_data=f"cat_{cat}")] for cat in categories]
+        keyboard = [[InlineKeyboardButton(cat, callback_data=f"cat_{cat}_{session.manual_key}")] for cat in categories]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await update.message.reply_text(
@@ -1336,25 +4763,45 @@ async def category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if query.data.startswith("cat_"):
         category = query.data.split("_")[1]
+        key = callback_key(query.data, f"cat_{category}")
         user_id = update.effective_user.id
         
+        if key is not None and key in committed_keys:
+            # Repeated tap or redelivered callback, the row is already written
+            return
+        
         # Get transaction data
-        amount = context.user_data.get('amount', 0)
-        description = context.user_data.get('description', '')
+        session = get_session(context.user_data)
+        if session.amount is None or (key is not None and session.manual_key != key):
+            await query.edit_message_text("❌ Transaksi sudah kedaluwarsa. Silakan kirim ulang transaksi Anda.")
+            return
+        
+        amount = session.amount
+        description = session.description or ''
         
         # Prepare row data
-        today = datetime.now().strftime("%Y-%m-%d")
-        row_data = [
-            today,
+        transaction_date = session.date or datetime.now().strftime("%Y-%m-%d")
+        row_data = build_transaction_row(
+            user_id,
+            transaction_date,
             amount,  # Already has correct sign (positive for income, negative for expense)
             category,
-            description,
-            user_id,
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ]
+            description
+        )
         
         # Append to Google Sheet
-        sheet.append_row(row_data)
+        try:
+            budget_warnings = await record_transactions(context.user_data, user_id, [row_data])
+        except Exception as e:
+            logger.error(f"Error recording transaction: {e}", exc_info=True)
+            # The manual entry is kept, so the same buttons can be tapped again
+            await query.edit_message_text(
+                "❌ Gagal mencatat transaksi. Silakan coba lagi.",
+                reply_markup=query.message.reply_markup
+            )
+            return
+        if key is not None:
+            committed_keys.add(key)
         
         # Determine transaction type for display
         transaction_type = "Pemasukan" if amount > 0 else "Pengeluaran"
@@ -1367,42 +4814,120 @@ async def category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Deskripsi: {description}"
         )
         
-        # Clear user data
-        context.user_data.clear()
+        # Clear the manual entry flow (settings and budgets are kept)
+        session.clear_manual_entry()
+        
+        await send_budget_warnings(context, update.effective_chat.id, budget_warnings)
 
-def main():
-    # Create application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+def build_application(token=TELEGRAM_TOKEN, persistence_path="bot_data.pickle", request=None):
+    """Create the application with every handler and job registered.
     
+    `request` replaces the HTTP layer of the bot, the load test uses it to
+    run without Telegram.
+    """
     # Create persistence object
-    persistence = PicklePersistence(filepath="bot_data.pickle")
+    persistence = PicklePersistence(filepath=persistence_path)
     
-    # Create application with persistence
-    application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
+    # Create application with persistence and concurrent update processing
+    builder = (
+        Application.builder()
+        .token(token)
+        .persistence(persistence)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
     
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("catat", record_command))
-    application.add_handler(CommandHandler("laporan", report))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("sheet", sheet_link))
-    application.add_handler(CommandHandler("hapus", delete_data))
-    application.add_handler(CommandHandler("hapuspesan", toggle_delete_messages))
+    # Add handlers (each one serialized per user)
+    application.add_handler(CommandHandler("start", serialize_per_user(start)))
+    application.add_handler(CommandHandler("catat", serialize_per_user(record_command)))
+    application.add_handler(CommandHandler("laporan", serialize_per_user(report)))
+    application.add_handler(CommandHandler("grafik", serialize_per_user(chart)))
+    application.add_handler(CommandHandler("analisis", serialize_per_user(analysis_command)))
+    application.add_handler(CommandHandler("anggaran", serialize_per_user(budget_command)))
+    application.add_handler(CommandHandler("rutin", serialize_per_user(recurring_command)))
+    application.add_handler(CommandHandler("cari", serialize_per_user(search_command)))
+    application.add_handler(CommandHandler("riwayat", serialize_per_user(history_command)))
+    application.add_handler(CommandHandler("kategori", serialize_per_user(category_command)))
+    application.add_handler(CommandHandler("statistik", serialize_per_user(statistics_command)))
+    application.add_handler(CommandHandler("help", serialize_per_user(help_command)))
+    application.add_handler(CommandHandler("sheet", serialize_per_user(sheet_link)))
+    application.add_handler(CommandHandler("hapus", serialize_per_user(delete_data)))
+    application.add_handler(CommandHandler("batal", serialize_per_user(undo_delete)))
+    application.add_handler(CommandHandler("hapuspesan", serialize_per_user(toggle_delete_messages)))
+    application.add_handler(CommandHandler("ringkasan", serialize_per_user(toggle_digest)))
     
     # Add callback handlers
-    application.add_handler(CallbackQueryHandler(multiple_transactions_callback, pattern="^confirm_all_"))
-    application.add_handler(CallbackQueryHandler(delete_callback, pattern="^delete_"))
-    application.add_handler(CallbackQueryHandler(delete_specific_callback, pattern="^del_specific_"))
-    application.add_handler(CallbackQueryHandler(confirm_delete_callback, pattern="^confirm_delete_"))
-    application.add_handler(CallbackQueryHandler(button_callback, pattern="^(confirm_|type_)"))
-    application.add_handler(CallbackQueryHandler(category_callback, pattern="^cat_"))
-    
-    # Add message handler
+    application.add_handler(CallbackQueryHandler(serialize_per_user(multiple_transactions_callback), pattern="^confirm_all_"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(delete_callback), pattern="^delete_"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(delete_specific_callback), pattern="^del_specific_"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(confirm_delete_callback), pattern="^confirm_delete_"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(button_callback), pattern="^(confirm_|type_)"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(category_callback), pattern="^cat_"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(search_callback), pattern="^cari_"))
+    application.add_handler(CallbackQueryHandler(serialize_per_user(history_callback), pattern="^hist_"))
+    
+    # Add message handlers
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-        message_handler
+        serialize_per_user(message_handler)
+    ))
+    application.add_handler(MessageHandler(
+        filters.PHOTO & filters.ChatType.PRIVATE,
+        serialize_per_user(photo_handler)
     ))
     
+    # Post recurring transactions daily, and once at startup to catch up after downtime
+    application.job_queue.run_daily(materialize_recurring_transactions, time=RECURRING_RUN_TIME)
+    application.job_queue.run_once(materialize_recurring_transactions, 10)
+    
+    # Remove tombstoned rows in bulk outside busy hours
+    application.job_queue.run_daily(compact_ledger, time=COMPACTION_TIME)
+    
+    # Refresh the Sheets token ahead of expiry, outside of user requests
+    if sheets_connection is not None:
+        application.job_queue.run_repeating(
+            maintain_sheets_connection, SHEETS_KEEPALIVE_INTERVAL, first=SHEETS_KEEPALIVE_INTERVAL
+        )
+    
+    # Weekly and monthly digests, checked every morning
+    application.job_queue.run_daily(send_digests, time=DIGEST_TIME)
+    
+    # Persist Gemini usage accounting for /statistik
+    application.job_queue.run_repeating(flush_gemini_usage, GEMINI_USAGE_FLUSH_INTERVAL, first=GEMINI_USAGE_FLUSH_INTERVAL)
+    
+    # Drop idle conversation state so user_data and the pickle stay small
+    application.job_queue.run_repeating(expire_sessions, SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+    application.job_queue.run_repeating(prune_duplicate_index, SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+    
+    # Pick up edits made directly in the Google Sheet
+    if sheet_synchronizer is not None:
+        application.job_queue.run_repeating(sync_sheet_changes, SHEET_SYNC_INTERVAL, first=SHEET_SYNC_INTERVAL)
+    
+    # Copy SQLite ledger changes to the sheet in the background
+    if sheets_replica is not None:
+        application.job_queue.run_repeating(flush_sheets_mirror, MIRROR_FLUSH_INTERVAL, first=MIRROR_FLUSH_INTERVAL)
+    
+    return application
+
+def main():
+    genai.configure(api_key=GEMINI_API_KEY)
+    open_storage()
+    
+    # Make sure the ledger (and its sheet replica) has every column the bot writes
+    storage.ensure_schema()
+    if sheets_replica is not None:
+        sheets_replica.ensure_schema()
+    
+    # Load the ledger into memory for search and history
+    transaction_index.load()
+    duplicate_index.seed(transaction_index.records.values())
+    
+    application = build_application()
+    
     # Start the Bot
     application.run_polling()
 
@@ -0,0 +1,99 @@
+"""Table-driven tests of the local date resolver."""
+import os
+from datetime import date
+
+import pytest
+
+# main reads its configuration at import time; use a throwaway local ledger
+os.environ.setdefault('AUTHORIZED_USER_ID', '1')
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:TEST')
+os.environ.setdefault('GEMINI_API_KEY', 'test')
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = ':memory:'
+os.environ['SHEETS_MIRROR'] = '0'
+
+from main import parse_date_from_text, resolve_date_expression
+
+TODAY = date(2026, 10, 19)  # a Monday
+
+@pytest.mark.parametrize("text, expected", [
+    # No date expression
+    ("beli kopi 20000", None),
+    ("cicilan 2 minggu", None),
+    ("bayar 1.250.000", None),
+    ("beli 25.000", None),
+    ("makan 12.30", None),
+    
+    # Relative days
+    ("kemarin makan 50rb", "2026-10-18"),
+    ("yesterday lunch", "2026-10-18"),
+    ("besok bayar", "2026-10-20"),
+    ("lusa", "2026-10-21"),
+    ("kemarin lusa beli bensin", "2026-10-17"),
+    ("day before yesterday", "2026-10-17"),
+    ("3 hari yang lalu", "2026-10-16"),
+    ("3 hari lalu", "2026-10-16"),
+    ("2 days ago", "2026-10-17"),
+    ("seminggu lalu", "2026-10-12"),
+    ("a week ago", "2026-10-12"),
+    ("dua minggu lalu", "2026-10-05"),
+    ("2 hari lagi", "2026-10-21"),
+    ("minggu lalu", "2026-10-12"),
+    ("last week", "2026-10-12"),
+    ("bulan lalu", "2026-09-19"),
+    ("last month", "2026-09-19"),
+    ("bulan depan", "2026-11-19"),
+    ("tahun lalu", "2025-10-19"),
+    
+    # Weekdays
+    ("Senin", "2026-10-19"),
+    ("Senin lalu", "2026-10-12"),
+    ("last Monday", "2026-10-12"),
+    ("Senin depan", "2026-10-26"),
+    ("next monday", "2026-10-26"),
+    ("jumat", "2026-10-16"),
+    ("jumat depan", "2026-10-23"),
+    ("hari minggu", "2026-10-18"),
+    ("hari minggu lalu", "2026-10-18"),
+    ("sunday", "2026-10-18"),
+    
+    # Month boundaries
+    ("awal bulan", "2026-10-01"),
+    ("akhir bulan", "2026-10-31"),
+    ("pertengahan bulan", "2026-10-15"),
+    ("awal bulan lalu", "2026-09-01"),
+    ("akhir bulan lalu", "2026-09-30"),
+    ("beginning of last month", "2026-09-01"),
+    ("end of the month", "2026-10-31"),
+    ("akhir februari", "2026-02-28"),
+    
+    # Explicit dates
+    ("5 Mei 2023", "2023-05-05"),
+    ("5 Mei", "2026-05-05"),
+    ("5 may 2023", "2023-05-05"),
+    ("May 5, 2023", "2023-05-05"),
+    ("1st december", "2026-12-01"),
+    ("05/05/2023", "2023-05-05"),
+    ("5-5-23", "2023-05-05"),
+    ("2023-05-05", "2023-05-05"),
+    ("05/05", "2026-05-05"),
+    
+    # Day of month
+    ("tanggal 5", "2026-10-05"),
+    ("tgl 25 bulan lalu", "2026-09-25"),
+    ("tanggal 31", "2026-10-31"),
+    ("bayar kos tgl 31 bulan lalu", "2026-09-30"),
+    ("tgl 30 bulan depan", "2026-11-30"),
+    
+    # Invalid dates stop resolution instead of falling through to later rules
+    ("31/02", None),
+    ("31/02 3 hari lalu", None),
+    ("tgl 45 bulan lalu", None),
+])
+def test_resolve_date_expression(text, expected):
+    resolved = resolve_date_expression(text, TODAY)
+    assert (resolved and resolved.isoformat()) == expected
+
+def test_parse_date_from_text_defaults_to_today():
+    assert parse_date_from_text("beli kopi 20000", TODAY) == "2026-10-19"
+    assert parse_date_from_text("kemarin beli kopi", TODAY) == "2026-10-18"